@@ -0,0 +1,92 @@
+"""Benchmarks of the DGT export, not part of the package.
+
+python bench/dgt.py dgt-rows --rows 10000
+"""
+
+import time
+from datetime import datetime, timezone
+
+import minicli
+
+from egapro import dgt, models, utils
+
+
+def fake_declaration(i):
+    """Synthetic, but complete, declaration for benchmarks."""
+    big = i % 3 == 0
+    mode = "csp" if i % 2 else "niveau_branche"
+    tranches = {":29": 2.8, "30:39": -1.5, "40:49": 0.0, "50:": 12.33}
+    ues = {}
+    if i % 5 == 0:
+        ues = {
+            "nom": "UES",
+            "entreprises": [{"siren": "315710251", "raison_sociale": "Baz"}],
+        }
+    return {
+        "id": f"{i:x}",
+        "source": "formulaire",
+        "déclarant": {"email": f"foo{i}@bar.org", "nom": "Martine", "prénom": "M"},
+        "entreprise": {
+            "siren": f"{i:09}",
+            "raison_sociale": f"Company {i}",
+            "région": "84",
+            "département": "26",
+            "code_naf": "47.25Z",
+            "adresse": "1 rue de la Paix",
+            "commune": "Valence",
+            "code_postal": "26000",
+            "effectif": {"tranche": "1000:" if big else "50:250", "total": 149},
+            "ues": ues,
+        },
+        "déclaration": {
+            "année_indicateurs": 2020,
+            "date": "2021-03-01T10:11:12+00:00",
+            "fin_période_référence": "2020-12-31",
+            "index": 87,
+            "points": 87,
+            "points_calculables": 100,
+            "publication": {"date": "2021-03-02", "url": "https://example.org"},
+        },
+        "indicateurs": {
+            "rémunérations": {
+                "mode": mode,
+                "note": 36,
+                "résultat": 1.5,
+                "catégories": [{"nom": "x", "tranches": tranches}]
+                * (4 if mode == "csp" else 12),
+            },
+            "augmentations": {"note": 20, "catégories": [0.5, None, 1.2, -0.1]},
+            "promotions": {"note": 15, "catégories": [0.1, 0.2, None, -0.3]},
+            "augmentations_et_promotions": {"note": 35, "résultat": 1.2},
+            "congés_maternité": {"note": 15, "résultat": 100},
+            "hautes_rémunérations": {"note": 5, "résultat": 3},
+        },
+    }
+
+
+@minicli.cli
+def dgt_rows(rows: int = 100_000):
+    """Per row time of the DGT rows preparation, flattened vs compiled columns.
+
+    :rows: number of synthetic declarations
+    """
+    _, columns = dgt.headers_columns(12)
+    modified_at = datetime.now(timezone.utc)
+
+    def flattened(data):
+        data = utils.flatten(data, flatten_lists=True)
+        return [dgt.clean_cell(fmt(data.get(c))) for c, fmt in columns]
+
+    for name, build in [("flatten", flattened), ("compiled", dgt.compiled_row(12))]:
+        elapsed = 0
+        for i in range(rows):
+            data = dgt.prepare_record(models.Data(fake_declaration(i)))
+            data["modified_at"] = modified_at
+            start = time.perf_counter()
+            build(data)
+            elapsed += time.perf_counter() - start
+        print(f"{name}: {elapsed / rows * 1_000_000:.1f} µs per row")
+
+
+if __name__ == "__main__":
+    minicli.run()
@@ -1,7 +1,13 @@
+import asyncio
+import os
 import sys
+import time
 import urllib.request
-from collections import Counter
-from datetime import date
+import zipfile
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from datetime import date, datetime, timezone
 from importlib import import_module
 from io import BytesIO
 from pathlib import Path
@@ -13,6 +19,7 @@ import ujson as json
 from openpyxl import load_workbook
 
 from egapro import (
+    cache,
     config,
     constants,
     db,
@@ -21,21 +28,63 @@ from egapro import (
     exporter,
     helpers,
     models,
+    pdf,
     schema,
     tokens,
     loggers,
+    utils,
 )
 from egapro.pdf import declaration as declaration_receipt
 from egapro.exporter import dump  # noqa: expose to minicli
 from egapro.utils import json_dumps
 
 
+async def parse_since(since, watermark):
+    """Start of a delta export: `since` as an ISO date or datetime, or the time
+    of the previous export named `watermark` when `since` is "last"."""
+    if since == "last":
+        since = await db.watermark.get(watermark)
+        if since is None:
+            sys.exit("No watermark found, run a full export")
+        return since - exporter.DELTA_MARGIN
+    since = datetime.fromisoformat(since)
+    if not since.tzinfo:
+        since = since.replace(tzinfo=timezone.utc)
+    return since
+
+
+def tombstones_path(path):
+    """Where a delta CSV export writes its deletions: foo.csv => foo.deleted.csv"""
+    return path.with_name(f"{path.stem}.deleted{path.suffix or '.csv'}")
+
+
 @minicli.cli
-async def dump_dgt(path: Path, max_rows: int = None):
-    wb = await dgt.as_xlsx(max_rows)
-    print("Writing the XLSX to", path)
-    wb.save(path)
-    print("Done")
+async def dump_dgt(path: Path, max_rows: int = None, workers: int = None, since=None):
+    """Export the DGT XLSX, written to disk while the rows are being read.
+
+    :path: where to write the file, or "-" to stream it to stdout
+    :max_rows: max number of declarations to export
+    :workers: number of processes preparing the rows (default: DGT_WORKERS)
+    :since: only export changes made since this date (YYYY-MM-DD or ISO
+            datetime), or since the previous export when given "last";
+            deletions are listed in the "Suppressions" sheet
+    """
+    # Changes made during the export will be in the next delta.
+    started_at = utils.utcnow()
+    if since:
+        since = await parse_since(since, "dump_dgt")
+    if str(path) == "-":
+        # Keep stdout for the file itself.
+        with redirect_stdout(sys.stderr):
+            await dgt.dump_xlsx(sys.stdout.buffer, max_rows, workers, since)
+        sys.stdout.buffer.flush()
+    else:
+        print("Writing the XLSX to", path)
+        with path.open("wb") as f:
+            await dgt.dump_xlsx(f, max_rows, workers, since)
+        print("Done")
+    if not max_rows:
+        await db.watermark.put("dump_dgt", started_at)
 
 
 @minicli.cli
@@ -48,29 +97,99 @@ async def search(q, verbose=False):
             print(row)
 
 
-@minicli.cli
-async def export_public_data(path: Path):
-    print("Writing the CSV to", path)
+async def export_csv(name, export, path, since):
+    """Run the CSV `export` to `path`, only the changes when `since` is given,
+    with the deletions next to it, then store the `name` watermark."""
+    # Changes made during the export will be in the next delta.
+    started_at = utils.utcnow()
+    if since:
+        since = await parse_since(since, name)
+        print("Writing changes since", since, "to", path)
+    else:
+        print("Writing the CSV to", path)
     with path.open("w") as f:
-        await exporter.public_data(f)
+        await export(f, since)
+    if since:
+        with tombstones_path(path).open("w") as f:
+            count = await exporter.tombstones(f, since)
+        print(f"{count} deletions written to", tombstones_path(path))
     print("Done")
+    await db.watermark.put(name, started_at)
 
 
 @minicli.cli
-async def export_indexes(path: Path):
-    print("Writing the CSV to", path)
-    with path.open("w") as f:
-        await exporter.indexes(f)
-    print("Done")
+async def export_public_data(path: Path, since=None):
+    """Export the public declarations as CSV.
+
+    :since: only export changes made since this date (YYYY-MM-DD or ISO
+            datetime), or since the previous export when given "last";
+            deletions are written to a .deleted.csv file next to `path`
+    """
+    await export_csv("export_public_data", exporter.public_data, path, since)
 
 
 @minicli.cli
-async def full(path: Path):
-    """Create a full JSON export."""
-    print("Writing to", path)
-    with path.open("w") as f:
-        await exporter.full(f)
-    print("Done")
+async def export_indexes(path: Path, since=None):
+    """Export the indexes of all the declarations as CSV.
+
+    :since: only export changes made since this date (YYYY-MM-DD or ISO
+            datetime), or since the previous export when given "last";
+            deletions are written to a .deleted.csv file next to `path`
+    """
+    await export_csv("export_indexes", exporter.indexes, path, since)
+
+
+@minicli.cli
+async def export_parquet(path: Path, row_group_size: int = exporter.ROW_GROUP_SIZE):
+    """Create a typed, columnar, export of the declarations.
+
+    :path: where to write the Parquet file
+    :row_group_size: number of declarations per row group
+    """
+    print("Writing the Parquet file to", path)
+    try:
+        count = await exporter.parquet(path, row_group_size)
+    except ImportError:
+        print('pyarrow is not installed. Type "pip install egapro[parquet]"')
+        return
+    print("Done,", count, "declarations")
+
+
+@minicli.cli
+async def full(path: Path, since=None):
+    """Create a full JSON export, or a delta one when `since` is given.
+
+    :since:     Only export changes made since this date (YYYY-MM-DD or ISO
+                datetime), or since the previous export when given "last".
+    """
+    # Changes made during the export will be in the next delta.
+    started_at = utils.utcnow()
+    if since:
+        since = await parse_since(since, "export")
+        print("Writing changes since", since, "to", path)
+        with path.open("w") as f:
+            count = await exporter.delta(f, since)
+        print(f"Done, {count} changes")
+    else:
+        print("Writing to", path)
+        with path.open("w") as f:
+            await exporter.full(f)
+        print("Done")
+    await db.watermark.put("export", started_at)
+
+
+@minicli.cli
+def compact(destination: Path, snapshot: Path, *deltas):
+    """Merge delta exports, in order, into a full one.
+
+    :destination:   where to write the new full export
+    :snapshot:      previous full export
+    :deltas:        delta exports made since the snapshot
+    """
+    print("Writing to", destination)
+    with destination.open("w") as f:
+        count = exporter.compact(snapshot, deltas, f)
+    print(f"Done, {count} déclarations")
 
 
 @minicli.cli
@@ -110,13 +229,37 @@ async def create_indexes():
 
 
 @minicli.cli
-async def reindex():
-    """Reindex Full Text search."""
-    await db.search.truncate()
-    records = await db.declaration.completed()
-    bar = progressist.ProgressBar(prefix="Reindexing", total=len(records), throttle=100)
-    for record in bar.iter(records):
-        await db.search.index(record.data)
+async def reindex(since=None):
+    """Reindex Full Text search.
+
+    :since:     Only reindex déclarations modified since this date (YYYY-MM-DD or
+                ISO datetime), or since the last sync when given "last".
+    """
+    if since:
+        if since != "last":
+            since = datetime.fromisoformat(since)
+            if not since.tzinfo:
+                since = since.replace(tzinfo=timezone.utc)
+        count = await db.search.sync(None if since == "last" else since)
+        if count is None:
+            sys.exit("No watermark found (or sync already running), run a full reindex")
+        print(f"Reindexed {count} déclarations")
+        return
+    # Changes made during the full reindex will be caught by the next sync.
+    started_at = utils.utcnow()
+    total = await db.declaration.count_completed()
+    bar = progressist.ProgressBar(prefix="Reindexing", total=total, throttle=100)
+
+    async def records():
+        async for record in db.declaration.iter_completed():
+            bar.update()
+            yield record.data
+
+    start = time.perf_counter()
+    count = await db.search.bulk_index(records())
+    elapsed = time.perf_counter() - start
+    print(f"Indexed {count} rows in {elapsed:.1f}s ({count / elapsed:.0f} rows/s)")
+    await db.watermark.put("search", started_at)
 
 
 @minicli.cli
@@ -138,7 +281,7 @@ async def validate(pdb=False, verbose=False):
     from egapro.schema import validate, cross_validate
 
     errors = Counter()
-    for row in await db.declaration.completed():
+    async for row in db.declaration.iter_completed():
         data = json.loads(json_dumps(row.data.raw))
         try:
             validate(data)
@@ -266,13 +409,16 @@ async def ownership(email):
 async def replace_siren(year: int, old, new):
     res = await db.declaration.execute(
         "UPDATE declaration "
-        "SET siren=$3::text, "
+        "SET siren=$3::text, modified_at=NOW(), "
         "data=jsonb_set(data, '{entreprise,siren}', to_jsonb($3)) "
         "WHERE year=$1 AND siren=$2",
         year,
         old,
         new,
     )
+    if res != "UPDATE 0":
+        # So the delta exports drop the old one.
+        await db.tombstone.put(old, year)
     print(res)
 
 
@@ -316,9 +462,100 @@ async def receipt(siren, year, destination=None):
     print(pdf.output(destination) or f"Saved to {destination}")
 
 
+@contextmanager
+def open_destination(path):
+    """Yield a `write(filename, blob)` function, to a zip file or to a directory."""
+    if path.suffix == ".zip":
+        with zipfile.ZipFile(path, "w") as archive:
+            yield archive.writestr
+    else:
+        path.mkdir(parents=True, exist_ok=True)
+        yield lambda filename, blob: (path / filename).write_bytes(blob)
+
+
+@minicli.cli
+async def receipts(
+    destination: Path,
+    year: int = None,
+    region=None,
+    departement=None,
+    workers: int = None,
+):
+    """Export the PDF receipts of all the matching declarations.
+
+    :destination: Directory, or zip file when ending with .zip
+    :year:        Only the declarations of this year
+    :region:      Only the declarations of this région (code)
+    :departement: Only the declarations of this département (code)
+    :workers:     Number of rendering processes (default: CPU count)
+    """
+    filters = {
+        "year": year,
+        "data->'entreprise'->>'région'": region,
+        "data->'entreprise'->>'département'": departement,
+    }
+    where = ["declared_at IS NOT NULL"]
+    params = []
+    for column, value in filters.items():
+        if value is not None:
+            params.append(value)
+            where.append(f"{column}=${len(params)}")
+    where = " AND ".join(where)
+    total = await db.declaration.fetchval(
+        f"SELECT COUNT(*) FROM declaration WHERE {where}", *params
+    )
+    if not total:
+        sys.exit("Nothing to export!")
+    workers = workers or os.cpu_count()
+    bar = progressist.ProgressBar(prefix="Rendering", total=total, throttle=100)
+    loop = asyncio.get_running_loop()
+    # Bounded number of PDFs in flight, to keep memory flat whatever the total.
+    pending = deque()
+    count = 0
+
+    async def write_next():
+        nonlocal count
+        key, future = pending.popleft()
+        try:
+            blob, filename = await future
+        except Exception as err:
+            print(f"Cannot render {key}: {err}")
+        else:
+            write(filename, blob)
+            count += 1
+        bar.update()
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers, initializer=pdf.warmup) as pool:
+        with open_destination(destination) as write:
+            async for record in db.declaration.cursor(
+                f"SELECT siren, year, data, modified_at FROM declaration WHERE {where}",
+                *params,
+            ):
+                data = {"modified_at": record["modified_at"], **record.data}
+                future = loop.run_in_executor(
+                    pool, pdf.output, declaration_receipt.main, data
+                )
+                pending.append((f"{record['siren']}/{record['year']}", future))
+                if len(pending) >= workers * 2:
+                    await write_next()
+            while pending:
+                await write_next()
+    elapsed = time.perf_counter() - start
+    print(
+        f"Exported {count} receipts to {destination} in {elapsed:.1f}s "
+        f"({count / elapsed:.1f} receipts/s)"
+    )
+
+
 @minicli.cli("from_", name="from")
 async def resend_receipts(
-    siren=[], from_=None, recipient=None, year=constants.CURRENT_YEAR
+    siren=[],
+    from_=None,
+    recipient=None,
+    year=constants.CURRENT_YEAR,
+    checkpoint: Path = None,
+    workers: int = None,
 ):
     """Resend receipt for a list of sirens in the current year
 
@@ -326,6 +563,9 @@ async def resend_receipts(
     :from:      Start date (YYYY-MM-DD) to consider declarations candidates
     :recipient: Send receipts to this address (eg. for validation/testing)
     :year:      Which year to consider (default: current)
+    :checkpoint: File keeping track of the receipts already sent, to resume an
+                 interrupted run
+    :workers:   Number of processes rendering the receipts (default: CPU count)
     """
     if siren:
         sql = (
@@ -345,21 +585,22 @@ async def resend_receipts(
     records = await db.declaration.fetch(*sql)
     if not records:
         sys.exit("Nothing to send!")
-    for record in records:
-        data = record.data
-        url = config.DOMAIN + data.uri
-        recipient_ = recipient or record["declarant"]
-        try:
-            emails.success.send(
-                recipient_,
-                url=url,
-                modified_at=record["modified_at"],
+
+    def items():
+        for record in records:
+            data = record.data
+            context = {
                 **data,
-            )
-        except Exception as ex:
-            print(ex)
-            print(data)
-            continue
+                "url": config.DOMAIN + data.uri,
+                "modified_at": record["modified_at"],
+            }
+            key = f"{data.siren}/{data.year}"
+            yield key, recipient or record["declarant"], context
+
+    start = time.perf_counter()
+    count = await emails.send_many("success", items(), checkpoint, workers)
+    elapsed = time.perf_counter() - start
+    print(f"Sent {count} receipts in {elapsed:.1f}s")
 
 
 @minicli.cli
@@ -391,6 +632,25 @@ def shell():
         )
 
 
+@minicli.cli
+async def send_emails(stats=False):
+    """Send the queued emails now, or only show the outbox stats.
+
+    :stats: Only show the outbox stats.
+    """
+    if not stats:
+        print(f"Sent {await emails.outbox.flush()} emails")
+    for key, value in (await emails.outbox.stats()).items():
+        print(f"{key}: {value}")
+
+
+@minicli.cli
+async def siren_cache_stats():
+    """Show the company metadata cache stats."""
+    for key, value in (await helpers.entreprise_cache_stats()).items():
+        print(f"{key}: {value}")
+
+
 @minicli.cli
 async def sync_address(limit=100, offset=0):
     rows = await db.declaration.fetch(
@@ -400,24 +660,14 @@ async def sync_address(limit=100, offset=0):
         offset,
     )
     bar = progressist.ProgressBar(prefix="Syncing", total=len(rows))
-    # Keep a cache, just in case we need a full rerun quickly.
-    ROOT = Path(".").parent / "tmp/api_entreprise"
-    ROOT.mkdir(exist_ok=True)
-    for idx, row in enumerate(bar.iter(rows)):
+    # Lookups are cached in DB, so a rerun does not hit the API again.
+    for row in bar.iter(rows):
         siren = row["siren"]
         data = row["data"]
-        dest = ROOT / f"{siren}.json"
-        if not dest.exists():
-            try:
-                new = await helpers.get_entreprise_details(siren)
-            except ValueError as err:
-                print(siren, err)
-                continue
-            if new:
-                dest.write_text(json_dumps(new))
-        else:
-            new = json.loads(dest.read_text())
-        if not new:
+        try:
+            new = await helpers.get_entreprise_details(siren)
+        except ValueError as err:
+            print(siren, err)
             continue
         row["data"]["entreprise"].update(new)
         await db.declaration.put(
@@ -433,11 +683,14 @@ async def sync_address(limit=100, offset=0):
 async def wrapper():
     loggers.init()
     config.init()
+    cache.init()
+    helpers.init()
     try:
         await db.init()
     except RuntimeError as err:
         print(err)
     yield
+    await helpers.terminate()
     await db.terminate()
 
 
@@ -0,0 +1,182 @@
+"""Results cache, with TTL and size bounds, invalidated on writes."""
+
+import hashlib
+import os
+import pickle
+import time
+from collections import OrderedDict
+from functools import wraps
+from pathlib import Path
+
+from . import config
+
+MISSING = object()
+
+
+class MemoryCache:
+    """Per process LRU cache."""
+
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return MISSING
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class FileCache(MemoryCache):
+    """Cache shared by all the workers of a host, one pickle file per key.
+
+    The size is only checked every `maxsize / 10` writes of each worker, so the
+    cache may go a bit beyond `maxsize` meanwhile.
+    """
+
+    def __init__(self, ttl=60, maxsize=1024, path=None):
+        super().__init__(ttl, maxsize)
+        self.root = Path(path or config.CACHE_PATH)
+        self.root.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.prune_every = max(1, maxsize // 10)
+        self.writes = 0
+
+    def path(self, key):
+        return self.root / hashlib.sha1(key.encode()).hexdigest()
+
+    def entries(self):
+        """Cached values files, skipping the ones being written."""
+        return [path for path in self.root.iterdir() if not path.suffix]
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            if path.stat().st_mtime + self.ttl < time.time():
+                path.unlink()
+                raise FileNotFoundError
+            value = pickle.loads(path.read_bytes())
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        # Write then rename, so concurrent readers never see a partial file.
+        tmp = path.with_suffix(f".{os.getpid()}")
+        try:
+            tmp.write_bytes(pickle.dumps(value))
+            tmp.replace(path)
+        except FileNotFoundError:
+            # Removed by a concurrent clear: just not cached.
+            return
+        self.writes += 1
+        if self.writes % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        now = time.time()
+        paths = []
+        for path in self.root.iterdir():
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if not path.suffix:
+                paths.append((mtime, path))
+            elif mtime + self.ttl < now:
+                # Left over by a worker that died while writing it.
+                path.unlink(missing_ok=True)
+        if len(paths) > self.maxsize:
+            paths.sort()
+            for _, path in paths[: len(paths) - self.maxsize]:
+                path.unlink(missing_ok=True)
+
+    def clear(self):
+        for path in self.entries():
+            path.unlink(missing_ok=True)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries()),
+        }
+
+
+BACKENDS = {"memory": MemoryCache, "file": FileCache}
+backend = MemoryCache()
+# Typeahead queries are many, small and short lived: keep them apart so they do
+# not evict the search results.
+suggestions = MemoryCache()
+
+
+def init():
+    global backend, suggestions
+    backend = BACKENDS[config.CACHE_BACKEND](
+        ttl=config.CACHE_TTL, maxsize=config.CACHE_SIZE
+    )
+    if config.CACHE_BACKEND == "file":
+        suggestions = FileCache(
+            ttl=config.SUGGEST_CACHE_TTL,
+            maxsize=config.SUGGEST_CACHE_SIZE,
+            path=f"{config.CACHE_PATH}-suggestions",
+        )
+    else:
+        suggestions = MemoryCache(
+            ttl=config.SUGGEST_CACHE_TTL, maxsize=config.SUGGEST_CACHE_SIZE
+        )
+
+
+def clear():
+    """Invalidate all cached results, to be called on every write they rely on."""
+    backend.clear()
+    suggestions.clear()
+
+
+def stats():
+    return backend.stats()
+
+
+def cached(func=None, *, store="backend"):
+    """Cache the results of an async function in the configured backend, or in
+    the module level cache named `store`."""
+    if func is None:
+        return lambda func: cached(func, store=store)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        # Looked up at call time, as init replaces the caches.
+        cache = globals()[store]
+        key = repr((func.__qualname__, args, sorted(kwargs.items())))
+        value = cache.get(key)
+        if value is MISSING:
+            value = await func(*args, **kwargs)
+            cache.set(key, value)
+        return value
+
+    return wrapper
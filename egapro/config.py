@@ -8,6 +8,8 @@ SMTP_PORT = 1025
 SMTP_PASSWORD = ""
 SMTP_LOGIN = ""
 SMTP_SSL = False
+# Seconds, for each blocking SMTP operation.
+SMTP_TIMEOUT = 30
 FROM_EMAIL = "EgaPro <index@travail.gouv.fr>"
 SITE_DESCRIPTION = "Egapro"
 EMAIL_SIGNATURE = "Egapro"
@@ -19,6 +21,8 @@ DBPASS = "postgres"
 DBSSL = False
 DBMINSIZE = 2
 DBMAXSIZE = 10
+# Number of rows fetched per round trip by server-side cursors (exports…).
+DBPREFETCH = 500
 BASE_URL = ""
 ALLOW_ORIGIN = "*"
 STAFF = []
@@ -28,6 +32,49 @@ API_ENTREPRISES = ""
 ALLOWED_IPS = []
 DOMAIN = "https://index-egapro.travail.gouv.fr"
 READONLY = False
+# Search results cache: "memory" (per process) or "file" (shared by workers).
+CACHE_BACKEND = "memory"
+CACHE_TTL = 60
+CACHE_SIZE = 1024
+CACHE_PATH = "/tmp/egapro-cache"
+# Company names suggestions, with their own cache (same backend as the search).
+SUGGEST_LIMIT = 10
+SUGGEST_CACHE_TTL = 300
+SUGGEST_CACHE_SIZE = 4096
+# Shared HTTP client for the company lookups APIs (timeouts in seconds).
+HTTP_TIMEOUT = 10.0
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_KEEPALIVE = 30.0
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_PER_HOST = 10
+# Company metadata cache, in seconds: known SIRENs, unknown or closed ones, and how
+# long an expired entry may still be served while it is refreshed in background.
+SIREN_TTL = 7 * 24 * 3600
+SIREN_NEGATIVE_TTL = 3600
+SIREN_STALE = 24 * 3600
+# Emails outbox: seconds between two polls, max emails per SMTP transaction, how
+# long a claimed batch is hidden from other workers (in seconds, never less than
+# twice OUTBOX_BATCH * SMTP_TIMEOUT), and retry policy (delay in seconds, doubled
+# at each attempt).
+OUTBOX_INTERVAL = 5
+OUTBOX_BATCH = 50
+OUTBOX_LEASE = 3600
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF = 60
+# PDF receipts: rendering processes, and cache of the rendered documents.
+PDF_WORKERS = 2
+PDF_CACHE_TTL = 24 * 3600
+PDF_CACHE_SIZE = 256
+# Seconds between two incremental syncs of the search index, 0 to disable.
+SEARCH_SYNC_INTERVAL = 0
+# Serve /search and /stats from an in-memory replica of the search data instead
+# of the DB, refreshed every SEARCH_REPLICA_INTERVAL seconds.
+SEARCH_REPLICA = False
+SEARCH_REPLICA_INTERVAL = 10
+# DGT export: processes preparing the rows (0 to prepare them in-process), and
+# number of declarations sent to a process at once.
+DGT_WORKERS = 2
+DGT_CHUNK = 500
 
 
 def init():
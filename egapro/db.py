@@ -1,13 +1,16 @@
+import base64
 import uuid
-from datetime import datetime
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
 
 import asyncpg
 from naf import DB as NAF
-from asyncstdlib.functools import lru_cache
 from asyncpg.exceptions import DuplicateDatabaseError, PostgresError
 import ujson as json
 
-from . import config, models, sql, utils, helpers
+from . import cache, config, models, sql, utils, helpers
 from .loggers import logger
 
 
@@ -15,6 +18,12 @@ class NoData(Exception):
     pass
 
 
+# Connection of the current unit of work, if any (see `table.transaction`).
+CONNECTION = ContextVar("connection", default=None)
+# Callbacks to run once the current unit of work is committed (see `on_commit`).
+AFTER_COMMIT = ContextVar("after_commit", default=None)
+
+
 class Record(asyncpg.Record):
     fields = []
 
@@ -45,13 +54,59 @@ class table:
     record_class = Record
 
     @classmethod
-    async def fetch(cls, sql, *params):
+    @asynccontextmanager
+    async def acquire(cls):
+        """Reuse the connection of the current unit of work, if any, otherwise
+        checkout one from the pool."""
+        conn = CONNECTION.get()
+        if conn is not None:
+            yield conn
+            return
         async with cls.pool.acquire() as conn:
+            yield conn
+
+    @classmethod
+    @asynccontextmanager
+    async def transaction(cls):
+        """Unit of work: every query run inside this block, whatever the table,
+        uses the same connection and the same transaction.
+
+        Nested calls create a savepoint.
+        """
+        outermost = CONNECTION.get() is None
+        callbacks = [] if outermost else AFTER_COMMIT.get()
+        async with cls.acquire() as conn:
+            async with conn.transaction():
+                token = CONNECTION.set(conn)
+                callbacks_token = AFTER_COMMIT.set(callbacks)
+                try:
+                    yield conn
+                finally:
+                    AFTER_COMMIT.reset(callbacks_token)
+                    CONNECTION.reset(token)
+        # Only reached once committed: on error, the exception goes through.
+        if outermost:
+            for callback in callbacks:
+                callback()
+
+    @staticmethod
+    def on_commit(callback):
+        """Call `callback` when the current unit of work is committed, or right
+        away outside of any unit of work."""
+        callbacks = AFTER_COMMIT.get()
+        if callbacks is None:
+            callback()
+        elif callback not in callbacks:
+            callbacks.append(callback)
+
+    @classmethod
+    async def fetch(cls, sql, *params):
+        async with cls.acquire() as conn:
             return await conn.fetch(sql, *params, record_class=cls.record_class)
 
     @classmethod
     async def fetchrow(cls, sql, *params):
-        async with cls.pool.acquire() as conn:
+        async with cls.acquire() as conn:
             row = await conn.fetchrow(sql, *params, record_class=cls.record_class)
         if not row:
             raise NoData
@@ -59,15 +114,33 @@ class table:
 
     @classmethod
     async def fetchval(cls, sql, *params):
-        async with cls.pool.acquire() as conn:
+        async with cls.acquire() as conn:
             row = await conn.fetchval(sql, *params)
         if row is None:
             raise NoData
         return row
 
+    @classmethod
+    async def cursor(cls, sql, *params, prefetch=None):
+        """Iterate over the query results using a server-side cursor.
+
+        Rows are loaded by batches of `prefetch` (default: config.DBPREFETCH), so
+        memory stays bounded whatever the size of the result set.
+        """
+        async with cls.acquire() as conn:
+            # Cursors can only be used inside a transaction.
+            async with conn.transaction():
+                async for row in conn.cursor(
+                    sql,
+                    *params,
+                    prefetch=prefetch or config.DBPREFETCH,
+                    record_class=cls.record_class,
+                ):
+                    yield row
+
     @classmethod
     async def execute(cls, sql, *params):
-        async with cls.pool.acquire() as conn:
+        async with cls.acquire() as conn:
             return await conn.execute(sql, *params)
 
 
@@ -78,12 +151,46 @@ class declaration(table):
     async def all(cls):
         return await cls.fetch("SELECT * FROM declaration")
 
+    # Do not select draft in this request, as it must reflect the declarations state
+    COMPLETED = (
+        "SELECT data, legacy, modified_at FROM declaration "
+        "WHERE declared_at IS NOT NULL ORDER BY declared_at DESC"
+    )
+
     @classmethod
     async def completed(cls):
-        # Do not select draft in this request, as it must reflect the declarations state
-        return await cls.fetch(
+        return await cls.fetch(cls.COMPLETED)
+
+    @classmethod
+    async def iter_completed(cls, limit=None, prefetch=None):
+        """Same as `completed`, but streamed from a server-side cursor."""
+        query = cls.COMPLETED + " LIMIT $1"
+        async for record in cls.cursor(query, limit, prefetch=prefetch):
+            yield record
+
+    @classmethod
+    async def iter_modified(cls, since, limit=None, prefetch=None):
+        """Iterate over the completed declarations modified after `since`."""
+        query = (
             "SELECT data, legacy, modified_at FROM declaration "
-            "WHERE declared_at IS NOT NULL ORDER BY declared_at DESC"
+            "WHERE declared_at IS NOT NULL AND modified_at > $1 ORDER BY modified_at "
+            "LIMIT $2"
+        )
+        async for record in cls.cursor(query, since, limit, prefetch=prefetch):
+            yield record
+
+    @classmethod
+    async def count_completed(cls, since=None):
+        """Number of completed declarations, only the ones modified after `since`
+        if given."""
+        if since is None:
+            return await cls.fetchval(
+                "SELECT COUNT(*) FROM declaration WHERE declared_at IS NOT NULL"
+            )
+        return await cls.fetchval(
+            "SELECT COUNT(*) FROM declaration "
+            "WHERE declared_at IS NOT NULL AND modified_at > $1",
+            since,
         )
 
     @classmethod
@@ -94,9 +201,18 @@ class declaration(table):
 
     @classmethod
     async def delete(cls, siren, year):
-        return await cls.execute(
-            "DELETE FROM declaration WHERE siren=$1 AND year=$2", siren, int(year)
-        )
+        async with cls.transaction() as conn:
+            group = await conn.fetchrow(sql.search_group, siren, int(year))
+            status = await conn.execute(
+                "DELETE FROM declaration WHERE siren=$1 AND year=$2", siren, int(year)
+            )
+            if status != "DELETE 0":
+                await tombstone.put(siren, year)
+            if group:
+                await stats.move(group, None)
+            # Readers would otherwise cache the not yet committed state again.
+            cls.on_commit(cache.clear)
+        return status
 
     @classmethod
     async def get_last(cls, siren):
@@ -129,18 +245,23 @@ class declaration(table):
         data.setdefault("entreprise", {})
         data["entreprise"]["siren"] = siren
         ft = helpers.extract_ft(data)
-        declared_at = await cls.get_declared_at(siren, year)
-        if not declared_at and not data.is_draft():
-            declared_at = modified_at
-        if declared_at:
-            data["déclaration"]["date"] = declared_at.isoformat()
-        if data.is_draft():
-            query = sql.insert_draft_declaration
-            args = (siren, int(year), modified_at, declarant, data.raw)
-        else:
-            query = sql.insert_declaration
-            args = (siren, year, modified_at, declared_at, declarant, data.raw, ft)
-        async with cls.pool.acquire() as conn:
+        async with cls.transaction() as conn:
+            declared_at = await conn.fetchval(
+                "SELECT declared_at FROM declaration "
+                "WHERE siren=$1 AND year=$2 FOR UPDATE",
+                siren,
+                year,
+            )
+            if not declared_at and not data.is_draft():
+                declared_at = modified_at
+            if declared_at:
+                data["déclaration"]["date"] = declared_at.isoformat()
+            if data.is_draft():
+                query = sql.insert_draft_declaration
+                args = (siren, year, modified_at, declarant, data.raw)
+            else:
+                query = sql.insert_declaration
+                args = (siren, year, modified_at, declared_at, declarant, data.raw, ft)
             await conn.execute(query, *args)
             if not data.is_draft():
                 await search.index(data)
@@ -151,7 +272,9 @@ class declaration(table):
         return [
             cls.metadata(r)
             for r in await cls.fetch(
-                "SELECT * FROM declaration WHERE siren = any($1::text[])", sirens
+                "SELECT * FROM declaration WHERE siren = any($1::text[]) "
+                "ORDER BY siren, year DESC",
+                sirens,
             )
         ]
 
@@ -165,6 +288,16 @@ class declaration(table):
             "name": record.data.company,
         }
 
+    @classmethod
+    @cache.cached
+    async def public_version(cls):
+        """Latest modification and count of the public déclarations.
+
+        Cached like the search results, so polling the public export does not scan
+        the table on every request.
+        """
+        return dict(await cls.fetchrow(sql.public_declarations_version))
+
     @classmethod
     def public_data(cls, data):
         data = models.Data(data)
@@ -193,7 +326,7 @@ class ownership(table):
     @classmethod
     async def put(cls, siren, email):
         email = email.lower()
-        async with cls.pool.acquire() as conn:
+        async with cls.acquire() as conn:
             created = await conn.fetchval(
                 "INSERT INTO ownership (siren, email) VALUES ($1, $2) "
                 "ON CONFLICT DO NOTHING RETURNING true",
@@ -205,7 +338,7 @@ class ownership(table):
 
     @classmethod
     async def delete(cls, siren, email):
-        async with cls.pool.acquire() as conn:
+        async with cls.acquire() as conn:
             deleted = await conn.fetchval(
                 "DELETE FROM ownership WHERE siren=$1 AND email=$2 RETURNING true",
                 siren,
@@ -237,7 +370,7 @@ class simulation(table):
         # Allow to force modified_at, eg. during migrations.
         if modified_at is None:
             modified_at = utils.utcnow()
-        async with cls.pool.acquire() as conn:
+        async with cls.acquire() as conn:
             await conn.execute(
                 "INSERT INTO simulation (id, modified_at, data) VALUES ($1, $2, $3) "
                 "ON CONFLICT (id) DO UPDATE SET modified_at = $2, data = $3",
@@ -258,15 +391,42 @@ class simulation(table):
 
 
 class search(table):
-    @classmethod
-    async def index(cls, data):
-        if not data.is_public():
-            return
-        ft = helpers.extract_ft(data)
-        siren = data.siren
-        year = data.year
-        region = data.path("entreprise.région")
-        departement = data.path("entreprise.département")
+    # Arbitrary key for the advisory lock taken during sync.
+    SYNC_LOCK = 2626
+    # Rows are timestamped before being committed, so always rescan a bit before
+    # the watermark to catch those committed after the previous sync.
+    SYNC_MARGIN = timedelta(minutes=1)
+    COLUMNS = (
+        "siren",
+        "year",
+        "declared_at",
+        "ft",
+        "region",
+        "departement",
+        "section_naf",
+        "note",
+        "names",
+    )
+    # Below this length, a prefix matches too many names to be of any help.
+    SUGGEST_MIN_LENGTH = 3
+    # Fields of a search result, with their SQL expression (see search.sql).
+    FIELDS = {
+        "entreprise": "results.entreprise",
+        "notes": "results.notes",
+        "notes_remunerations": "results.notes_remunerations",
+        "notes_augmentations": "results.notes_augmentations",
+        "notes_promotions": "results.notes_promotions",
+        "notes_augmentations_et_promotions": (
+            "results.notes_augmentations_et_promotions"
+        ),
+        "notes_conges_maternite": "results.notes_conges_maternite",
+        "notes_hautes_rémunérations": "results.notes_hautes_rémunérations",
+        "label": f"({sql.search_label})",
+    }
+
+    @staticmethod
+    def as_row(data):
+        """Compute the `search` row values of a declaration, in COLUMNS order."""
         code_naf = data.path("entreprise.code_naf")
         section_naf = None
         if code_naf:
@@ -274,48 +434,227 @@ class search(table):
                 section_naf = NAF[code_naf].section.code
             except KeyError:
                 pass
-        note = data.path("déclaration.index")
-        declared_at = datetime.fromisoformat(data.path("déclaration.date"))
-        async with cls.pool.acquire() as conn:
-            try:
-                await conn.execute(
-                    sql.index_declaration,
-                    siren,
-                    year,
-                    declared_at,
-                    ft,
-                    region,
-                    departement,
-                    section_naf,
-                    note,
+        return (
+            data.siren,
+            data.year,
+            datetime.fromisoformat(data.path("déclaration.date")),
+            helpers.extract_ft(data),
+            data.path("entreprise.région"),
+            data.path("entreprise.département"),
+            section_naf,
+            data.path("déclaration.index"),
+            " | ".join(utils.normalize(n) for n in helpers.extract_names(data)),
+        )
+
+    @classmethod
+    async def index(cls, data, touched=None):
+        """Index a declaration, and update the stats of its group(s).
+
+        When given a `touched` set, the stats are not updated, but the groups to
+        refresh are added to it instead.
+        """
+        if not data.is_public():
+            return
+        row = cls.as_row(data)
+        try:
+            # Nested in a unit of work, this is a savepoint, so a failure does not
+            # abort it.
+            async with cls.transaction() as conn:
+                previous = await conn.fetchrow(sql.search_group, data.siren, data.year)
+                await conn.execute(sql.index_declaration, *row)
+                # The declaration may have moved from one group to another.
+                current = (row[1], *row[4:8])
+                if touched is None:
+                    await stats.move(previous, current)
+                else:
+                    touched.update(
+                        stats.key(*group[:4]) for group in (previous, current) if group
+                    )
+        except PostgresError as err:
+            logger.error(f"Cannot index {data.siren}/{data.year}: {err}")
+        else:
+            cls.on_commit(cache.clear)
+
+    @classmethod
+    async def bulk_index(cls, records):
+        """Rebuild the whole index from an async iterable of declarations data.
+
+        Rows are computed in Python and streamed with COPY into a staging table,
+        which then replaces the index content in the same transaction: readers see
+        either the old or the new index, never an empty one.
+
+        Return the number of indexed rows.
+        """
+
+        async def rows():
+            async for data in records:
+                if data.is_public():
+                    yield cls.as_row(data)
+
+        async with cls.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(sql.create_search_staging)
+                await conn.copy_records_to_table(
+                    "search_staging", records=rows(), columns=cls.COLUMNS
                 )
-            except PostgresError as err:
-                logger.error(f"Cannot index {siren}/{year}: {err}")
+                await conn.execute("DELETE FROM search")
+                status = await conn.execute(sql.insert_search_from_staging)
+                await conn.execute(sql.refresh_stats)
+        cls.on_commit(cache.clear)
+        # Status is in the form "INSERT 0 1234".
+        return int(status.split()[-1])
 
     @classmethod
-    def as_json(cls, row, query):
+    async def sync(cls, since=None):
+        """Reindex declarations modified after `since`, or after the stored
+        watermark when `since` is None, then move the watermark forward.
+
+        Return the number of reindexed declarations, or None if there is no
+        watermark yet or if another process is already syncing.
+        """
+        async with cls.transaction() as conn:
+            locked = await conn.fetchval(
+                "SELECT pg_try_advisory_xact_lock($1)", cls.SYNC_LOCK
+            )
+            if not locked:
+                return None
+            stored = await watermark.get("search")
+            if since is None:
+                if stored is None:
+                    return None
+                since = stored - cls.SYNC_MARGIN
+            # An explicit `since` never moves the stored watermark backwards.
+            last = stored or since
+            count = 0
+            touched = set()
+            async for record in declaration.iter_modified(since):
+                await cls.index(record.data, touched)
+                last = max(last, record["modified_at"])
+                count += 1
+            # Each group once, in a stable order (see stats.move).
+            for group in sorted(touched):
+                await stats.refresh_group(*group)
+            await watermark.put("search", last)
+        return count
+
+    @staticmethod
+    def as_json(row):
         row = dict(row)
-        data = row.pop("data")[0]
-        return {
-            **declaration.public_data(data),
-            **dict(row),
-            "label": cls.compute_label(query, data),
-        }
+        for key in ("total", "last_declared_at", "siren"):
+            row.pop(key, None)
+        ues = (row.get("entreprise") or {}).get("ues")
+        if ues:
+            entreprise = row["entreprise"]
+            ues["entreprises"].insert(
+                0,
+                {
+                    "raison_sociale": entreprise["raison_sociale"],
+                    "siren": entreprise["siren"],
+                },
+            )
+        return row
 
     @classmethod
-    @lru_cache(maxsize=1024)
-    async def run(cls, query=None, limit=10, offset=0, **filters):
+    async def run(
+        cls, query=None, limit=10, offset=0, cursor=None, fields=None, **filters
+    ):
+        page = await cls.page(query, limit, offset, cursor, fields, **filters)
+        return page["data"]
+
+    @classmethod
+    @cache.cached
+    async def page(
+        cls, query=None, limit=10, offset=0, cursor=None, fields=None, **filters
+    ):
+        """Return a page of results along with the total count of companies.
+
+        `cursor` is the opaque `next` value of the previous page: unlike
+        `offset`, it costs the same whatever the depth of the page.
+
+        `fields` restricts each result to these FIELDS, which are then the only
+        ones computed and fetched from the DB.
+        """
         args = [limit, offset]
         args, where = cls.build_query(args, query, **filters)
-        rows = await cls.fetch(sql.search.format(where=where), *args)
-        return [cls.as_json(row, query) for row in rows]
+        after = ""
+        if cursor:
+            args.extend(cls.decode_cursor(cursor))
+            after = (
+                f"WHERE (last_declared_at, siren) < (${len(args) - 1}, ${len(args)})"
+            )
+        columns = []
+        for name in fields or cls.FIELDS:
+            try:
+                expression = cls.FIELDS[name]
+            except KeyError:
+                raise ValueError(f"Invalid field: {name}")
+            if name == "label":
+                # Match the names as they are indexed.
+                args.append(utils.normalize(query) if query else None)
+                expression = expression.format(query=f"${len(args)}")
+            columns.append(f"{expression} as {name}")
+        tpl = sql.search.format(where=where, after=after, fields=", ".join(columns))
+        rows = await cls.fetch(tpl, *args)
+        if rows:
+            count = rows[0]["total"]
+        elif offset or cursor:
+            # Out of range page, the window count is not available.
+            count = await cls.count(query, **filters)
+        else:
+            count = 0
+        page = {"data": [cls.as_json(row) for row in rows], "count": count}
+        if rows and len(rows) == limit:
+            last = rows[-1]
+            page["next"] = cls.encode_cursor(last["last_declared_at"], last["siren"])
+        return page
+
+    @staticmethod
+    def encode_cursor(declared_at, siren):
+        raw = json.dumps([declared_at.isoformat(), siren]).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            declared_at, siren = json.loads(raw)
+            declared_at = datetime.fromisoformat(declared_at)
+        except (ValueError, TypeError):
+            raise ValueError(f"Invalid cursor: {cursor}")
+        # Compared to timezone aware datetimes, see encode_cursor.
+        if declared_at.tzinfo is None:
+            raise ValueError(f"Invalid cursor: {cursor}")
+        return declared_at, str(siren)
 
     @classmethod
-    @lru_cache(maxsize=128)
+    @cache.cached(store="suggestions")
+    async def suggest(cls, query, limit=10):
+        """Companies whose names contain all the words of `query`, best matches
+        first, as {"siren", "raison_sociale"} dicts.
+
+        Matching is done on the trigram index of the normalized names, so it
+        never touches the declarations that do not match.
+        """
+        query = " ".join(utils.normalize(query or "").split())
+        if len(query) < cls.SUGGEST_MIN_LENGTH:
+            return []
+        args = [query, limit]
+        where = []
+        for token in query.split():
+            for char in ("\\", "%", "_"):
+                token = token.replace(char, "\\" + char)
+            args.append(f"%{token}%")
+            where.append(f"search.names LIKE ${len(args)}")
+        where = "WHERE " + " AND ".join(where)
+        rows = await cls.fetch(sql.search_suggest.format(where=where), *args)
+        return [dict(row) for row in rows]
+
+    @classmethod
+    @cache.cached
     async def stats(cls, year, **filters):
-        args = [year]
-        args, where = cls.build_query(args, **filters)
-        return await cls.fetchrow(sql.search_stats.format(where=where), *args)
+        """Aggregates of the notes of `year`, with `count` being the number of
+        companies having declared on any year, and `year_count` on this one."""
+        return {"count": await cls.count(**filters), **await stats.get(year, **filters)}
 
     @classmethod
     async def count(cls, query=None, **filters):
@@ -345,23 +684,11 @@ class search(table):
     async def truncate(cls):
         await cls.execute("TRUNCATE table search")
 
-    @classmethod
-    def compute_label(cls, query, data):
-        entreprise = data["entreprise"]
-        declarante = entreprise.get("raison_sociale")
-        ues = entreprise.get("ues", {})
-        nom_ues = ues.get("nom")
-        others = ues.get("entreprises")
-        if not nom_ues or not others or not query:
-            return declarante
-        others = [o["raison_sociale"] for o in others]
-        return helpers.compute_label(query, nom_ues, declarante, *others)
-
 
 class archive(table):
     @classmethod
     async def put(cls, siren, year, data, by=None, ip=None):
-        async with cls.pool.acquire() as conn:
+        async with cls.acquire() as conn:
             await conn.execute(sql.insert_archive, siren, year, data, by, ip)
 
     @classmethod
@@ -371,6 +698,241 @@ class archive(table):
         )
 
 
+class stats(table):
+    """Count and notes aggregates of the search table, per year × region ×
+    département × section NAF, kept up to date on each (re)indexation."""
+
+    @staticmethod
+    def key(year, region, departement, section_naf):
+        return (year, region or "", departement or "", section_naf or "")
+
+    @classmethod
+    async def lock(cls, *key):
+        """Lock the stats row of a group, creating it empty if needed, so two
+        transactions creating the same group are serialized too.
+
+        Return its (min, max), or None when it has just been created, hence must
+        be aggregated.
+        """
+        created = await cls.fetch(
+            "INSERT INTO stats (year, region, departement, section_naf, count, "
+            "notes, total) VALUES ($1, $2, $3, $4, 0, 0, 0) "
+            "ON CONFLICT DO NOTHING RETURNING year",
+            *key,
+        )
+        rows = await cls.fetch(
+            "SELECT min, max FROM stats WHERE year=$1 AND region=$2 "
+            "AND departement=$3 AND section_naf=$4 FOR UPDATE",
+            *key,
+        )
+        if created or not rows:
+            return None
+        return rows[0]["min"], rows[0]["max"]
+
+    @classmethod
+    async def refresh_group(cls, year, region, departement, section_naf):
+        key = cls.key(year, region, departement, section_naf)
+        # Aggregate only once the row is locked, so the statement snapshot sees
+        # the writes committed meanwhile.
+        await cls.lock(*key)
+        await cls.execute(sql.refresh_stats_group, *key)
+
+    @classmethod
+    async def move(cls, previous, current):
+        """Update the stats for a search row going from `previous` to `current`,
+        both (year, region, departement, section_naf, note), None when the row is
+        created or deleted.
+
+        Count and sum are adjusted from the notes. The group is only aggregated
+        again when a removed note was its min or max, or when it has no stats row
+        yet. Groups are locked (created if needed, see lock) in a stable order, so
+        concurrent writes do not deadlock.
+        """
+        if previous and current and tuple(previous) == tuple(current):
+            return
+        changes = defaultdict(lambda: ([], []))
+        if previous:
+            changes[cls.key(*previous[:4])][0].append(previous[4])
+        if current:
+            changes[cls.key(*current[:4])][1].append(current[4])
+        for key in sorted(changes):
+            removed, added = changes[key]
+            bounds = await cls.lock(*key)
+            if bounds is None or any(n is not None and n in bounds for n in removed):
+                await cls.execute(sql.refresh_stats_group, *key)
+                continue
+            removed = [n for n in removed if n is not None]
+            added_notes = [n for n in added if n is not None]
+            await cls.execute(
+                sql.update_stats_group,
+                *key,
+                len(added) - len(changes[key][0]),
+                len(added_notes) - len(removed),
+                sum(added_notes) - sum(removed),
+                min(added_notes, default=None),
+                max(added_notes, default=None),
+            )
+
+    @classmethod
+    async def refresh(cls):
+        await cls.execute(sql.refresh_stats)
+
+    @classmethod
+    async def get(cls, year, **filters):
+        args = [year]
+        where = ["year=$1"]
+        for name, value in filters.items():
+            if value is not None:
+                args.append(value)
+                where.append(f"{name}=${len(args)}")
+        where = "WHERE " + " AND ".join(where)
+        return dict(await cls.fetchrow(sql.search_stats.format(where=where), *args))
+
+
+class entreprise(table):
+    """Company metadata from the external APIs, cached with its fetch time.
+
+    An unknown or closed company is cached with `data` NULL and the `error`.
+    """
+
+    @classmethod
+    async def get(cls, siren):
+        try:
+            return await cls.fetchrow(
+                "SELECT data, error, fetched_at FROM entreprise WHERE siren=$1", siren
+            )
+        except NoData:
+            return None
+
+    @classmethod
+    async def put(cls, siren, data=None, error=None):
+        await cls.execute(
+            "INSERT INTO entreprise (siren, data, error, fetched_at) "
+            "VALUES ($1, $2, $3, NOW()) ON CONFLICT (siren) DO UPDATE "
+            "SET data=$2, error=$3, fetched_at=NOW()",
+            siren,
+            data,
+            error,
+        )
+
+    @classmethod
+    async def delete(cls, siren):
+        await cls.execute("DELETE FROM entreprise WHERE siren=$1", siren)
+
+    @classmethod
+    async def stats(cls):
+        return dict(
+            await cls.fetchrow(
+                "SELECT COUNT(*) AS total, COUNT(error) AS negative, "
+                "MIN(fetched_at) AS oldest FROM entreprise"
+            )
+        )
+
+
+class outbox(table):
+    """Emails waiting to be sent. An email is deleted once sent, and kept with a
+    NULL `next_attempt_at` once we gave up retrying."""
+
+    @classmethod
+    async def put(cls, message):
+        await cls.execute("INSERT INTO outbox (message) VALUES ($1)", message)
+
+    @classmethod
+    async def claim(cls, limit, lease):
+        """Lease the emails to send now: they are not due anymore for `lease`
+        seconds, so other workers skip them while they are being sent, and they
+        are sent again should this worker die meanwhile.
+
+        Return them in due order, along with their former `due_at`, see release.
+        """
+        rows = await cls.fetch(
+            "UPDATE outbox SET next_attempt_at=NOW() + make_interval(secs => $2) "
+            "FROM (SELECT id, next_attempt_at FROM outbox WHERE next_attempt_at <= NOW() "
+            "ORDER BY next_attempt_at LIMIT $1 FOR UPDATE SKIP LOCKED) AS due "
+            "WHERE outbox.id=due.id "
+            "RETURNING outbox.id, message, attempts, due.next_attempt_at AS due_at",
+            limit,
+            lease,
+        )
+        return sorted(rows, key=lambda row: (row["due_at"], row["id"]))
+
+    @classmethod
+    async def release(cls, rows):
+        """Give back claimed emails, unsent, as they were before being claimed."""
+        if not rows:
+            return
+        await cls.execute(
+            "UPDATE outbox SET next_attempt_at=due.at "
+            "FROM unnest($1::int[], $2::timestamptz[]) AS due(id, at) "
+            "WHERE outbox.id=due.id",
+            [row["id"] for row in rows],
+            [row["due_at"] for row in rows],
+        )
+
+    @classmethod
+    async def done(cls, id):
+        await cls.execute("DELETE FROM outbox WHERE id=$1", id)
+
+    @classmethod
+    async def retry(cls, id, attempts, next_attempt_at, error):
+        await cls.execute(
+            "UPDATE outbox SET attempts=$2, next_attempt_at=$3, error=$4 WHERE id=$1",
+            id,
+            attempts,
+            next_attempt_at,
+            error,
+        )
+
+    @classmethod
+    async def stats(cls):
+        return dict(
+            await cls.fetchrow(
+                "SELECT COUNT(next_attempt_at) AS pending, "
+                "COUNT(*) - COUNT(next_attempt_at) AS abandoned FROM outbox"
+            )
+        )
+
+
+class watermark(table):
+    @classmethod
+    async def get(cls, name):
+        try:
+            return await cls.fetchval("SELECT at FROM watermark WHERE name=$1", name)
+        except NoData:
+            return None
+
+    @classmethod
+    async def put(cls, name, at):
+        await cls.execute(
+            "INSERT INTO watermark (name, at) VALUES ($1, $2) "
+            "ON CONFLICT (name) DO UPDATE SET at = $2",
+            name,
+            at,
+        )
+
+
+class tombstone(table):
+    """Deleted declarations, for the delta exports."""
+
+    @classmethod
+    async def put(cls, siren, year):
+        await cls.execute(
+            "INSERT INTO tombstone (siren, year) VALUES ($1, $2) "
+            "ON CONFLICT (siren, year) DO UPDATE SET deleted_at = NOW()",
+            siren,
+            int(year),
+        )
+
+    @classmethod
+    async def iter_since(cls, since, prefetch=None):
+        query = (
+            "SELECT siren, year, deleted_at FROM tombstone "
+            "WHERE deleted_at > $1 ORDER BY deleted_at"
+        )
+        async for record in cls.cursor(query, since, prefetch=prefetch):
+            yield record
+
+
 async def set_type_codecs(conn):
     await conn.set_type_codec(
         "jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
@@ -1,7 +1,11 @@
 """DGT specific utils"""
 
+import asyncio
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
+from functools import lru_cache
 
 import arrow
 from naf import DB as NAF
@@ -9,9 +13,9 @@ from openpyxl import Workbook
 from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 from progressist import ProgressBar
 
-from egapro import config, constants, db, models
+from egapro import config, constants, db, models, xlsx
 from egapro.schema import SCHEMA
-from egapro.utils import flatten, remove_one_year
+from egapro.utils import remove_one_year
 
 
 AGES = {
@@ -23,6 +27,10 @@ AGES = {
 EFFECTIF = {"50:250": "50 à 250", "251:999": "251 à 999", "1000:": "1000 et plus"}
 
 
+def identity(val):
+    return val
+
+
 def truthy(val):
     return False if val is False else True
 
@@ -51,17 +59,21 @@ def value_or_nc(value):
     return value if value is not None else "nc"
 
 
-async def get_headers_columns():
-    """Return a tuple of lists of (header_names, column_names) that we want in the export."""
+async def get_num_coefficient():
     try:
-        num_coefficient = await db.declaration.fetchval(
-            "SELECT "
-            "jsonb_array_length(data->'indicateurs'->'rémunérations'->'catégories') AS length "
-            "FROM declaration WHERE data->'indicateurs'->'rémunérations' ? 'catégories' "
-            "ORDER BY length DESC LIMIT 1;"
-        )
+        return await db.declaration.fetchval("SELECT MAX(categories) FROM declaration")
     except db.NoData:
-        num_coefficient = 0
+        return 0
+
+
+async def get_headers_columns():
+    """Return a tuple of lists of (header_names, column_names) that we want in the export."""
+    return headers_columns(await get_num_coefficient())
+
+
+@lru_cache()
+def headers_columns(num_coefficient):
+    """Same as `get_headers_columns`, for a known number of coefficients."""
     interesting_cols = (
         [
             ("source", "source"),
@@ -121,7 +133,7 @@ async def get_headers_columns():
         + [
             (
                 f"Indic1_Niv{index_coef}",
-                f"indicateurs.rémunérations.catégories.{index_coef}",
+                f"indicateurs.rémunérations.Indic1_Niv{index_coef}",
             )
             for index_coef in range(num_coefficient)
         ]
@@ -258,10 +270,55 @@ async def get_headers_columns():
     columns = []
     for header, column, *fmt in interesting_cols:
         headers.append(header)
-        columns.append((column, fmt[0] if fmt else lambda x: x))
+        columns.append((column, fmt[0] if fmt else identity))
     return (headers, columns)
 
 
+@lru_cache()
+def compiled_row(num_coefficient):
+    _, columns = headers_columns(num_coefficient)
+    return compile_row(columns)
+
+
+def compile_row(columns):
+    """Generate a function building an export row from a prepared record.
+
+    Each (path, fmt) column gets the same value as
+    `fmt(flatten(record, flatten_lists=True).get(path))`, but only the needed
+    values are read, and common path prefixes are walked once per record.
+    Keys in the record must not contain dots.
+    """
+    namespace = {"clean_cell": clean_cell}
+    lines = ["def row(node):"]
+    names = {(): "node"}
+    cells = []
+    for idx, (path, fmt) in enumerate(columns):
+        parts = tuple(path.split("."))
+        for depth in range(1, len(parts) + 1):
+            if parts[:depth] in names:
+                continue
+            parent = names[parts[: depth - 1]]
+            key = parts[depth - 1]
+            expr = f"{parent}.get({key!r}) if isinstance({parent}, dict) else "
+            if key.isdigit():
+                pos = int(key)
+                expr += f"{parent}[{pos}] if type({parent}) is list "
+                expr += f"and len({parent}) > {pos} else "
+            name = f"n{len(names)}"
+            lines.append(f"    {name} = {expr}None")
+            names[parts[:depth]] = name
+        # flatten only outputs scalars.
+        name = names[parts]
+        value = f"(None if isinstance({name}, (dict, list)) else {name})"
+        if fmt is not identity:
+            namespace[f"fmt{idx}"] = fmt
+            value = f"fmt{idx}{value}"
+        cells.append(f"clean_cell({value})")
+    lines.append(f"    return [{', '.join(cells)}]")
+    exec("\n".join(lines), namespace)
+    return namespace["row"]
+
+
 WHITE_SPACES = re.compile(r"\s+")
 
 
@@ -271,23 +328,46 @@ def clean_cell(value):
     return value
 
 
-async def as_xlsx(max_rows=None, debug=False):
+async def as_xlsx(max_rows=None, debug=False, workers=None, since=None):
     """Export des données au format souhaité par la DGT.
 
     :max_rows:          Max number of rows to process.
     :debug:             Turn on debug to be able to read the generated Workbook
+    :workers:           Number of processes preparing the rows.
+    :since:             Only the declarations modified after this datetime.
     """
-    print("Reading from DB")
-    records = await db.declaration.completed()
-    print("Flattening JSON")
-    if max_rows:
-        records = records[:max_rows]
     wb = Workbook(write_only=not debug)
-    ws = wb.create_sheet()
-    ws.title = "BDD REPONDANTS"
-    wb.active = ws
-    ws_ues = wb.create_sheet()
-    ws_ues.title = "BDD UES détail entreprises"
+    if debug:
+        # Remove default sheet, so the first one we create is the active one.
+        wb.remove(wb.active)
+    await fill(wb, max_rows, workers, since)
+    return wb
+
+
+async def dump_xlsx(out, max_rows=None, workers=None, since=None):
+    """Stream the DGT export to the `out` file object, in constant memory.
+
+    :out:               Writable file object, does not need to be seekable.
+    :max_rows:          Max number of rows to process.
+    :workers:           Number of processes preparing the rows.
+    :since:             Only the declarations modified after this datetime, and
+                        the deleted ones in a "Suppressions" sheet.
+    """
+    with xlsx.Workbook(out) as wb:
+        await fill(wb, max_rows, workers, since)
+
+
+async def fill(wb, max_rows=None, workers=None, since=None):
+    """Write the declarations in `wb` sheets as they are read from the DB.
+
+    Rows are prepared by chunks in a pool of processes, and written in order.
+    """
+    workers = config.DGT_WORKERS if workers is None else workers
+    total = await db.declaration.count_completed(since)
+    if max_rows:
+        total = min(total, max_rows)
+    ws = wb.create_sheet("BDD REPONDANTS")
+    ws_ues = wb.create_sheet("BDD UES détail entreprises")
     ws_ues.append(
         [
             "Annee_indicateurs",
@@ -304,25 +384,80 @@ async def as_xlsx(max_rows=None, debug=False):
             "Siren",
         ]
     )
-    headers, columns = await get_headers_columns()
+    num_coefficient = await get_num_coefficient()
+    headers, _ = headers_columns(num_coefficient)
     ws.append(headers)
-    bar = ProgressBar(prefix="Computing", total=len(records))
-    for record in bar.iter(records):
-        data = record.data
-        if not data:
-            continue
-        ues_data(ws_ues, data)
+    bar = ProgressBar(prefix="Computing", total=total)
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(workers) if workers else None
+    # Bound the number of chunks in flight, to keep memory constant.
+    pending = deque()
+
+    def write(rows, ues_rows):
+        for row in ues_rows:
+            ws_ues.append(row)
+        for row in rows:
+            ws.append(row)
+
+    async def submit(chunk):
+        if not pool:
+            write(*prepare_rows(chunk, num_coefficient))
+            return
+        if len(pending) >= workers * 2:
+            write(*await pending.popleft())
+        pending.append(loop.run_in_executor(pool, prepare_rows, chunk, num_coefficient))
+
+    if since is None:
+        records = db.declaration.iter_completed(limit=max_rows)
+    else:
+        records = db.declaration.iter_modified(since, limit=max_rows)
+    chunk = []
+    try:
+        async for record in records:
+            bar.update()
+            if not record["data"]:
+                continue
+            chunk.append((record["data"], record["modified_at"]))
+            if len(chunk) >= config.DGT_CHUNK:
+                await submit(chunk)
+                chunk = []
+        if chunk:
+            await submit(chunk)
+        while pending:
+            write(*await pending.popleft())
+        if since is not None:
+            ws_deleted = wb.create_sheet("Suppressions")
+            ws_deleted.append(["Siren", "Annee_indicateurs", "Date_suppression"])
+            async for record in db.tombstone.iter_since(since):
+                ws_deleted.append(
+                    [record["siren"], record["year"], isodatetime(record["deleted_at"])]
+                )
+    finally:
+        if pool:
+            pool.shutdown()
+
+
+def prepare_rows(chunk, num_coefficient):
+    """Turn a chunk of (data, modified_at) into rows for both sheets.
+
+    Pure CPU work, run in the worker processes.
+    """
+    row = compiled_row(num_coefficient)
+    rows = []
+    ues_rows = []
+    for data, modified_at in chunk:
+        data = models.Data(data)
+        ues_rows.extend(ues_data(data))
         data = prepare_record(data)
-        data["modified_at"] = record["modified_at"]
-        ws.append([clean_cell(fmt(data.get(c))) for c, fmt in columns])
-    return wb
+        data["modified_at"] = modified_at
+        rows.append(row(data))
+    return rows, ues_rows
 
 
-def ues_data(sheet, data):
-    data = models.Data(data)
+def ues_data(data):
     entreprises = data.path("entreprise.ues.entreprises")
     if not entreprises:
-        return
+        return []
     region = constants.REGIONS.get(data.path("entreprise.région"))
     departement = constants.DEPARTEMENTS.get(data.path("entreprise.département"))
     adresse = data.path("entreprise.adresse")
@@ -363,13 +498,12 @@ def ues_data(sheet, data):
                 ues["siren"],
             ]
         )
-    for row in rows:
-        sheet.append(clean_cell(cell) for cell in row)
+    return [[clean_cell(cell) for cell in row] for row in rows]
 
 
 def prepare_record(data):
 
-    # Before flattening.
+    # Computed values, read by the compiled row.
     data["URL_declaration"] = f"'{config.DOMAIN}{data.uri}"
     effectif = data["entreprise"]["effectif"]["tranche"]
     prepare_entreprise(data["entreprise"])
@@ -392,7 +526,7 @@ def prepare_record(data):
             prepare_augmentations(data["indicateurs"]["augmentations"])
             prepare_promotions(data["indicateurs"]["promotions"])
 
-    return flatten(data, flatten_lists=True)
+    return data
 
 
 def prepare_entreprise(data):
@@ -426,7 +560,7 @@ def prepare_remunerations(data):
         csp_names = ["Ouv", "Emp", "TAM", "IC"]
         for idx, category in enumerate(indic1_categories):
             tranches = category.get("tranches", {})
-            key = f"catégories.{idx}"
+            key = f"Indic1_Niv{idx}"
             if indic1_mode == "csp":
                 key = f"Indic1_{csp_names[idx]}"
             values = [
@@ -1,16 +1,20 @@
+import asyncio
 import importlib
 import mimetypes
-import smtplib
-import ssl
+import os
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from email.message import EmailMessage
 from pathlib import Path
 
 import yaml
 from jinja2 import Template, TemplateError, Undefined
 
-from .. import config
+from .. import config, pdf
 from ..loggers import logger
+from . import outbox
 
 
 ACCESS_GRANTED = """Bonjour,
@@ -31,7 +35,7 @@ class SilentUndefined(Undefined):
         return None
 
 
-def send(to, subject, txt, html=None, reply_to=None, attachment=None):
+def build(to, subject, txt, html=None, reply_to=None, attachment=None):
     msg = EmailMessage()
     msg["From"] = config.FROM_EMAIL
     msg["To"] = to
@@ -48,22 +52,80 @@ def send(to, subject, txt, html=None, reply_to=None, attachment=None):
         ctype, encoding = mimetypes.guess_type(filename)
         maintype, subtype = ctype.split("/", 1)
         msg.add_attachment(blob, maintype=maintype, subtype=subtype, filename=filename)
+    return msg
+
+
+async def send(to, subject, txt, html=None, reply_to=None, attachment=None):
+    """Build the message and queue it in the outbox, see `emails.outbox`."""
+    msg = build(to, subject, txt, html, reply_to=reply_to, attachment=attachment)
     if not config.SEND_EMAILS:
         print("Sending email", str(msg))
         print("email txt:", txt)
         return
-    context = ssl.create_default_context()
-    with smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT) as server:
-        if config.SMTP_SSL:
-            server.starttls(context=context)
+    await outbox.put(msg.as_bytes())
+    logger.debug(f"Email queued for {to}: {subject}")
+
+
+def render(name, to, context):
+    """Build the `name` email message as bytes, eg. in a worker process."""
+    subject, txt, html, reply_to, attachment = globals()[name].prepare(**context)
+    return build(to, subject, txt, html, reply_to, attachment).as_bytes()
+
+
+async def send_many(name, items, checkpoint=None, workers=None):
+    """Queue the `name` email for each `(key, to, context)` of `items`, and send
+    the queue meanwhile.
+
+    Messages (and their PDF, if any) are rendered in a pool of `workers` processes.
+    Keys listed in the `checkpoint` file are skipped, and each queued key is
+    appended to it, so an interrupted run can be resumed.
+    Return the number of queued emails.
+    """
+    done = set()
+    if checkpoint and checkpoint.exists():
+        done = set(checkpoint.read_text().split())
+    workers = workers or os.cpu_count()
+    loop = asyncio.get_running_loop()
+    # Bounded number of messages in flight, see bin.receipts.
+    pending = deque()
+    queued = 0
+    flushing = None
+
+    async def queue_next():
+        nonlocal queued, flushing
+        key, to, future = pending.popleft()
         try:
-            if config.SMTP_LOGIN:
-                server.login(config.SMTP_LOGIN, config.SMTP_PASSWORD)
-            server.send_message(msg)
-        except smtplib.SMTPException as err:
-            raise RuntimeError from err
+            message = await future
+        except Exception as err:
+            logger.error(f"Cannot render {name} email for {key}: {err}")
+            return
+        if not config.SEND_EMAILS:
+            print(f"Sending {name} email to {to} ({key})")
         else:
-            logger.debug(f"Email sent to {to}: {subject}")
+            await outbox.put(message)
+        if log:
+            log.write(f"{key}\n")
+            log.flush()
+        queued += 1
+        if config.SEND_EMAILS and (flushing is None or flushing.done()):
+            flushing = asyncio.ensure_future(outbox.flush())
+
+    with ProcessPoolExecutor(workers) as pool, ExitStack() as stack:
+        log = stack.enter_context(checkpoint.open("a")) if checkpoint else None
+        for key, to, context in items:
+            if key in done:
+                continue
+            future = loop.run_in_executor(pool, render, name, to, context)
+            pending.append((key, to, future))
+            if len(pending) >= workers * 2:
+                await queue_next()
+        while pending:
+            await queue_next()
+    if flushing:
+        await flushing
+        # Send what was queued while the last flush was running.
+        await outbox.flush()
+    return queued
 
 
 class Email:
@@ -73,13 +135,23 @@ class Email:
         self.html = self.load(html)
         self.attachment = attachment
 
-    def send(self, to, **context):
+    def prepare(self, attach=True, **context):
+        """Return the subject, bodies, reply-to and attachment (if `attach`) of
+        the message."""
         txt, html, subject = self(**context)
         reply_to = REPLY_TO.get(context.get("departement"))
         attachment = None
-        if self.attachment:
+        if attach and self.attachment:
             attachment = self.attachment(context)
-        send(to, subject, txt, html, reply_to=reply_to, attachment=attachment)
+        return subject, txt, html, reply_to, attachment
+
+    async def send(self, to, **context):
+        subject, txt, html, reply_to, _ = self.prepare(attach=False, **context)
+        attachment = None
+        if self.attachment:
+            # Rendered out of the event loop, and cached.
+            attachment = await pdf.render(self.attachment, context)
+        await send(to, subject, txt, html, reply_to=reply_to, attachment=attachment)
 
     def __call__(self, **context):
         return (
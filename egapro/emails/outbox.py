@@ -0,0 +1,153 @@
+"""Durable emails queue.
+
+Views only queue the messages, a worker sends them through a single SMTP
+connection, out of the event loop, and retries with an exponential backoff.
+"""
+
+import asyncio
+import email
+import smtplib
+import ssl
+from collections import Counter
+from datetime import timedelta
+from email import policy
+
+from .. import config, db, utils
+from ..loggers import logger
+
+# Counters for this process.
+STATS = Counter(queued=0, sent=0, retried=0, abandoned=0)
+# Set by the worker, to be woken up as soon as an email is queued.
+WAKEUP = None
+# Refused by the server for this very message: the next ones may still be sent.
+MESSAGE_ERRORS = (
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPDataError,
+)
+
+
+async def put(message):
+    await db.outbox.put(message)
+    STATS["queued"] += 1
+    if WAKEUP is not None:
+        WAKEUP.set()
+
+
+class Session:
+    """An SMTP connection, opened on first use and reused until closed."""
+
+    def __init__(self):
+        self.server = None
+
+    def connect(self):
+        server = smtplib.SMTP(
+            config.SMTP_HOST, config.SMTP_PORT, timeout=config.SMTP_TIMEOUT
+        )
+        if config.SMTP_SSL:
+            server.starttls(context=ssl.create_default_context())
+        if config.SMTP_LOGIN:
+            server.login(config.SMTP_LOGIN, config.SMTP_PASSWORD)
+        return server
+
+    def send_message(self, msg):
+        if self.server is None:
+            self.server = self.connect()
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Connection timed out by the server since last use, retry once.
+            self.server = self.connect()
+            self.server.send_message(msg)
+
+    def quit(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except smtplib.SMTPException:
+                pass
+            self.server = None
+
+    async def send(self, message):
+        msg = email.message_from_bytes(message, policy=policy.default)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.send_message, msg)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.quit)
+
+
+async def flush():
+    """Send all the due emails, batch by batch, and return how many were sent.
+
+    Each batch of OUTBOX_BATCH emails is claimed in a single statement, then sent
+    through a single SMTP session out of any transaction, each email being deleted
+    as soon as it is sent. On a connection error, the rest of the batch is
+    released untouched and the flush stops: the next one will try again.
+    """
+    # Long enough for a whole batch of slow sends: never claimed twice.
+    lease = max(config.OUTBOX_LEASE, 2 * config.OUTBOX_BATCH * config.SMTP_TIMEOUT)
+    sent = 0
+    while True:
+        rows = await db.outbox.claim(config.OUTBOX_BATCH, lease)
+        if not rows:
+            break
+        handled = 0
+        session = Session()
+        try:
+            for row in rows:
+                try:
+                    await session.send(row["message"])
+                except MESSAGE_ERRORS as err:
+                    await retry(row, err)
+                except (smtplib.SMTPException, OSError) as err:
+                    # The next emails would fail the same way.
+                    await retry(row, err)
+                    handled += 1
+                    return sent
+                else:
+                    await db.outbox.done(row["id"])
+                    STATS["sent"] += 1
+                    sent += 1
+                handled += 1
+        finally:
+            await session.close()
+            await db.outbox.release(rows[handled:])
+    return sent
+
+
+async def retry(row, err):
+    attempts = row["attempts"] + 1
+    if attempts >= config.OUTBOX_MAX_ATTEMPTS:
+        logger.error(f"Giving up sending email {row['id']}: {err}")
+        next_attempt_at = None
+        STATS["abandoned"] += 1
+    else:
+        logger.warning(f"Cannot send email {row['id']} (attempt {attempts}): {err}")
+        delay = config.OUTBOX_BACKOFF * 2 ** (attempts - 1)
+        next_attempt_at = utils.utcnow() + timedelta(seconds=delay)
+        STATS["retried"] += 1
+    await db.outbox.retry(row["id"], attempts, next_attempt_at, str(err))
+
+
+async def worker():
+    global WAKEUP
+    WAKEUP = asyncio.Event()
+    while True:
+        try:
+            count = await flush()
+        except Exception as err:
+            logger.error(f"Cannot flush emails outbox: {err}")
+        else:
+            if count:
+                logger.info(f"Sent {count} emails")
+        try:
+            await asyncio.wait_for(WAKEUP.wait(), config.OUTBOX_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        WAKEUP.clear()
+
+
+async def stats():
+    return {**STATS, **await db.outbox.stats()}
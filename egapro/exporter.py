@@ -1,11 +1,25 @@
 """Export data from DB."""
 
+import asyncio
 import csv
+import io
+import os
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import ujson as json
 
-from egapro import constants, db, sql, utils
+from egapro import config, constants, db, models, sql, utils
+
+# Number of declarations per Parquet row group.
+ROW_GROUP_SIZE = 50_000
+# Only one coroutine per process generates a given public snapshot.
+SNAPSHOT_LOCKS = defaultdict(asyncio.Lock)
+# Rows are timestamped before being committed, so always export a bit before
+# the watermark: replaying a change twice is harmless.
+DELTA_MARGIN = timedelta(minutes=1)
 
 
 async def dump(path: Path):
@@ -14,36 +28,39 @@ async def dump(path: Path):
     :path:          chemin vers le fichier d'export
     """
 
-    records = await db.declaration.completed()
-    print("Number of records", len(records))
+    count = 0
     with path.open("w") as f:
-        json.dump([r["data"] for r in records], f, ensure_ascii=False)
+        f.write("[")
+        async for record in db.declaration.iter_completed():
+            if count:
+                f.write(",")
+            f.write(json.dumps(record["data"], ensure_ascii=False))
+            count += 1
+        f.write("]")
+    print("Number of records", count)
 
 
-async def public_data(path: Path):
-    """Export des données Egapro publiques au format CSV.
+PUBLIC_HEADERS = [
+    "Raison Sociale",
+    "SIREN",
+    "Année",
+    "Note",
+    "Structure",
+    "Nom UES",
+    "Entreprises UES (SIREN)",
+    "Région",
+    "Département",
+    "Pays",
+]
 
-    :path:          chemin vers le fichier d'export
-    """
 
-    records = await db.declaration.fetch(sql.public_declarations)
-    writer = csv.writer(path, delimiter=";")
-    writer.writerow(
-        [
-            "Raison Sociale",
-            "SIREN",
-            "Année",
-            "Note",
-            "Structure",
-            "Nom UES",
-            "Entreprises UES (SIREN)",
-            "Région",
-            "Département",
-            "Pays",
-        ]
-    )
-    rows = []
-    for record in records:
+async def public_rows(since=None):
+    """Iterate over the public déclarations, as rows matching PUBLIC_HEADERS, only
+    the ones modified after `since` if given."""
+    query, args = sql.public_declarations, []
+    if since is not None:
+        query, args = f"{query} WHERE declaration.modified_at > $1", [since]
+    async for record in db.declaration.cursor(query, *args):
         data = record.data
         ues = ",".join(
             [
@@ -51,32 +68,199 @@ async def public_data(path: Path):
                 for company in data.path("entreprise.ues.entreprises") or []
             ]
         )
-        rows.append(
-            [
-                data.company,
-                data.siren,
-                data.year,
-                data.grade,
-                data.structure,
-                data.ues,
-                ues,
-                constants.REGIONS.get(data.region),
-                constants.DEPARTEMENTS.get(data.departement),
-                constants.PAYS_ISO_TO_LIB.get(
-                    data.path("entreprise.code_pays"), "FRANCE"
-                ),
-            ]
+        yield [
+            data.company,
+            data.siren,
+            data.year,
+            data.grade,
+            data.structure,
+            data.ues,
+            ues,
+            constants.REGIONS.get(data.region),
+            constants.DEPARTEMENTS.get(data.departement),
+            constants.PAYS_ISO_TO_LIB.get(data.path("entreprise.code_pays"), "FRANCE"),
+        ]
+
+
+async def public_data(path: Path, since=None):
+    """Export des données Egapro publiques au format CSV.
+
+    :path:          chemin vers le fichier d'export
+    :since:         n'exporter que les déclarations modifiées depuis cette date
+    """
+
+    writer = csv.writer(path, delimiter=";")
+    writer.writerow(PUBLIC_HEADERS)
+    async for row in public_rows(since):
+        writer.writerow(row)
+
+
+async def tombstones(dest, since):
+    """Export the déclarations deleted after `since`, as CSV, to go along with
+    the delta CSV exports. Return their number."""
+    writer = csv.writer(dest, delimiter=";")
+    writer.writerow(["siren", "year", "deleted_at"])
+    count = 0
+    async for record in db.tombstone.iter_since(since):
+        writer.writerow(
+            [record["siren"], record["year"], record["deleted_at"].isoformat()]
         )
-    writer.writerows(rows)
+        count += 1
+    return count
+
+
+async def public_chunks(format="csv", compress=False, chunk_size=64 * 1024):
+    """Iterate over the public export as bytes, to be streamed over HTTP.
+
+    :format:        "csv" or "jsonl"
+    :compress:      gzip the output
+    :chunk_size:    size of the uncompressed chunks
+    """
+    buffer = io.StringIO()
+    # 16 + MAX_WBITS means a gzip container.
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+
+    def flush(final=False):
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        if compressor:
+            data = compressor.compress(data)
+            if final:
+                data += compressor.flush()
+        return data
+
+    if format == "csv":
+        writer = csv.writer(buffer, delimiter=";")
+        writer.writerow(PUBLIC_HEADERS)
+    async for row in public_rows():
+        if format == "csv":
+            writer.writerow(row)
+        else:
+            buffer.write(utils.json_dumps(dict(zip(PUBLIC_HEADERS, row))) + "\n")
+        if buffer.tell() >= chunk_size:
+            data = flush()
+            # An empty chunk would end the chunked response.
+            if data:
+                yield data
+    data = flush(final=True)
+    if data:
+        yield data
+
+
+async def public_snapshot(format, version):
+    """Open the gzipped public export in `format` for this `version` of the data,
+    generating it first if needed.
+
+    Snapshots are files shared by the workers, so downloads do not hold a DB
+    connection for as long as the client takes to read them. Older snapshots
+    are removed once a new one is written.
+    """
+    root = Path(f"{config.CACHE_PATH}-export")
+    path = root / f"public-{version}.{format}.gz"
+    async with SNAPSHOT_LOCKS[path]:
+        if not path.exists():
+            root.mkdir(mode=0o700, parents=True, exist_ok=True)
+            # Write then rename, so concurrent readers never see a partial file.
+            tmp = path.with_suffix(f".{os.getpid()}")
+            try:
+                with tmp.open("wb") as f:
+                    async for chunk in public_chunks(format, compress=True):
+                        f.write(chunk)
+                tmp.replace(path)
+            finally:
+                tmp.unlink(missing_ok=True)
+            for old in root.glob(f"public-*.{format}.gz"):
+                if old != path:
+                    old.unlink(missing_ok=True)
+        # Opened right away: a later unlink does not affect the open file.
+        f = path.open("rb")
+    SNAPSHOT_LOCKS.pop(path, None)
+    return f
+
+
+async def file_chunks(f, decompress=False, chunk_size=64 * 1024):
+    """Iterate over the content of the gzipped file `f`, as is or decompressed,
+    then close it."""
+    loop = asyncio.get_running_loop()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if decompress else None
+    try:
+        while True:
+            data = await loop.run_in_executor(None, f.read, chunk_size)
+            if not data:
+                break
+            if decompressor:
+                data = decompressor.decompress(data)
+            # An empty chunk would end the chunked response.
+            if data:
+                yield data
+        if decompressor:
+            data = decompressor.flush()
+            if data:
+                yield data
+    finally:
+        f.close()
 
 
 async def full(dest):
-    records = await db.declaration.completed()
-    for record in records:
+    async for record in db.declaration.iter_completed():
         dest.write(utils.json_dumps(record["data"]) + "\n")
 
 
-async def indexes(path: Path):
+async def delta(dest, since):
+    """Export the changes made after `since`, one JSON object per line.
+
+    Modified déclarations are written as {"modified_at": …, "data": …} and
+    deleted ones as tombstones: {"deleted_at": …, "siren": …, "year": …}.
+    Return the number of changes.
+    """
+    count = 0
+    async for record in db.declaration.iter_modified(since):
+        change = {"modified_at": record["modified_at"], "data": record["data"]}
+        dest.write(utils.json_dumps(change) + "\n")
+        count += 1
+    async for record in db.tombstone.iter_since(since):
+        dest.write(utils.json_dumps(dict(record)) + "\n")
+        count += 1
+    return count
+
+
+def compact(snapshot: Path, deltas, dest):
+    """Apply `deltas` files on a `full` export, writing a new full export.
+
+    Only the changes are loaded in memory, the snapshot is streamed. The most
+    recent change of a déclaration wins. Return the number of déclarations.
+    """
+    changes = {}
+    for path in deltas:
+        with Path(path).open() as f:
+            for line in f:
+                change = json.loads(line)
+                if "data" in change:
+                    data = models.Data(change["data"])
+                    key = (data.siren, data.year)
+                    at = change["modified_at"]
+                else:
+                    key = (change["siren"], change["year"])
+                    at = change["deleted_at"]
+                at = datetime.fromisoformat(at)
+                if key not in changes or changes[key][0] <= at:
+                    changes[key] = (at, change.get("data"))
+    count = 0
+    with snapshot.open() as f:
+        for line in f:
+            data = models.Data(json.loads(line))
+            if (data.siren, data.year) not in changes:
+                dest.write(line)
+                count += 1
+    for _, data in changes.values():
+        if data is not None:
+            dest.write(utils.json_dumps(data) + "\n")
+            count += 1
+    return count
+
+
+async def indexes(path: Path, since=None):
     writer = csv.writer(path, delimiter=";")
     writer.writerow(
         [
@@ -85,15 +269,69 @@ async def indexes(path: Path):
             "index",
         ]
     )
-    rows = []
-    records = await db.declaration.completed()
-    for record in records:
+    if since is None:
+        records = db.declaration.iter_completed()
+    else:
+        records = db.declaration.iter_modified(since)
+    async for record in records:
         data = record.data
-        rows.append(
+        writer.writerow(
             [
                 data.siren,
                 data.year,
                 data.grade,
             ]
         )
-    writer.writerows(rows)
+
+
+async def parquet(path: Path, row_group_size=ROW_GROUP_SIZE):
+    """Export des déclarations au format Parquet, typé et en colonnes.
+
+    Requires pyarrow (`pip install egapro[parquet]`).
+
+    :path:              chemin vers le fichier d'export
+    :row_group_size:    nombre de déclarations par groupe de lignes
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    note = pa.int8()
+    timestamp = pa.timestamp("us", tz="UTC")
+    schema = pa.schema(
+        [
+            ("siren", pa.string()),
+            ("year", pa.int16()),
+            ("note", note),
+            ("note_remunerations", note),
+            ("note_augmentations", note),
+            ("note_promotions", note),
+            ("note_augmentations_et_promotions", note),
+            ("note_conges_maternite", note),
+            ("note_hautes_remunerations", note),
+            ("region", pa.string()),
+            ("departement", pa.string()),
+            ("code_naf", pa.string()),
+            ("tranche", pa.string()),
+            ("fin_periode_reference", pa.date32()),
+            ("declared_at", timestamp),
+            ("modified_at", timestamp),
+            ("ues_size", pa.int16()),
+        ]
+    )
+    count = 0
+    batch = []
+
+    def write():
+        columns = dict(zip(schema.names, zip(*batch)))
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        batch.clear()
+
+    with pq.ParquetWriter(path, schema) as writer:
+        async for record in db.declaration.cursor(sql.export_declarations):
+            batch.append(tuple(record.values()))
+            count += 1
+            if len(batch) >= row_group_size:
+                write()
+        if batch:
+            write()
+    return count
@@ -1,9 +1,10 @@
 """Unlike utils, helpers may import business logic"""
 
+import asyncio
 import math
-from asyncstdlib.functools import lru_cache
+from collections import Counter
 from datetime import date
-from difflib import SequenceMatcher
+from functools import partial
 
 import httpx
 
@@ -71,6 +72,17 @@ HAUTES_REMUNERATIONS_THRESHOLDS = {
 }
 
 
+# Company metadata cache counters, for this process.
+ENTREPRISE_STATS = Counter(hits=0, stale=0, misses=0)
+# SIRENs being refreshed in background: their task.
+REVALIDATING = {}
+
+
+class UpstreamError(ValueError):
+    """The companies API is unreachable or failing: unlike a 404, this says
+    nothing about the SIREN itself, so it must not be cached."""
+
+
 def compute_note(resultat, thresholds):
     if resultat is None:
         return None
@@ -206,23 +218,71 @@ def compute_notes(data):
         data["déclaration"]["index"] = math.floor((points / maximum * 100) + 0.5)
 
 
-def extract_ft(data):
+def extract_names(data):
     candidates = [
         data.path("entreprise.raison_sociale"),
         data.path("entreprise.ues.nom"),
     ] + [e["raison_sociale"] for e in data.path("entreprise.ues.entreprises") or []]
-    return " ".join(c for c in candidates if c)
+    return [c for c in candidates if c]
 
 
-async def get(*args, **kwargs):
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(*args, **kwargs)
-        except httpx.HTTPError:
-            return None
-        if response.status_code != httpx.codes.OK:
-            return None
-        return response.json()
+def extract_ft(data):
+    return " ".join(extract_names(data))
+
+
+# Application lifetime HTTP client, see init and terminate.
+client = None
+# Per host concurrency caps, created lazily within the running loop.
+HOST_SEMAPHORES = {}
+
+
+def init():
+    global client
+    client = httpx.AsyncClient(
+        timeout=httpx.Timeout(config.HTTP_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=config.HTTP_KEEPALIVE,
+        ),
+    )
+
+
+async def terminate():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+    HOST_SEMAPHORES.clear()
+
+
+async def _get(client, url, **kwargs):
+    host = httpx.URL(url).host
+    if host not in HOST_SEMAPHORES:
+        HOST_SEMAPHORES[host] = asyncio.Semaphore(config.HTTP_MAX_PER_HOST)
+    async with HOST_SEMAPHORES[host]:
+        return await client.get(url, **kwargs)
+
+
+async def get(url, **kwargs):
+    """Return the JSON of `url`, or None if it does not exist.
+
+    Raise UpstreamError on network errors and on any other status.
+    """
+    try:
+        if client is not None:
+            response = await _get(client, url, **kwargs)
+        else:
+            # Not initialized (eg. in a script): use a one shot client.
+            async with httpx.AsyncClient() as one_shot:
+                response = await _get(one_shot, url, **kwargs)
+    except httpx.HTTPError as err:
+        raise UpstreamError(f"Service indisponible: {err!r}")
+    if response.status_code == httpx.codes.NOT_FOUND:
+        return None
+    if response.status_code != httpx.codes.OK:
+        raise UpstreamError(f"Service indisponible: {response.status_code}")
+    return response.json()
 
 
 async def load_from_recherche_entreprises(siren):
@@ -311,18 +371,78 @@ async def load_from_api_entreprises(siren):
     }
 
 
-@lru_cache(maxsize=1024)
+async def fetch_entreprise_details(siren):
+    """Call the external API and cache the result, be it a success or a definitive
+    error (unknown or closed company). UpstreamError is raised, not cached."""
+    data, error = None, None
+    try:
+        if config.API_ENTREPRISES:
+            data = await load_from_api_entreprises(siren)
+        else:
+            data = await load_from_recherche_entreprises(siren)
+        data = {k: v for k, v in data.items() if v is not None}
+        if not data:
+            raise ValueError(f"Numéro SIREN inconnu: {siren}")
+    except UpstreamError:
+        raise
+    except ValueError as err:
+        data, error = None, str(err)
+    from egapro import db  # db imports helpers.
+
+    await db.entreprise.put(siren, data, error)
+    return data, error
+
+
+async def revalidate_entreprise_details(siren):
+    from egapro import db  # db imports helpers.
+
+    # Running in its own task: do not share the caller's unit of work, if any.
+    db.CONNECTION.set(None)
+    await fetch_entreprise_details(siren)
+
+
+def on_revalidated(siren, task):
+    REVALIDATING.pop(siren, None)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Cannot refresh entreprise {siren}: {task.exception()}")
+
+
 async def get_entreprise_details(siren):
-    if config.API_ENTREPRISES:
-        data = await load_from_api_entreprises(siren)
-    else:
-        data = await load_from_recherche_entreprises(siren)
-    data = {k: v for k, v in data.items() if v is not None}
-    if not data:
+    if not siren:
         raise ValueError(f"Numéro SIREN inconnu: {siren}")
+    from egapro import db  # db imports helpers.
+
+    record = await db.entreprise.get(siren)
+    if record:
+        age = (utils.utcnow() - record["fetched_at"]).total_seconds()
+        data, error = record["data"], record["error"]
+        ttl = config.SIREN_TTL if data else config.SIREN_NEGATIVE_TTL
+        if age < ttl:
+            ENTREPRISE_STATS["hits"] += 1
+        elif data and age < ttl + config.SIREN_STALE:
+            # Serve the stale value, and refresh it for the next callers.
+            ENTREPRISE_STATS["stale"] += 1
+            if siren not in REVALIDATING:
+                # Keep a reference, or the task may be garbage collected.
+                task = asyncio.ensure_future(revalidate_entreprise_details(siren))
+                task.add_done_callback(partial(on_revalidated, siren))
+                REVALIDATING[siren] = task
+        else:
+            record = None
+    if not record:
+        ENTREPRISE_STATS["misses"] += 1
+        data, error = await fetch_entreprise_details(siren)
+    if error:
+        raise ValueError(error)
     return data
 
 
+async def entreprise_cache_stats():
+    from egapro import db  # db imports helpers.
+
+    return {**ENTREPRISE_STATS, **await db.entreprise.stats()}
+
+
 async def patch_from_recherche_entreprises(data):
     entreprise = data.setdefault("entreprise", {})
     siren = entreprise.get("siren")
@@ -336,29 +456,6 @@ async def patch_from_recherche_entreprises(data):
                 entreprise.setdefault(key, value)
 
 
-def compare_str(wanted, candidate):
-    candidate = candidate.lower()
-    if wanted == candidate:
-        return 1
-    if wanted in candidate:
-        return 0.9
-    return SequenceMatcher(a=wanted, b=candidate).ratio()
-
-
-def compute_label(query, label, *others):
-    if not others:
-        return label
-    query = query.lower()
-    main_score = compare_str(query, label)
-    candidates = sorted(
-        ((c, compare_str(query, c)) for c in others), reverse=True, key=lambda x: x[1]
-    )
-    candidate, score = candidates[0]
-    if score > main_score:
-        label = f"{label} ({candidate})"
-    return label
-
-
 def code_insee_to_departement(code):
     if not code:
         return None
@@ -0,0 +1,3 @@
+async def main(db, logger):
+    # The stats table itself is created by init, on app startup.
+    await db.stats.refresh()
@@ -0,0 +1,22 @@
+ALTER TABLE declaration
+    ADD COLUMN IF NOT EXISTS note INT,
+    ADD COLUMN IF NOT EXISTS note_remunerations INT,
+    ADD COLUMN IF NOT EXISTS note_augmentations INT,
+    ADD COLUMN IF NOT EXISTS note_promotions INT,
+    ADD COLUMN IF NOT EXISTS note_augmentations_et_promotions INT,
+    ADD COLUMN IF NOT EXISTS note_conges_maternite INT,
+    ADD COLUMN IF NOT EXISTS note_hautes_remunerations INT,
+    ADD COLUMN IF NOT EXISTS tranche TEXT,
+    ADD COLUMN IF NOT EXISTS categories INT;
+UPDATE declaration
+SET note=jsonb_int(data->'déclaration'->'index'),
+    note_remunerations=jsonb_int(data->'indicateurs'->'rémunérations'->'note'),
+    note_augmentations=jsonb_int(data->'indicateurs'->'augmentations'->'note'),
+    note_promotions=jsonb_int(data->'indicateurs'->'promotions'->'note'),
+    note_augmentations_et_promotions=jsonb_int(data->'indicateurs'->'augmentations_et_promotions'->'note'),
+    note_conges_maternite=jsonb_int(data->'indicateurs'->'congés_maternité'->'note'),
+    note_hautes_remunerations=jsonb_int(data->'indicateurs'->'hautes_rémunérations'->'note'),
+    tranche=data->'entreprise'->'effectif'->>'tranche',
+    categories=CASE WHEN jsonb_typeof(data->'indicateurs'->'rémunérations'->'catégories') = 'array'
+        THEN jsonb_array_length(data->'indicateurs'->'rémunérations'->'catégories') END
+WHERE data IS NOT NULL;
@@ -0,0 +1,11 @@
+"""Fill the new `search.names` column, used by the suggestions, by rebuilding the
+whole search index."""
+
+
+async def main(db, logger):
+    async def records():
+        async for record in db.declaration.iter_completed():
+            yield record.data
+
+    count = await db.search.bulk_index(records())
+    logger.info(f"Indexed {count} rows")
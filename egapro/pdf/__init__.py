@@ -0,0 +1,67 @@
+"""Render PDFs in a pool of processes, out of the event loop, and cache them."""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from .. import cache, config
+
+POOL = None
+CACHE = cache.MemoryCache()
+
+
+def init():
+    global POOL, CACHE
+    POOL = ProcessPoolExecutor(config.PDF_WORKERS, initializer=warmup)
+    if config.CACHE_BACKEND == "file":
+        CACHE = cache.FileCache(
+            config.PDF_CACHE_TTL,
+            config.PDF_CACHE_SIZE,
+            path=f"{config.CACHE_PATH}-pdf",
+        )
+    else:
+        CACHE = cache.MemoryCache(config.PDF_CACHE_TTL, config.PDF_CACHE_SIZE)
+
+
+def terminate():
+    global POOL
+    if POOL is not None:
+        POOL.shutdown()
+        POOL = None
+
+
+def warmup():
+    from .base import load_fonts
+
+    load_fonts()  # Once for all the documents of this worker.
+
+
+def output(func, context):
+    pdf, filename = func(context)
+    return bytes(pdf.output()), filename
+
+
+async def render(func, context):
+    """Return the `(bytes, filename)` of the PDF built by `func(context)`.
+
+    Cached by siren, year and modification date, when the context has one.
+    Without init (eg. in a script), the PDF is rendered in a thread.
+    """
+    key = None
+    if context.get("modified_at"):
+        key = repr(
+            (
+                func.__module__,
+                func.__qualname__,
+                context["siren"],
+                context["year"],
+                context["modified_at"],
+            )
+        )
+        cached = CACHE.get(key)
+        if cached is not cache.MISSING:
+            return cached
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(POOL, output, func, context)
+    if key:
+        CACHE.set(key, result)
+    return result
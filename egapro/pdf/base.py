@@ -12,21 +12,40 @@ def as_date(d):
     return d.date().strftime("%d/%m/%Y")
 
 
+# Fonts metrics, loaded once per process then shared by all documents.
+FONTS = {}
+
+
+def load_fonts():
+    pdf = fpdf.FPDF(font_cache_dir="/tmp/")
+    root = Path(__file__).parent
+    pdf.add_font("Marianne", "", root / "font/Marianne-Regular.ttf", uni=True)
+    pdf.add_font("Marianne", "I", root / "font/Marianne-RegularItalic.ttf", uni=True)
+    pdf.add_font("Marianne", "B", root / "font/Marianne-Bold.ttf", uni=True)
+    pdf.add_font("Marianne", "BI", root / "font/Marianne-BoldItalic.ttf", uni=True)
+    FONTS["fonts"] = pdf.fonts
+    FONTS["font_files"] = pdf.font_files
+
+
 class PDF(fpdf.FPDF):
     LABELS = {}
 
     def __init__(self, *args, **kwargs):
         kwargs["font_cache_dir"] = "/tmp/"
         super().__init__(*args, **kwargs)
-        root = Path(__file__).parent
-        self.add_font("Marianne", "", root / "font/Marianne-Regular.ttf", uni=True)
-        self.add_font(
-            "Marianne", "I", root / "font/Marianne-RegularItalic.ttf", uni=True
-        )
-        self.add_font("Marianne", "B", root / "font/Marianne-Bold.ttf", uni=True)
-        self.add_font("Marianne", "BI", root / "font/Marianne-BoldItalic.ttf", uni=True)
+        self.add_fonts()
         self.add_page()
 
+    def add_fonts(self):
+        """Reuse the fonts parsed once per process, through fpdf2 internals: see
+        the exact fpdf2 version pinned in setup.cfg."""
+        if not FONTS:
+            load_fonts()
+        for key, font in FONTS["fonts"].items():
+            # The subset is filled with the chars used by each document.
+            self.fonts[key] = {**font, "subset": list(font["subset"])}
+        self.font_files.update(FONTS["font_files"])
+
     def __call__(self, path=None):
         return self.output(path)
 
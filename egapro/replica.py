@@ -0,0 +1,334 @@
+"""In-memory replica of the public search data, for the /search and /stats hot
+path.
+
+Rows of the search index are held in array-backed columns, along with inverted
+indexes of the filters values and of the names tokens, so searches, counts and
+stats are answered without a round trip to the DB. The replica is built on
+startup, then refreshed from the declarations `modified_at` and the tombstones.
+It is eventually consistent: a write shows up after the next refresh.
+"""
+
+import asyncio
+import bisect
+import heapq
+import re
+from array import array
+from collections import defaultdict
+from copy import deepcopy
+from functools import lru_cache
+
+from . import config, db, sql, utils
+from .loggers import logger
+
+# Same words as the `simple` text search parser, once normalized.
+TOKENS = re.compile(r"[^\W_]+")
+NO_NOTE = -1
+# Search result field: column of the replica.
+NOTES = {
+    "notes": "note",
+    "notes_remunerations": "note_remunerations",
+    "notes_augmentations": "note_augmentations",
+    "notes_promotions": "note_promotions",
+    "notes_augmentations_et_promotions": "note_augmentations_et_promotions",
+    "notes_conges_maternite": "note_conges_maternite",
+    "notes_hautes_rémunérations": "note_hautes_remunerations",
+}
+FILTERS = ("year", "region", "departement", "section_naf")
+
+# Built on startup when config.SEARCH_REPLICA is set, see init.
+index = None
+
+
+@lru_cache(maxsize=100_000)
+def trigrams(value):
+    """Trigrams of a normalized string, as computed by pg_trgm."""
+    out = set()
+    for word in TOKENS.findall(value):
+        word = f"  {word} "
+        out.update(word[i : i + 3] for i in range(len(word) - 2))
+    return frozenset(out)
+
+
+def similarity(a, b):
+    a, b = trigrams(a), trigrams(b)
+    union = len(a | b)
+    return len(a & b) / union if union else 0
+
+
+def label_score(name, query):
+    """Python version of the label_score SQL function."""
+    name = utils.normalize(name)
+    if name == query:
+        return 1
+    if query in name:
+        return 0.9
+    return similarity(name, query)
+
+
+def compute_label(entreprise, query):
+    """Python version of search_label.sql."""
+    ues = entreprise.get("ues") or {}
+    nom = ues.get("nom")
+    if not query or not nom or not ues.get("entreprises"):
+        return entreprise.get("raison_sociale")
+    candidates = [entreprise.get("raison_sociale")] + [
+        e.get("raison_sociale") for e in ues["entreprises"]
+    ]
+    main_score = label_score(nom, query)
+    best, best_score = None, main_score
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        score = label_score(candidate, query)
+        if score > best_score:
+            best, best_score = candidate, score
+    return f"{nom} ({best})" if best else nom
+
+
+class Index:
+    def __init__(self):
+        # (siren, year): row id.
+        self.ids = {}
+        # Ids of the deleted rows, reused by the next inserted ones.
+        self.free = []
+        self.sirens = []
+        self.declared_at = []
+        self.grades = array("b")
+        self.notes = {column: array("b") for column in NOTES.values()}
+        self.entreprises = []
+        self.names = []
+        self.filters = {name: [] for name in FILTERS}
+        # Inverted indexes: value (or token): set of row ids.
+        self.by_siren = defaultdict(set)
+        self.by_filter = {name: defaultdict(set) for name in FILTERS}
+        self.by_token = defaultdict(set)
+        # Sorted tokens, for the prefix search of the last word.
+        self.tokens = []
+        self.synced_at = None
+        self.refreshed_at = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def upsert(self, row):
+        key = (row["siren"], row["year"])
+        id_ = self.ids.get(key)
+        if id_ is None and self.free:
+            id_ = self.free.pop()
+            self.ids[key] = id_
+            self.sirens[id_] = row["siren"]
+        elif id_ is None:
+            id_ = len(self.sirens)
+            self.ids[key] = id_
+            self.sirens.append(row["siren"])
+            self.declared_at.append(None)
+            self.grades.append(NO_NOTE)
+            for values in self.notes.values():
+                values.append(NO_NOTE)
+            self.entreprises.append(None)
+            self.names.append("")
+            for values in self.filters.values():
+                values.append(None)
+        else:
+            self.unindex(id_)
+        self.declared_at[id_] = row["declared_at"]
+        self.grades[id_] = NO_NOTE if row["grade"] is None else row["grade"]
+        for column, values in self.notes.items():
+            values[id_] = NO_NOTE if row[column] is None else row[column]
+        self.entreprises[id_] = row["entreprise"]
+        self.names[id_] = row["names"] or ""
+        for name, values in self.filters.items():
+            values[id_] = row[name]
+        self.reindex(id_)
+
+    def delete(self, siren, year):
+        id_ = self.ids.pop((siren, year), None)
+        if id_ is not None:
+            self.unindex(id_)
+            self.entreprises[id_] = None
+            self.free.append(id_)
+
+    def reindex(self, id_):
+        self.by_siren[self.sirens[id_]].add(id_)
+        for name, values in self.filters.items():
+            self.by_filter[name][values[id_]].add(id_)
+        for token in set(TOKENS.findall(self.names[id_])):
+            if token not in self.by_token:
+                bisect.insort(self.tokens, token)
+            self.by_token[token].add(id_)
+
+    def unindex(self, id_):
+        self.by_siren[self.sirens[id_]].discard(id_)
+        for name, values in self.filters.items():
+            self.by_filter[name][values[id_]].discard(id_)
+        for token in set(TOKENS.findall(self.names[id_])):
+            ids = self.by_token[token]
+            ids.discard(id_)
+            if not ids:
+                del self.by_token[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+
+    async def refresh(self):
+        """Load the rows modified since the last refresh, everything at first,
+        and drop the ones that left the search index.
+
+        Return the number of upserted and deleted rows.
+        """
+        since = self.synced_at
+        args, where = [], "WHERE search.siren IS NOT NULL"
+        if since is not None:
+            # See db.search.sync.
+            since -= db.search.SYNC_MARGIN
+            args, where = [since], "WHERE declaration.modified_at > $1"
+        last = self.synced_at
+        count = 0
+        if since is not None:
+            async for row in db.tombstone.iter_since(since):
+                self.delete(row["siren"], row["year"])
+                last = max(last, row["deleted_at"])
+                count += 1
+        async for row in db.search.cursor(sql.replica_rows.format(where=where), *args):
+            # Modified, but not (or no more) indexed, eg. no longer public.
+            if row["indexed"]:
+                self.upsert(row)
+            else:
+                self.delete(row["siren"], row["year"])
+            if row["modified_at"]:
+                last = max(last, row["modified_at"]) if last else row["modified_at"]
+            count += 1
+        # Rows may also leave the index without their declaration being modified,
+        # eg. on a full reindex: compare the keys when the sizes do not match.
+        if since is not None and len(self) != await db.search.fetchval(
+            "SELECT COUNT(*) FROM search"
+        ):
+            query = "SELECT siren, year FROM search"
+            keys = {(r["siren"], r["year"]) async for r in db.search.cursor(query)}
+            for key in set(self.ids) - keys:
+                self.delete(*key)
+                count += 1
+        self.synced_at = last or utils.utcnow()
+        self.refreshed_at = utils.utcnow()
+        return count
+
+    def match(self, query=None, **filters):
+        """Return the set of the row ids matching the query and the filters."""
+        sets = []
+        if query and len(query) == 9 and query.isdigit():
+            filters["siren"] = query
+        elif query:
+            tokens = TOKENS.findall(utils.normalize(query))
+            # Prefix search on the last word, see utils.prepare_query.
+            prefix = tokens.pop() if tokens and not query.endswith("*") else None
+            sets.extend(self.by_token.get(token, set()) for token in tokens)
+            if prefix is not None:
+                position = bisect.bisect_left(self.tokens, prefix)
+                ids = set()
+                while position < len(self.tokens):
+                    token = self.tokens[position]
+                    if not token.startswith(prefix):
+                        break
+                    ids |= self.by_token[token]
+                    position += 1
+                sets.append(ids)
+        for name, value in filters.items():
+            if value is None:
+                continue
+            if name == "siren":
+                sets.append(self.by_siren.get(value, set()))
+            elif name in self.by_filter:
+                sets.append(self.by_filter[name].get(value, set()))
+            else:
+                raise ValueError(f"Invalid filter: {name}")
+        if not sets:
+            return set(self.ids.values())
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    async def page(
+        self, query=None, limit=10, offset=0, cursor=None, fields=None, **filters
+    ):
+        """Same as db.search.page."""
+        fields = fields or tuple(db.search.FIELDS)
+        for name in fields:
+            if name not in db.search.FIELDS:
+                raise ValueError(f"Invalid field: {name}")
+        groups = defaultdict(list)
+        for id_ in self.match(query, **filters):
+            groups[self.sirens[id_]].append(id_)
+        keys = (
+            (max(self.declared_at[i] for i in ids), siren)
+            for siren, ids in groups.items()
+        )
+        if cursor:
+            after = db.search.decode_cursor(cursor)
+            keys = (key for key in keys if key < after)
+        keys = heapq.nlargest(offset + limit, keys)[offset:]
+        label_query = utils.normalize(query) if query else None
+        rows = []
+        for _, siren in keys:
+            ids = sorted(groups[siren], key=lambda i: self.declared_at[i], reverse=True)
+            entreprise = self.entreprises[ids[0]]
+            row = {}
+            for name in fields:
+                if name == "entreprise":
+                    row[name] = deepcopy(entreprise)
+                elif name == "label":
+                    row[name] = compute_label(entreprise, label_query)
+                else:
+                    values = self.notes[NOTES[name]]
+                    row[name] = {
+                        str(self.filters["year"][i]): (
+                            None if values[i] == NO_NOTE else values[i]
+                        )
+                        for i in ids
+                    }
+            rows.append(db.search.as_json(row))
+        page = {"data": rows, "count": len(groups)}
+        if rows and len(rows) == limit:
+            page["next"] = db.search.encode_cursor(*keys[-1])
+        return page
+
+    async def stats(self, year, **filters):
+        """Same as db.search.stats."""
+        companies = {self.sirens[i] for i in self.match(**filters)}
+        ids = self.match(year=year, **filters)
+        notes = [self.grades[i] for i in ids if self.grades[i] != NO_NOTE]
+        return {
+            "count": len(companies),
+            "year_count": len(ids),
+            "avg": sum(notes) / len(notes) if notes else None,
+            "min": min(notes, default=None),
+            "max": max(notes, default=None),
+            "refreshed_at": self.refreshed_at if ids else None,
+        }
+
+
+async def init():
+    """Build the replica, or leave it unset (hence the DB being used) on error."""
+    global index
+    replica = Index()
+    try:
+        count = await replica.refresh()
+    except Exception as err:
+        logger.error(f"Cannot build search replica: {err}")
+        return
+    logger.info(f"Search replica built with {count} rows")
+    index = replica
+
+
+def terminate():
+    global index
+    index = None
+
+
+async def worker():
+    """Refresh the replica every config.SEARCH_REPLICA_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(config.SEARCH_REPLICA_INTERVAL)
+        if index is None:
+            await init()
+            continue
+        try:
+            await index.refresh()
+        except Exception as err:
+            logger.error(f"Cannot refresh search replica: {err}")
@@ -1,7 +1,10 @@
 CREATE INDEX IF NOT EXISTS idx_effectifs ON declaration ((data->'entreprise'->'effectifs'->'tranche'));
 CREATE INDEX IF NOT EXISTS idx_status ON declaration (declared_at) WHERE declared_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_modified_at ON declaration (modified_at);
 CREATE INDEX IF NOT EXISTS idx_ft ON search USING GIN (ft);
+CREATE INDEX IF NOT EXISTS idx_names ON search USING GIN (names gin_trgm_ops);
 CREATE INDEX IF NOT EXISTS idx_region ON search(region);
 CREATE INDEX IF NOT EXISTS idx_departement ON search(departement);
 CREATE INDEX IF NOT EXISTS idx_naf ON search(section_naf);
 CREATE INDEX IF NOT EXISTS idx_declared_at ON search (declared_at);
+CREATE INDEX IF NOT EXISTS idx_search_group ON search (year, COALESCE(region, ''), COALESCE(departement, ''), COALESCE(section_naf::text, ''));
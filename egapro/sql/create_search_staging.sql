@@ -0,0 +1,3 @@
+CREATE TEMPORARY TABLE search_staging
+(siren TEXT, year INT, declared_at TIMESTAMP WITH TIME ZONE, ft TEXT, region VARCHAR(2), departement VARCHAR(3), section_naf CHAR, note INT, names TEXT)
+ON COMMIT DROP
@@ -0,0 +1,16 @@
+SELECT siren, year, note, note_remunerations, note_augmentations, note_promotions,
+    note_augmentations_et_promotions, note_conges_maternite, note_hautes_remunerations,
+    data->'entreprise'->>'région' AS region,
+    data->'entreprise'->>'département' AS departement,
+    data->'entreprise'->>'code_naf' AS code_naf,
+    tranche,
+    CASE WHEN data->'déclaration'->>'fin_période_référence' ~ '^[0-9]+-[0-9]+-[0-9]+$'
+        THEN (data->'déclaration'->>'fin_période_référence')::date
+    END AS fin_periode_reference,
+    declared_at, modified_at,
+    CASE WHEN jsonb_typeof(data->'entreprise'->'ues'->'entreprises') = 'array'
+        THEN NULLIF(jsonb_array_length(data->'entreprise'->'ues'->'entreprises'), 0) + 1
+    END AS ues_size
+FROM declaration
+WHERE declared_at IS NOT NULL
+ORDER BY year, siren
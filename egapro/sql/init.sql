@@ -1,4 +1,5 @@
 CREATE EXTENSION IF NOT EXISTS unaccent;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 DO
 $$BEGIN
     CREATE TEXT SEARCH CONFIGURATION ftdict (COPY=simple);
@@ -7,16 +8,56 @@ EXCEPTION
    WHEN unique_violation THEN
       NULL;  -- ignore error
 END;$$;
+-- How well a company name matches a (lowercased, unaccented) search query, to
+-- choose the name displayed in the search results.
+CREATE OR REPLACE FUNCTION label_score(name TEXT, query TEXT) RETURNS REAL AS $$
+    SELECT CASE
+        WHEN lower(unaccent(name)) = query THEN 1
+        WHEN strpos(lower(unaccent(name)), query) > 0 THEN 0.9
+        ELSE similarity(lower(unaccent(name)), query)
+    END
+$$ LANGUAGE SQL STABLE;
+-- Integer value of a JSON number, rounded, NULL for any other JSON value or out
+-- of range, to fill the typed columns whatever the stored data.
+CREATE OR REPLACE FUNCTION jsonb_int(value JSONB) RETURNS INT AS $$
+    SELECT CASE WHEN jsonb_typeof(value) = 'number' THEN
+        CASE WHEN abs(value::numeric) < 2147483647 THEN round(value::numeric)::int END
+    END
+$$ LANGUAGE SQL IMMUTABLE;
 CREATE TABLE IF NOT EXISTS declaration
 (siren TEXT, year INT, modified_at TIMESTAMP WITH TIME ZONE, declared_at TIMESTAMP WITH TIME ZONE, declarant TEXT, data JSONB, draft JSONB, legacy JSONB, ft TSVECTOR,
 PRIMARY KEY (siren, year));
+-- Typed copies of the hot data paths, set by insert_declaration.
+ALTER TABLE declaration
+    ADD COLUMN IF NOT EXISTS note INT,
+    ADD COLUMN IF NOT EXISTS note_remunerations INT,
+    ADD COLUMN IF NOT EXISTS note_augmentations INT,
+    ADD COLUMN IF NOT EXISTS note_promotions INT,
+    ADD COLUMN IF NOT EXISTS note_augmentations_et_promotions INT,
+    ADD COLUMN IF NOT EXISTS note_conges_maternite INT,
+    ADD COLUMN IF NOT EXISTS note_hautes_remunerations INT,
+    ADD COLUMN IF NOT EXISTS tranche TEXT,
+    ADD COLUMN IF NOT EXISTS categories INT;
 CREATE TABLE IF NOT EXISTS simulation
 (id uuid PRIMARY KEY, modified_at TIMESTAMP WITH TIME ZONE, data JSONB);
 CREATE TABLE IF NOT EXISTS search
 (siren TEXT, year INT, declared_at TIMESTAMP WITH TIME ZONE, ft TSVECTOR, region VARCHAR(2), departement VARCHAR(3), section_naf CHAR, note INT,
 PRIMARY KEY (siren, year));
+-- Normalized company names, for the suggestions.
+ALTER TABLE search ADD COLUMN IF NOT EXISTS names TEXT;
 ALTER TABLE search DROP CONSTRAINT IF EXISTS declaration_exists;
 ALTER TABLE search ADD CONSTRAINT declaration_exists FOREIGN KEY (siren,year) REFERENCES declaration(siren,year) ON DELETE CASCADE ON UPDATE CASCADE;
 CREATE TABLE IF NOT EXISTS archive
 (siren TEXT, year INT, at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), by TEXT, ip INET, data JSONB);
 CREATE TABLE IF NOT EXISTS ownership (siren TEXT, email TEXT, PRIMARY KEY (siren, email));
+CREATE TABLE IF NOT EXISTS entreprise (siren TEXT PRIMARY KEY, data JSONB, error TEXT, fetched_at TIMESTAMP WITH TIME ZONE);
+CREATE TABLE IF NOT EXISTS outbox
+(id SERIAL PRIMARY KEY, created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), message BYTEA, attempts INT DEFAULT 0, next_attempt_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), error TEXT);
+CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt_at ON outbox (next_attempt_at) WHERE next_attempt_at IS NOT NULL;
+CREATE TABLE IF NOT EXISTS watermark (name TEXT PRIMARY KEY, at TIMESTAMP WITH TIME ZONE);
+CREATE TABLE IF NOT EXISTS tombstone
+(siren TEXT, year INT, deleted_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+PRIMARY KEY (siren, year));
+CREATE TABLE IF NOT EXISTS stats
+(year INT, region TEXT, departement TEXT, section_naf TEXT, count INT, notes INT, total INT, min INT, max INT, refreshed_at TIMESTAMP WITH TIME ZONE,
+PRIMARY KEY (year, region, departement, section_naf));
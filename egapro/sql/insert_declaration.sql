@@ -1,4 +1,24 @@
-INSERT INTO declaration (siren, year, modified_at, declared_at, declarant, data, ft, draft)
-VALUES ($1, $2, $3, $4, $5, $6, to_tsvector('ftdict', $7), null)
+INSERT INTO declaration (siren, year, modified_at, declared_at, declarant, data, ft, draft,
+    note, note_remunerations, note_augmentations, note_promotions, note_augmentations_et_promotions, note_conges_maternite, note_hautes_remunerations, tranche, categories)
+VALUES ($1, $2, $3, $4, $5, $6, to_tsvector('ftdict', $7), null,
+    jsonb_int($6::jsonb->'déclaration'->'index'),
+    jsonb_int($6::jsonb->'indicateurs'->'rémunérations'->'note'),
+    jsonb_int($6::jsonb->'indicateurs'->'augmentations'->'note'),
+    jsonb_int($6::jsonb->'indicateurs'->'promotions'->'note'),
+    jsonb_int($6::jsonb->'indicateurs'->'augmentations_et_promotions'->'note'),
+    jsonb_int($6::jsonb->'indicateurs'->'congés_maternité'->'note'),
+    jsonb_int($6::jsonb->'indicateurs'->'hautes_rémunérations'->'note'),
+    $6::jsonb->'entreprise'->'effectif'->>'tranche',
+    CASE WHEN jsonb_typeof($6::jsonb->'indicateurs'->'rémunérations'->'catégories') = 'array'
+        THEN jsonb_array_length($6::jsonb->'indicateurs'->'rémunérations'->'catégories') END)
 ON CONFLICT (siren, year) DO UPDATE
-SET modified_at=$3, declared_at=$4, declarant=$5, data=$6, ft=to_tsvector('ftdict', $7), draft=null
+SET modified_at=$3, declared_at=$4, declarant=$5, data=$6, ft=to_tsvector('ftdict', $7), draft=null,
+    note=EXCLUDED.note,
+    note_remunerations=EXCLUDED.note_remunerations,
+    note_augmentations=EXCLUDED.note_augmentations,
+    note_promotions=EXCLUDED.note_promotions,
+    note_augmentations_et_promotions=EXCLUDED.note_augmentations_et_promotions,
+    note_conges_maternite=EXCLUDED.note_conges_maternite,
+    note_hautes_remunerations=EXCLUDED.note_hautes_remunerations,
+    tranche=EXCLUDED.tranche,
+    categories=EXCLUDED.categories
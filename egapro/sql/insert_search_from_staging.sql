@@ -0,0 +1,3 @@
+INSERT INTO search (siren, year, declared_at, ft, region, departement, section_naf, note, names)
+SELECT siren, year, declared_at, to_tsvector('ftdict', ft), region, departement, section_naf, note, names
+FROM search_staging
@@ -0,0 +1,2 @@
+SELECT MAX(declaration.modified_at) AS modified_at, COUNT(*) AS count
+FROM declaration JOIN search ON declaration.siren=search.siren AND declaration.year=search.year
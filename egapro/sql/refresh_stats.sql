@@ -0,0 +1,5 @@
+DELETE FROM stats;
+INSERT INTO stats (year, region, departement, section_naf, count, notes, total, min, max, refreshed_at)
+SELECT year, COALESCE(region, ''), COALESCE(departement, ''), COALESCE(section_naf::text, ''), COUNT(*), COUNT(note), COALESCE(SUM(note), 0), MIN(note), MAX(note), NOW()
+FROM search
+GROUP BY 1, 2, 3, 4
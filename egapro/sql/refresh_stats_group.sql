@@ -0,0 +1,9 @@
+INSERT INTO stats (year, region, departement, section_naf, count, notes, total, min, max, refreshed_at)
+SELECT $1, $2::text, $3::text, $4::text, COUNT(*), COUNT(note), COALESCE(SUM(note), 0), MIN(note), MAX(note), NOW()
+FROM search
+WHERE year=$1
+    AND COALESCE(region, '')=$2::text
+    AND COALESCE(departement, '')=$3::text
+    AND COALESCE(section_naf::text, '')=$4::text
+ON CONFLICT (year, region, departement, section_naf) DO UPDATE
+SET count=EXCLUDED.count, notes=EXCLUDED.notes, total=EXCLUDED.total, min=EXCLUDED.min, max=EXCLUDED.max, refreshed_at=EXCLUDED.refreshed_at
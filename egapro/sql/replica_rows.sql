@@ -0,0 +1,32 @@
+SELECT
+    declaration.siren,
+    declaration.year,
+    declaration.declared_at,
+    declaration.modified_at,
+    search.siren IS NOT NULL AS indexed,
+    search.region,
+    search.departement,
+    search.section_naf,
+    search.note AS grade,
+    search.names,
+    declaration.note,
+    declaration.note_remunerations,
+    declaration.note_augmentations,
+    declaration.note_promotions,
+    declaration.note_augmentations_et_promotions,
+    declaration.note_conges_maternite,
+    declaration.note_hautes_remunerations,
+    -- Same projection as in search.sql.
+    jsonb_build_object(
+        'raison_sociale', declaration.data->'entreprise'->'raison_sociale',
+        'siren', declaration.siren,
+        'région', declaration.data->'entreprise'->'région',
+        'département', declaration.data->'entreprise'->'département',
+        'code_naf', declaration.data->'entreprise'->'code_naf',
+        'ues', declaration.data->'entreprise'->'ues',
+        'effectif', jsonb_build_object('tranche', declaration.data->'entreprise'->'effectif'->'tranche')
+    ) AS entreprise
+FROM declaration
+LEFT JOIN search ON declaration.siren=search.siren AND declaration.year=search.year
+    {where}
+ORDER BY declaration.modified_at
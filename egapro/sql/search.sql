@@ -1,16 +1,52 @@
-SELECT
-    array_agg(declaration.data ORDER BY declaration.declared_at DESC) as data,
-    jsonb_object_agg(declaration.year::text, (declaration.data->'déclaration'->>'index')::int) as notes,
-    jsonb_object_agg(declaration.year::text, (declaration.data->'indicateurs'->'rémunérations'->>'note')::int) as notes_remunerations,
-    jsonb_object_agg(declaration.year::text, (declaration.data->'indicateurs'->'augmentations'->>'note')::int) as notes_augmentations,
-    jsonb_object_agg(declaration.year::text, (declaration.data->'indicateurs'->'promotions'->>'note')::int) as notes_promotions,
-    jsonb_object_agg(declaration.year::text, (declaration.data->'indicateurs'->'augmentations_et_promotions'->>'note')::int) as notes_augmentations_et_promotions,
-    jsonb_object_agg(declaration.year::text, (declaration.data->'indicateurs'->'congés_maternité'->>'note')::int) as notes_conges_maternite,
-    jsonb_object_agg(declaration.year::text, (declaration.data->'indicateurs'->'hautes_rémunérations'->>'note')::int) as notes_hautes_rémunérations
-FROM declaration
-JOIN search ON declaration.siren=search.siren AND declaration.year=search.year
-    {where}
-GROUP BY declaration.siren
-ORDER BY max(declaration.declared_at) DESC
-LIMIT $1
-OFFSET $2
+WITH groups AS (
+    SELECT
+        declaration.siren,
+        max(declaration.declared_at) as last_declared_at,
+        -- Computed over all groups, before the cursor and LIMIT/OFFSET.
+        COUNT(*) OVER () as total
+    FROM declaration
+    JOIN search ON declaration.siren=search.siren AND declaration.year=search.year
+        {where}
+    GROUP BY declaration.siren
+),
+page AS (
+    SELECT * FROM groups
+        {after}
+    ORDER BY last_declared_at DESC, siren DESC
+    LIMIT $1
+    OFFSET $2
+),
+results AS (
+    SELECT
+        -- Only the public fields of the latest declaration.
+        (array_agg(
+            jsonb_build_object(
+                'raison_sociale', declaration.data->'entreprise'->'raison_sociale',
+                'siren', declaration.siren,
+                'région', declaration.data->'entreprise'->'région',
+                'département', declaration.data->'entreprise'->'département',
+                'code_naf', declaration.data->'entreprise'->'code_naf',
+                'ues', declaration.data->'entreprise'->'ues',
+                'effectif', jsonb_build_object('tranche', declaration.data->'entreprise'->'effectif'->'tranche')
+            )
+            ORDER BY declaration.declared_at DESC
+        ))[1] as entreprise,
+        jsonb_object_agg(declaration.year::text, declaration.note) as notes,
+        jsonb_object_agg(declaration.year::text, declaration.note_remunerations) as notes_remunerations,
+        jsonb_object_agg(declaration.year::text, declaration.note_augmentations) as notes_augmentations,
+        jsonb_object_agg(declaration.year::text, declaration.note_promotions) as notes_promotions,
+        jsonb_object_agg(declaration.year::text, declaration.note_augmentations_et_promotions) as notes_augmentations_et_promotions,
+        jsonb_object_agg(declaration.year::text, declaration.note_conges_maternite) as notes_conges_maternite,
+        jsonb_object_agg(declaration.year::text, declaration.note_hautes_remunerations) as notes_hautes_rémunérations,
+        page.total,
+        page.last_declared_at,
+        page.siren
+    FROM page
+    JOIN declaration ON declaration.siren=page.siren
+    JOIN search ON declaration.siren=search.siren AND declaration.year=search.year
+        {where}
+    GROUP BY page.siren, page.last_declared_at, page.total
+)
+SELECT results.total, results.last_declared_at, results.siren, {fields}
+FROM results
+ORDER BY results.last_declared_at DESC, results.siren DESC
@@ -0,0 +1 @@
+SELECT year, region, departement, section_naf, note FROM search WHERE siren=$1 AND year=$2
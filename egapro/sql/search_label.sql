@@ -0,0 +1,26 @@
+-- UES are labelled with the member name matching the query best ({query}, see
+-- label_score), when it matches better than the UES name itself.
+CASE
+    WHEN {query}::text IS NULL
+        OR coalesce(results.entreprise->'ues'->>'nom', '') = ''
+        OR coalesce(jsonb_array_length(results.entreprise->'ues'->'entreprises'), 0) = 0
+        THEN results.entreprise->>'raison_sociale'
+    ELSE coalesce(
+        (
+            SELECT (results.entreprise->'ues'->>'nom') || ' (' || candidate.name || ')'
+            FROM (
+                SELECT results.entreprise->>'raison_sociale' as name, 0 as position
+                UNION ALL
+                SELECT member->>'raison_sociale', position
+                FROM jsonb_array_elements(results.entreprise->'ues'->'entreprises')
+                    WITH ORDINALITY AS members(member, position)
+            ) candidate
+            WHERE candidate.name IS NOT NULL
+                AND label_score(candidate.name, {query})
+                    > coalesce(label_score(results.entreprise->'ues'->>'nom', {query}), 0)
+            ORDER BY label_score(candidate.name, {query}) DESC, candidate.position
+            LIMIT 1
+        ),
+        results.entreprise->'ues'->>'nom'
+    )
+END
@@ -1,8 +1,7 @@
-WITH subset AS (SELECT siren FROM search {where}),
-     count AS (SELECT COUNT(DISTINCT(siren)) FROM subset),
-     stats AS (SELECT avg((data->'déclaration'->>'index')::int),
-                      min((data->'déclaration'->>'index')::int),
-                      max((data->'déclaration'->>'index')::int)
-               FROM declaration
-               WHERE year=$1 AND siren IN (SELECT siren FROM subset))
-    SELECT * FROM count JOIN stats ON true;
+SELECT COALESCE(SUM(count), 0)::int AS year_count,
+       SUM(total)::numeric / NULLIF(SUM(notes), 0) AS avg,
+       MIN(min) AS min,
+       MAX(max) AS max,
+       MAX(refreshed_at) AS refreshed_at
+FROM stats
+{where}
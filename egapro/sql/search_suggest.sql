@@ -0,0 +1,19 @@
+WITH matches AS (
+    SELECT search.siren, max(similarity(search.names, $1)) AS score
+    FROM search
+    {where}
+    GROUP BY search.siren
+    ORDER BY score DESC, search.siren
+    LIMIT $2
+)
+SELECT matches.siren, latest.raison_sociale
+FROM matches,
+LATERAL (
+    SELECT declaration.data->'entreprise'->>'raison_sociale' AS raison_sociale
+    FROM search
+    JOIN declaration ON declaration.siren=search.siren AND declaration.year=search.year
+    WHERE search.siren=matches.siren
+    ORDER BY search.year DESC
+    LIMIT 1
+) latest
+ORDER BY matches.score DESC, matches.siren
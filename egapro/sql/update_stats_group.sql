@@ -0,0 +1,9 @@
+UPDATE stats
+SET count=count + $5,
+    notes=notes + $6,
+    total=total + $7,
+    -- LEAST and GREATEST ignore NULLs.
+    min=LEAST(min, $8::int),
+    max=GREATEST(max, $9::int),
+    refreshed_at=NOW()
+WHERE year=$1 AND region=$2 AND departement=$3 AND section_naf=$4
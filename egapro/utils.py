@@ -2,6 +2,7 @@ from datetime import date, datetime, timedelta, timezone
 from importlib import import_module
 
 import json
+import unicodedata
 
 
 def default_json(v):
@@ -39,6 +40,12 @@ def prepare_query(query):
     return query
 
 
+def normalize(value):
+    """Lowercase and remove accents, for accent insensitive matching."""
+    value = unicodedata.normalize("NFKD", value.lower())
+    return "".join(c for c in value if not unicodedata.combining(c))
+
+
 def flatten(b, prefix="", delim=".", val=None, flatten_lists=False):
     # See https://stackoverflow.com/a/57228641/330911
     if val is None:
@@ -91,3 +98,20 @@ def official_round(i):
     So for example, 0.01 should be rounded to 0, while 0.1 should be rounded to 1.
     """
     return round(float(i) + 0.5 - 0.049)
+
+
+def accepts_encoding(header, encoding):
+    """Whether an Accept-Encoding `header` accepts `encoding`, q-values included."""
+    accepted = {}
+    for item in header.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.lower()] = quality
+    return accepted.get(encoding, accepted.get("*", 0)) > 0
@@ -1,4 +1,6 @@
+import asyncio
 import sys
+from email.utils import format_datetime
 from functools import wraps
 from traceback import print_exc
 
@@ -9,7 +11,9 @@ from asyncpg.exceptions import DataError
 from roll.extensions import cors, options
 from stdnum.fr.siren import is_valid as siren_is_valid
 
-from . import config, constants, db, emails, helpers, models, tokens, utils, schema
+from . import cache, config, constants, db, emails, exporter, helpers, models, pdf
+from . import replica, tokens, utils
+from . import schema
 from . import loggers
 
 
@@ -131,33 +135,40 @@ async def declare(request, response, siren, year):
     schema.validate(data.raw)
     helpers.compute_notes(data)
     schema.cross_validate(data.raw)
-    try:
-        current = await db.declaration.get(siren, year)
-    except db.NoData:
-        current = None
-    else:
-        # Do not force new declarant, in case this is a staff person editing
-        declarant = current["declarant"]
-        declared_at = current["declared_at"]
-        expired = declared_at and declared_at < utils.remove_one_year(utils.utcnow())
-        if expired and not request["staff"]:
-            raise HttpError(403, "Le délai de modification est écoulé.")
-    await db.declaration.put(siren, year, declarant, data)
-    response.status = 204
-    if data.validated:
-        await db.archive.put(siren, year, data, by=request["email"], ip=request.ip)
-        if not request["staff"]:
-            await db.ownership.put(siren, request["email"])
+    # Run the whole write on a single connection and transaction.
+    async with db.table.transaction():
+        try:
+            current = await db.declaration.get(siren, year)
+        except db.NoData:
+            current = None
+        else:
+            # Do not force new declarant, in case this is a staff person editing
+            declarant = current["declarant"]
+            declared_at = current["declared_at"]
+            expired = declared_at and declared_at < utils.remove_one_year(
+                utils.utcnow()
+            )
+            if expired and not request["staff"]:
+                raise HttpError(403, "Le délai de modification est écoulé.")
+        await db.declaration.put(siren, year, declarant, data)
+        if data.validated:
+            await db.archive.put(siren, year, data, by=request["email"], ip=request.ip)
+            if not request["staff"]:
+                await db.ownership.put(siren, request["email"])
         # Do not send the success email on update for now (we send too much emails that
         # are unwanted, mainly because when someone loads the frontend app a PUT is
         # automatically sent, without any action from the user.)
-        loggers.logger.info(f"{siren}/{year} BY {declarant} FROM {request.ip}")
-        if not current or not current.data.validated:
+        notify = data.validated and (not current or not current.data.validated)
+        if notify:
             owners = await db.ownership.emails(siren)
+    response.status = 204
+    if data.validated:
+        loggers.logger.info(f"{siren}/{year} BY {declarant} FROM {request.ip}")
+        if notify:
             if not owners:  # Staff member
                 owners = request["email"]
             url = request.domain + data.uri
-            emails.success.send(owners, url=url, **data)
+            await emails.success.send(owners, url=url, **data)
 
 
 @app.route("/declaration/{siren}/{year}", methods=["GET"])
@@ -197,7 +208,9 @@ async def resend_receipt(request, response, siren, year):
         owners = request["email"]
     data = record.data
     url = request.domain + data.uri
-    emails.success.send(owners, url=url, **data)
+    await emails.success.send(
+        owners, url=url, modified_at=record["modified_at"], **data
+    )
     response.status = 204
 
 
@@ -213,7 +226,7 @@ async def resend_objectifs_receipt(request, response, siren, year):
     if not owners:  # Staff member
         owners = request["email"]
     data = record.data
-    emails.objectives.send(owners, **data)
+    await emails.objectives.send(owners, **data)
     response.status = 204
 
 
@@ -263,7 +276,7 @@ async def start_simulation(request, response):
     uid = await db.simulation.create(request.json)
     response.json = {"id": uid}
     if email:
-        emails.permalink.send(email, id=uid)
+        await emails.permalink.send(email, id=uid)
     response.status = 200
 
 
@@ -276,7 +289,7 @@ async def send_simulation_code(request, response, uuid):
     response.status = 204
     if not email:
         raise HttpError(400, "Missing `email` key")
-    emails.permalink.send(email, id=uuid)
+    await emails.permalink.send(email, id=uuid)
 
 
 @app.route("/simulation/{uuid}")
@@ -320,7 +333,7 @@ async def send_token(request, response):
         if "localhost" in link or "127.0.0.1" in link:
             print(link)
         body = emails.ACCESS_GRANTED.format(link=link)
-        emails.send(email, "Validation de l'email", body)
+        await emails.send(email, "Validation de l'email", body)
         response.status = 204
 
 
@@ -341,23 +354,32 @@ async def search(request, response):
     q = request.query.get("q", "").strip()
     limit = request.query.int("limit", 10)
     offset = request.query.int("offset", 0)
+    cursor = request.query.get("cursor", None)
+    fields = request.query.list("fields", None)
     section_naf = request.query.get("section_naf", None)
     departement = request.query.get("departement", None)
     region = request.query.get("region", None)
-    results = await db.search.run(
+    if fields:
+        # Allow both `fields=a,b` and `fields=a&fields=b`.
+        fields = tuple(f for value in fields for f in value.split(",") if f)
+    response.json = await search_source().page(
         query=q,
         limit=limit,
         offset=offset,
+        cursor=cursor,
+        fields=fields,
         section_naf=section_naf,
         departement=departement,
         region=region,
     )
-    response.json = {
-        "data": results,
-        "count": await db.search.count(
-            query=q, section_naf=section_naf, departement=departement, region=region
-        ),
-    }
+
+
+@app.route("/search/suggest")
+async def suggest(request, response):
+    q = request.query.get("q", "").strip()
+    limit = request.query.int("limit", config.SUGGEST_LIMIT)
+    limit = max(1, min(limit, config.SUGGEST_LIMIT))
+    response.json = {"data": await db.search.suggest(q, limit)}
 
 
 @app.route("/stats")
@@ -366,13 +388,51 @@ async def stats(request, response):
     departement = request.query.get("departement", None)
     region = request.query.get("region", None)
     year = request.query.int("year", constants.PUBLIC_YEARS[-1])
-    stats = await db.search.stats(
+    stats = await search_source().stats(
         year,
         section_naf=section_naf,
         departement=departement,
         region=region,
     )
-    response.json = dict(stats)
+    stats = dict(stats)
+    refreshed_at = stats.pop("refreshed_at", None)
+    if refreshed_at:
+        response.headers["Last-Modified"] = format_datetime(refreshed_at, usegmt=True)
+    response.json = stats
+
+
+@app.route("/export/public.{format}")
+async def export_public(request, response, format):
+    content_types = {
+        "csv": "text/csv; charset=utf-8",
+        "jsonl": "application/x-ndjson; charset=utf-8",
+    }
+    if format not in content_types:
+        raise HttpError(404, f"Format inconnu: {format}")
+    version = await db.declaration.public_version()
+    modified_at = version["modified_at"]
+    if modified_at:
+        response.headers["Last-Modified"] = format_datetime(modified_at, usegmt=True)
+        modified_at = modified_at.timestamp()
+    # Weak, as the compressed representations may vary.
+    etag = f'W/"{format}-{modified_at or 0}-{version["count"]}"'
+    response.headers["ETag"] = etag
+    response.headers["Vary"] = "Accept-Encoding"
+    matches = request.headers.get("IF-NONE-MATCH", "").split(",")
+    if {m.strip() for m in matches} & {etag, etag[2:], "*"}:
+        response.status = 304
+        return
+    compress = utils.accepts_encoding(
+        request.headers.get("ACCEPT-ENCODING", ""), "gzip"
+    )
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Content-Type"] = content_types[format]
+    snapshot = await exporter.public_snapshot(
+        format, f"{modified_at or 0}-{version['count']}"
+    )
+    # Async iterable body: roll sends it with chunked transfer encoding.
+    response.body = exporter.file_chunks(snapshot, decompress=not compress)
 
 
 @app.route("/config")
@@ -404,6 +464,8 @@ async def validate_siren(request, response):
         raise HttpError(422, f"Numéro SIREN invalide: {siren}")
     try:
         metadata = await helpers.get_entreprise_details(siren)
+    except helpers.UpstreamError as err:
+        raise HttpError(503, str(err))
     except ValueError as err:
         raise HttpError(404, str(err))
     response.json = metadata
@@ -416,19 +478,53 @@ async def get_entreprise_data(request, response, siren):
     response.json = data["entreprise"]
 
 
+def search_source():
+    """The in-memory replica of the search data when available, else the DB."""
+    return replica.index if replica.index is not None else db.search
+
+
+async def sync_search():
+    while True:
+        await asyncio.sleep(config.SEARCH_SYNC_INTERVAL)
+        try:
+            count = await db.search.sync()
+        except Exception as err:
+            loggers.logger.error(f"Cannot sync search index: {err}")
+        else:
+            if count:
+                loggers.logger.info(f"Reindexed {count} déclarations")
+
+
 @app.listen("startup")
 async def on_startup():
     await init()
+    if config.SEARCH_SYNC_INTERVAL:
+        app["search_sync"] = asyncio.ensure_future(sync_search())
+    if config.SEARCH_REPLICA:
+        await replica.init()
+        app["search_replica"] = asyncio.ensure_future(replica.worker())
+    if config.SEND_EMAILS:
+        app["outbox"] = asyncio.ensure_future(emails.outbox.worker())
 
 
 @app.listen("shutdown")
 async def on_shutdown():
+    for name in ("search_sync", "search_replica", "outbox"):
+        task = app.pop(name, None)
+        if task:
+            task.cancel()
+    await helpers.terminate()
+    replica.terminate()
+    pdf.terminate()
     await db.terminate()
 
 
 async def init():
     config.init()
     loggers.init()
+    cache.init()
+    helpers.init()
+    pdf.init()
     try:
         await db.init()
     except RuntimeError as err:
@@ -0,0 +1,193 @@
+"""Minimal XLSX writer, streaming rows to a file object as they arrive.
+
+Only the subset needed by our exports is supported: several sheets, values
+being strings, numbers, booleans, dates and datetimes. The output file object
+does not need to be seekable, so it can be a pipe or an HTTP response.
+"""
+
+import shutil
+import zipfile
+from datetime import date, datetime, timezone
+from tempfile import SpooledTemporaryFile
+from xml.sax.saxutils import escape, quoteattr
+
+from openpyxl.utils import get_column_letter
+
+EPOCH = datetime(1899, 12, 30)
+DATE_STYLE = 1
+DATETIME_STYLE = 2
+SPOOL_SIZE = 10 * 1024 * 1024
+
+MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+RELS = "http://schemas.openxmlformats.org/package/2006/relationships"
+DOC_RELS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml"
+
+STYLES = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="{MAIN}">
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill>\
+<fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>\
+</cellStyleXfs>
+<cellXfs count="3">\
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>\
+<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>\
+<xf numFmtId="22" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>\
+</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>"""
+
+
+def to_excel(value):
+    """Excel stores dates as a number of days since its epoch."""
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    elif value.tzinfo is not None:
+        # Excel has no notion of timezone: write aware datetimes as UTC.
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = value - EPOCH
+    return delta.days + delta.seconds / 86400 + delta.microseconds / 86400e6
+
+
+def cell(ref, value):
+    if isinstance(value, bool):
+        return f'<c r="{ref}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}" t="n"><v>{value!r}</v></c>'
+    if isinstance(value, datetime):
+        return f'<c r="{ref}" s="{DATETIME_STYLE}"><v>{to_excel(value)!r}</v></c>'
+    if isinstance(value, date):
+        return f'<c r="{ref}" s="{DATE_STYLE}"><v>{to_excel(value)!r}</v></c>'
+    value = escape(str(value))
+    return (
+        f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{value}</t></is></c>'
+    )
+
+
+class Worksheet:
+    def __init__(self, title, stream):
+        self.title = title
+        self.stream = stream
+        self.letters = []
+        self.rows = 0
+        self.stream.write(
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<worksheet xmlns="{MAIN}"><sheetData>'.encode()
+        )
+
+    def append(self, values):
+        self.rows += 1
+        cells = []
+        for idx, value in enumerate(values):
+            if value is None:
+                continue
+            if idx >= len(self.letters):
+                self.letters.extend(
+                    get_column_letter(i + 1) for i in range(len(self.letters), idx + 1)
+                )
+            cells.append(cell(f"{self.letters[idx]}{self.rows}", value))
+        self.stream.write(f'<row r="{self.rows}">{"".join(cells)}</row>'.encode())
+
+    def close(self):
+        self.stream.write(b"</sheetData></worksheet>")
+
+
+class Workbook:
+    """Write only workbook, API compatible with openpyxl's write only mode.
+
+    A zip archive can only receive one member at a time, so the first sheet is
+    compressed into the output as rows arrive, while the other ones are spooled
+    to temporary files and copied in when closing.
+    """
+
+    def __init__(self, fileobj):
+        self.archive = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED)
+        self.worksheets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def create_sheet(self, title=None):
+        title = title or f"Sheet{len(self.worksheets) + 1}"
+        if self.worksheets:
+            stream = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        else:
+            stream = self.archive.open(self.path(0), "w", force_zip64=True)
+        sheet = Worksheet(title, stream)
+        self.worksheets.append(sheet)
+        return sheet
+
+    def path(self, index):
+        return f"xl/worksheets/sheet{index + 1}.xml"
+
+    def close(self):
+        for index, sheet in enumerate(self.worksheets):
+            sheet.close()
+            if index:
+                sheet.stream.seek(0)
+                with self.archive.open(self.path(index), "w", force_zip64=True) as f:
+                    shutil.copyfileobj(sheet.stream, f)
+            sheet.stream.close()
+        self.archive.writestr("[Content_Types].xml", self.content_types())
+        self.archive.writestr(
+            "_rels/.rels",
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<Relationships xmlns="{RELS}"><Relationship Id="rId1" '
+            f'Type="{DOC_RELS}/officeDocument" Target="xl/workbook.xml"/>'
+            "</Relationships>",
+        )
+        self.archive.writestr("xl/workbook.xml", self.workbook())
+        self.archive.writestr("xl/_rels/workbook.xml.rels", self.workbook_rels())
+        self.archive.writestr("xl/styles.xml", STYLES)
+        self.archive.close()
+
+    def content_types(self):
+        sheets = "".join(
+            f'<Override PartName="/{self.path(i)}" '
+            f'ContentType="{CONTENT_TYPE}.worksheet+xml"/>'
+            for i in range(len(self.worksheets))
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+            'content-types">'
+            '<Default Extension="rels" '
+            'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            f'ContentType="{CONTENT_TYPE}.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" '
+            f'ContentType="{CONTENT_TYPE}.styles+xml"/>'
+            f"{sheets}</Types>"
+        )
+
+    def workbook(self):
+        sheets = "".join(
+            f'<sheet name={quoteattr(s.title)} sheetId="{i + 1}" r:id="rId{i + 1}"/>'
+            for i, s in enumerate(self.worksheets)
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<workbook xmlns="{MAIN}" xmlns:r="{DOC_RELS}">'
+            f"<sheets>{sheets}</sheets></workbook>"
+        )
+
+    def workbook_rels(self):
+        rels = [
+            f'<Relationship Id="rId{i + 1}" Type="{DOC_RELS}/worksheet" '
+            f'Target="worksheets/sheet{i + 1}.xml"/>'
+            for i in range(len(self.worksheets))
+        ]
+        rels.append(
+            f'<Relationship Id="rId{len(rels) + 1}" Type="{DOC_RELS}/styles" '
+            'Target="styles.xml"/>'
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<Relationships xmlns="{RELS}">{"".join(rels)}</Relationships>'
+        )
@@ -1,10 +1,11 @@
+import gzip
 import json
 from datetime import datetime, timezone
 from unittest import mock
 
 import pytest
 
-from egapro import db
+from egapro import db, exporter
 
 pytestmark = pytest.mark.asyncio
 
@@ -12,7 +13,7 @@ pytestmark = pytest.mark.asyncio
 async def test_request_token(client, monkeypatch):
     calls = 0
 
-    def mock_send(to, subject, body):
+    async def mock_send(to, subject, body):
         assert to == "foo@bar.org"
         assert "https://mycustomurl.org/declaration/token/" in body
         nonlocal calls
@@ -34,7 +35,7 @@ async def test_request_token(client, monkeypatch):
 async def test_request_token_with_allowed_ips(client, monkeypatch):
     calls = 0
 
-    def mock_send(to, subject, body):
+    async def mock_send(to, subject, body):
         nonlocal calls
         calls += 1
 
@@ -95,6 +96,54 @@ async def test_search_endpoint(client):
     resp = await client.get("/search")
     assert resp.status == 200
     assert len(json.loads(resp.body)["data"]) == 1
+    resp = await client.get("/search?limit=1")
+    cursor = json.loads(resp.body)["next"]
+    resp = await client.get(f"/search?limit=1&cursor={cursor}")
+    assert resp.status == 200
+    assert json.loads(resp.body) == {"data": [], "count": 1}
+    resp = await client.get("/search?cursor=invalid")
+    assert resp.status == 422
+    # Naive datetime.
+    naive = db.search.encode_cursor(datetime(2020, 1, 1), "123456782")
+    resp = await client.get(f"/search?cursor={naive}")
+    assert resp.status == 422
+    resp = await client.get("/search?fields=label,notes")
+    assert resp.status == 200
+    assert json.loads(resp.body)["data"] == [
+        {"label": "Bio c Bon", "notes": {"2020": 95}}
+    ]
+    resp = await client.get("/search?fields=label&fields=entreprise")
+    assert resp.status == 200
+    assert list(json.loads(resp.body)["data"][0]) == ["label", "entreprise"]
+    resp = await client.get("/search?fields=data")
+    assert resp.status == 422
+
+
+async def test_search_suggest_endpoint(client, declaration, monkeypatch):
+    monkeypatch.setattr("egapro.config.SUGGEST_LIMIT", 2)
+    for idx in range(3):
+        await declaration(
+            f"12345678{idx}",
+            year=2019,
+            company=f"Bio c Bon {idx}",
+            entreprise={"effectif": {"tranche": "1000:"}},
+        )
+    resp = await client.get("/search/suggest?q=bio+bon&limit=50")
+    assert resp.status == 200
+    assert json.loads(resp.body) == {
+        "data": [
+            {"siren": "123456780", "raison_sociale": "Bio c Bon 0"},
+            {"siren": "123456781", "raison_sociale": "Bio c Bon 1"},
+        ]
+    }
+    resp = await client.get("/search/suggest?q=bio+bon&limit=-1")
+    assert resp.status == 200
+    assert json.loads(resp.body) == {
+        "data": [{"siren": "123456780", "raison_sociale": "Bio c Bon 0"}]
+    }
+    resp = await client.get("/search/suggest?q=bi")
+    assert resp.status == 200
+    assert json.loads(resp.body) == {"data": []}
 
 
 async def test_stats_endpoint(client):
@@ -130,6 +179,7 @@ async def test_stats_endpoint(client):
     assert resp.status == 200
     assert json.loads(resp.body) == {
         "count": 2,
+        "year_count": 2,
         "max": 95,
         "min": 93,
         "avg": 94,
@@ -138,10 +188,151 @@ async def test_stats_endpoint(client):
     assert resp.status == 200
     assert json.loads(resp.body) == {
         "count": 1,
+        "year_count": 1,
         "max": 93,
         "min": 93,
         "avg": 93,
     }
+    assert "Last-Modified" in resp.headers
+    resp = await client.get("/stats?year=2020")
+    assert resp.status == 200
+    assert json.loads(resp.body) == {
+        # Companies having declared on any year.
+        "count": 2,
+        "year_count": 0,
+        "max": None,
+        "min": None,
+        "avg": None,
+    }
+    assert "Last-Modified" not in resp.headers
+
+
+async def test_stats_follow_declaration_moves(client):
+    data = {
+        "déclaration": {"index": 95, "année_indicateurs": 2021},
+        "id": "12345678-1234-5678-9012-123456789013",
+        "entreprise": {
+            "raison_sociale": "Bio c Bon",
+            "effectif": {"tranche": "1000:"},
+            "département": "12",
+        },
+    }
+    await db.declaration.put("12345671", 2021, "foo@bar.org", data)
+    data["entreprise"]["département"] = "11"
+    await db.declaration.put("12345671", 2021, "foo@bar.org", data)
+    resp = await client.get("/stats?departement=12")
+    assert json.loads(resp.body)["count"] == 0
+    resp = await client.get("/stats?departement=11")
+    assert json.loads(resp.body)["count"] == 1
+    await db.declaration.delete("12345671", 2021)
+    resp = await client.get("/stats")
+    assert json.loads(resp.body)["count"] == 0
+
+
+def read_chunked(client):
+    """Decode the raw chunked body written by the last request."""
+    raw = client.protocol.transport.data.split(b"\r\n\r\n", 1)[1]
+    body = b""
+    while True:
+        size, raw = raw.split(b"\r\n", 1)
+        size = int(size, 16)
+        if not size:
+            return body
+        body += raw[:size]
+        raw = raw[size + 2 :]
+
+
+async def test_export_public_endpoint(client, monkeypatch, tmp_path):
+    monkeypatch.setattr("egapro.config.CACHE_PATH", str(tmp_path / "cache"))
+    for siren, name in [("12345671", "Bio c Bon"), ("12345672", "Karambar")]:
+        await db.declaration.put(
+            siren,
+            2020,
+            "foo@bar.org",
+            {
+                "déclaration": {"index": 95, "année_indicateurs": 2020},
+                "id": "12345678-1234-5678-9012-123456789013",
+                "entreprise": {
+                    "raison_sociale": name,
+                    "effectif": {"tranche": "1000:"},
+                    "région": "11",
+                },
+            },
+        )
+    resp = await client.get("/export/public.csv")
+    assert resp.status == 200
+    assert resp.headers["Content-Type"] == "text/csv; charset=utf-8"
+    assert resp.headers["Transfer-Encoding"] == "chunked"
+    assert "Content-Encoding" not in resp.headers
+    lines = read_chunked(client).decode().splitlines()
+    assert lines[0].startswith("Raison Sociale;SIREN;Année;Note;")
+    assert sorted(lines[1:]) == [
+        "Bio c Bon;12345671;2020;95;Entreprise;;;Île-de-France;;FRANCE",
+        "Karambar;12345672;2020;95;Entreprise;;;Île-de-France;;FRANCE",
+    ]
+    etag = resp.headers["ETag"]
+    (snapshot,) = (tmp_path / "cache-export").iterdir()
+    # Served from the snapshot while the data does not change.
+    with monkeypatch.context() as m:
+        m.setattr("egapro.exporter.public_chunks", None)
+        resp = await client.get("/export/public.csv")
+        assert resp.status == 200
+        assert read_chunked(client).decode().splitlines() == lines
+
+    resp = await client.get(
+        "/export/public.jsonl", headers={"Accept-Encoding": "gzip, deflate"}
+    )
+    assert resp.status == 200
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.headers["Vary"] == "Accept-Encoding"
+    rows = [json.loads(r) for r in gzip.decompress(read_chunked(client)).splitlines()]
+    assert sorted(r["SIREN"] for r in rows) == ["12345671", "12345672"]
+    assert rows[0]["Région"] == "Île-de-France"
+    assert resp.headers["ETag"] != etag
+
+    resp = await client.get("/export/public.csv", headers={"If-None-Match": etag})
+    assert resp.status == 304
+    assert resp.headers["ETag"] == etag
+    await db.declaration.delete("12345671", 2020)
+    resp = await client.get("/export/public.csv", headers={"If-None-Match": etag})
+    assert resp.status == 200
+    assert resp.headers["ETag"] != etag
+    read_chunked(client)
+    # Replaced by the new one.
+    assert snapshot not in (tmp_path / "cache-export").iterdir()
+
+    resp = await client.get("/export/public.xml")
+    assert resp.status == 404
+
+
+async def test_export_public_polls_do_not_hit_the_db(client, monkeypatch, tmp_path):
+    monkeypatch.setattr("egapro.config.CACHE_PATH", str(tmp_path / "cache"))
+    resp = await client.get(
+        "/export/public.csv", headers={"Accept-Encoding": "gzip;q=0"}
+    )
+    assert resp.status == 200
+    assert "Content-Encoding" not in resp.headers
+    etag = resp.headers["ETag"]
+
+    async def fetchrow(*args):
+        raise AssertionError("Not cached")
+
+    monkeypatch.setattr(db.declaration, "fetchrow", fetchrow)
+    resp = await client.get("/export/public.csv", headers={"If-None-Match": etag})
+    assert resp.status == 304
+
+
+async def test_export_public_snapshot_failure(monkeypatch, tmp_path):
+    monkeypatch.setattr("egapro.config.CACHE_PATH", str(tmp_path / "cache"))
+
+    async def public_chunks(*args, **kwargs):
+        yield b"partial"
+        raise ValueError("Broken")
+
+    monkeypatch.setattr("egapro.exporter.public_chunks", public_chunks)
+    with pytest.raises(ValueError):
+        await exporter.public_snapshot("csv", "1-1")
+    assert list((tmp_path / "cache-export").iterdir()) == []
 
 
 async def test_config_endpoint(client):
@@ -275,7 +466,7 @@ async def test_me_for_staff(client, declaration, monkeypatch):
 
 
 async def test_resend_receipt_endpoint(client, monkeypatch, declaration):
-    sender = mock.Mock()
+    sender = mock.AsyncMock()
     await db.ownership.put("514027945", "foo@bar.org")
     # Add another owner, that should be in the email recipients
     await db.ownership.put("514027945", "foo@foo.foo")
@@ -301,7 +492,7 @@ async def test_resend_receipt_endpoint(client, monkeypatch, declaration):
 
 
 async def test_resend_receipt_endpoint_by_staff(client, monkeypatch, declaration):
-    sender = mock.Mock()
+    sender = mock.AsyncMock()
     await db.ownership.put("514027945", "foo@bar.org")
     # Add another owner, that should be in the email recipients
     await db.ownership.put("514027945", "foo@foo.foo")
@@ -329,7 +520,7 @@ async def test_resend_receipt_endpoint_by_staff(client, monkeypatch, declaration
 
 
 async def test_resend_receipt_endpoint_by_non_owner(client, monkeypatch, declaration):
-    sender = mock.Mock()
+    sender = mock.AsyncMock()
     await db.ownership.put("514027945", "foo@bar.org")
     # Add another owner, that should be in the email recipients
     await db.ownership.put("514027945", "foo@foo.foo")
@@ -351,7 +542,7 @@ async def test_resend_receipt_endpoint_by_non_owner(client, monkeypatch, declara
 
 
 async def test_resend_receipt_endpoint_with_unknown_declaration(client, monkeypatch):
-    sender = mock.Mock()
+    sender = mock.AsyncMock()
     await db.ownership.put("514027945", "foo@bar.org")
     monkeypatch.setattr("egapro.emails.send", sender)
     resp = await client.post("/declaration/514027945/2019/receipt")
@@ -455,7 +455,7 @@ async def test_declaring_twice_should_not_duplicate(client, app, body):
 
 
 async def test_confirmed_declaration_should_send_email(client, monkeypatch, body):
-    sender = mock.Mock()
+    sender = mock.AsyncMock()
     del body["id"]
     await db.ownership.put("514027945", "foo@bar.org")
     # Add another owner, that should be in the email recipients
@@ -481,7 +481,7 @@ async def test_confirmed_declaration_should_send_email(client, monkeypatch, body
 async def test_confirmed_declaration_should_send_email_for_legacy_call(
     client, monkeypatch, body
 ):
-    sender = mock.Mock()
+    sender = mock.AsyncMock()
     id = "1234"
     body["source"] = "simulateur"
     body["déclaration"]["brouillon"] = True
@@ -6,7 +6,7 @@ from roll.testing import Client as BaseClient
 
 from egapro.views import app as egapro_app
 from egapro import config as egapro_config
-from egapro import db, helpers, models, tokens
+from egapro import cache, db, helpers, models, tokens
 
 
 def pytest_configure(config):
@@ -23,6 +23,11 @@ def pytest_configure(config):
             await conn.execute("DROP TABLE IF EXISTS search")
             await conn.execute("DROP TABLE IF EXISTS archive")
             await conn.execute("DROP TABLE IF EXISTS ownership")
+            await conn.execute("DROP TABLE IF EXISTS watermark")
+            await conn.execute("DROP TABLE IF EXISTS stats")
+            await conn.execute("DROP TABLE IF EXISTS outbox")
+            await conn.execute("DROP TABLE IF EXISTS entreprise")
+            await conn.execute("DROP TABLE IF EXISTS tombstone")
         await db.init()
 
     asyncio.run(configure())
@@ -43,13 +48,25 @@ def pytest_runtest_setup(item):
             await conn.execute("TRUNCATE TABLE search;")
             await conn.execute("TRUNCATE TABLE archive;")
             await conn.execute("TRUNCATE TABLE ownership;")
+            await conn.execute("TRUNCATE TABLE watermark;")
+            await conn.execute("TRUNCATE TABLE stats;")
+            await conn.execute("TRUNCATE TABLE outbox;")
+            await conn.execute("TRUNCATE TABLE entreprise;")
+            await conn.execute("TRUNCATE TABLE tombstone;")
         await db.terminate()
 
-        helpers.get_entreprise_details.cache_clear()
+        cache.clear()
 
     asyncio.run(setup())
 
 
+@pytest.fixture
+async def init_db():
+    await db.init()
+    yield
+    await db.terminate()
+
+
 @pytest.fixture
 def app():  # Requested by Roll testing utilities.
     return egapro_app
@@ -0,0 +1,109 @@
+import time
+
+import pytest
+
+from egapro import cache
+
+
+@pytest.fixture(params=["memory", "file"])
+def backend(request, tmp_path):
+    if request.param == "file":
+        return cache.FileCache(ttl=60, maxsize=2, path=tmp_path)
+    return cache.MemoryCache(ttl=60, maxsize=2)
+
+
+def test_get_and_set(backend):
+    assert backend.get("foo") is cache.MISSING
+    backend.set("foo", {"bar": [1, 2]})
+    assert backend.get("foo") == {"bar": [1, 2]}
+    assert backend.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+
+def test_ttl(backend, monkeypatch):
+    backend.set("foo", "bar")
+    now = time.time() + 61
+    monotonic = time.monotonic() + 61
+    monkeypatch.setattr("time.time", lambda: now)
+    monkeypatch.setattr("time.monotonic", lambda: monotonic)
+    assert backend.get("foo") is cache.MISSING
+
+
+def test_maxsize(backend):
+    backend.set("one", 1)
+    time.sleep(0.01)  # Make sure file mtimes differ.
+    backend.set("two", 2)
+    time.sleep(0.01)
+    backend.set("three", 3)
+    assert backend.get("one") is cache.MISSING
+    assert backend.get("two") == 2
+    assert backend.get("three") == 3
+
+
+def test_clear(backend):
+    backend.set("foo", "bar")
+    backend.clear()
+    assert backend.get("foo") is cache.MISSING
+
+
+def test_file_cache_skips_files_being_written(tmp_path, monkeypatch):
+    backend = cache.FileCache(path=tmp_path)
+    backend.set("foo", "bar")
+    tmp = (tmp_path / "being-written").with_suffix(".1234")
+    tmp.write_bytes(b"")
+    assert backend.stats()["size"] == 1
+    backend.clear()
+    assert tmp.exists()
+    assert backend.stats()["size"] == 0
+
+    # Cleared by another worker while being written.
+    replace = cache.Path.replace
+
+    def cleared(self, target):
+        self.unlink()
+        return replace(self, target)
+
+    monkeypatch.setattr(cache.Path, "replace", cleared)
+    backend.set("foo", "bar")
+    assert backend.get("foo") is cache.MISSING
+
+
+def test_file_cache_is_shared(tmp_path):
+    one = cache.FileCache(path=tmp_path)
+    other = cache.FileCache(path=tmp_path)
+    one.set("foo", "bar")
+    assert other.get("foo") == "bar"
+    other.clear()
+    assert one.get("foo") is cache.MISSING
+
+
+@pytest.mark.asyncio
+async def test_cached(monkeypatch):
+    monkeypatch.setattr(cache, "backend", cache.MemoryCache())
+    calls = []
+
+    @cache.cached
+    async def func(a, b=None):
+        calls.append((a, b))
+        return a
+
+    assert await func(1, b=2) == 1
+    assert await func(1, b=2) == 1
+    assert await func(2) == 2
+    assert calls == [(1, 2), (2, None)]
+    assert cache.stats() == {"hits": 1, "misses": 2, "size": 2}
+
+
+def test_suggestions_share_the_file_backend(monkeypatch, tmp_path):
+    monkeypatch.setattr("egapro.config.CACHE_BACKEND", "file")
+    monkeypatch.setattr("egapro.config.CACHE_PATH", str(tmp_path / "cache"))
+    monkeypatch.setattr(cache, "backend", None)
+    monkeypatch.setattr(cache, "suggestions", None)
+    cache.init()
+    assert isinstance(cache.suggestions, cache.FileCache)
+    assert cache.suggestions.root != cache.backend.root
+    cache.suggestions.set("foo", "bar")
+    # Another worker sees it, and its invalidation.
+    other = cache.FileCache(path=cache.suggestions.root)
+    assert other.get("foo") == "bar"
+    other.clear()
+    assert cache.suggestions.get("foo") is cache.MISSING
@@ -1,8 +1,10 @@
+import asyncio
 from datetime import datetime, timezone
+from pathlib import Path
 
 import pytest
 
-from egapro import db, utils
+from egapro import cache, db, utils
 
 pytestmark = pytest.mark.asyncio
 
@@ -69,6 +71,114 @@ async def test_declaration_completed():
     assert records[1].data.siren == "12345678"
 
 
+async def test_declaration_iter_completed():
+    for siren in ["12345678", "87654321", "87654331"]:
+        await db.declaration.put(
+            siren,
+            2020,
+            "foo@bar.com",
+            {"déclaration": {"date": utils.utcnow()}},
+        )
+    await db.declaration.put(
+        "87654341",
+        2020,
+        "foo@baz.com",
+        {"déclaration": {"date": utils.utcnow(), "brouillon": True}},
+    )
+
+    records = [r async for r in db.declaration.iter_completed(prefetch=2)]
+    assert [r.data.siren for r in records] == ["87654331", "87654321", "12345678"]
+    records = [r async for r in db.declaration.iter_completed(limit=1)]
+    assert [r.data.siren for r in records] == ["87654331"]
+    assert await db.declaration.count_completed() == 3
+
+
+async def test_declaration_typed_columns():
+    data = {
+        "déclaration": {"date": utils.utcnow().isoformat(), "index": 85},
+        "entreprise": {"effectif": {"tranche": "50:250"}},
+        "indicateurs": {
+            "rémunérations": {"note": 36, "catégories": [{}, {}, {}]},
+            "congés_maternité": {"note": 15},
+        },
+    }
+    await db.declaration.put("12345678", 2020, "foo@bar.com", data)
+    record = await db.declaration.fetchrow(
+        "SELECT * FROM declaration WHERE siren=$1", "12345678"
+    )
+    assert record["note"] == 85
+    assert record["note_remunerations"] == 36
+    assert record["note_conges_maternite"] == 15
+    assert record["note_promotions"] is None
+    assert record["tranche"] == "50:250"
+    assert record["categories"] == 3
+
+    # Drafts do not override the typed columns of the last complete version.
+    data["déclaration"]["index"] = 90
+    data["déclaration"]["brouillon"] = True
+    await db.declaration.put("12345678", 2020, "foo@bar.com", data)
+    record = await db.declaration.fetchrow(
+        "SELECT * FROM declaration WHERE siren=$1", "12345678"
+    )
+    assert record["note"] == 85
+
+
+async def test_declaration_typed_columns_with_malformed_data():
+    data = {
+        "déclaration": {"date": utils.utcnow().isoformat(), "index": "85"},
+        "indicateurs": {
+            "rémunérations": {"note": 35.6, "catégories": None},
+            "augmentations": {"note": {}},
+            "promotions": {"note": 1e12},
+            "congés_maternité": "nc",
+        },
+    }
+    await db.declaration.put("12345678", 2020, "foo@bar.com", data)
+    record = await db.declaration.fetchrow(
+        "SELECT * FROM declaration WHERE siren=$1", "12345678"
+    )
+    assert record["note"] is None
+    assert record["note_remunerations"] == 36
+    assert record["note_augmentations"] is None
+    assert record["note_promotions"] is None
+    assert record["note_conges_maternite"] is None
+    assert record["categories"] is None
+
+
+async def test_backfill_typed_columns_migration():
+    await db.declaration.put(
+        "12345678",
+        2020,
+        "foo@bar.com",
+        {
+            "déclaration": {"date": utils.utcnow().isoformat(), "index": 85},
+            "indicateurs": {"rémunérations": {"catégories": [{}, {}]}},
+        },
+    )
+    await db.declaration.put(
+        "12345679",
+        2020,
+        "foo@bar.com",
+        {
+            "déclaration": {"date": utils.utcnow().isoformat(), "index": "nc"},
+            "indicateurs": {"rémunérations": {"catégories": 3}},
+        },
+    )
+    await db.declaration.execute("UPDATE declaration SET note=NULL, categories=NULL")
+    await db.table.execute(
+        (
+            Path(db.__file__).parent / "migrations/026_backfill_typed_columns.sql"
+        ).read_text()
+    )
+    rows = await db.declaration.fetch(
+        "SELECT siren, note, categories FROM declaration ORDER BY siren"
+    )
+    assert [tuple(row) for row in rows] == [
+        ("12345678", 85, 2),
+        ("12345679", None, None),
+    ]
+
+
 async def test_declaration_data():
     now = utils.utcnow().isoformat()
     await db.declaration.put(
@@ -181,3 +291,93 @@ async def test_declaration_owned():
             "year": 2019,
         },
     ]
+
+
+async def test_transaction_uses_a_single_connection():
+    async with db.table.transaction() as conn:
+        await db.declaration.put(
+            "123456782", 2020, "foo@bar.com", {"entreprise": {"raison_sociale": "Foo"}}
+        )
+        await db.ownership.put("123456782", "foo@bar.com")
+        async with db.ownership.acquire() as other:
+            assert other is conn
+    assert await db.ownership.emails("123456782") == ["foo@bar.com"]
+    assert (await db.declaration.get("123456782", 2020)).data.company == "Foo"
+
+
+async def test_transaction_is_rolled_back_on_error():
+    with pytest.raises(ValueError):
+        async with db.table.transaction():
+            await db.declaration.put("123456782", 2020, "foo@bar.com", {})
+            await db.ownership.put("123456782", "foo@bar.com")
+            raise ValueError("Oops")
+    assert await db.ownership.emails("123456782") == []
+    with pytest.raises(db.NoData):
+        await db.declaration.get("123456782", 2020)
+
+
+async def test_cache_is_cleared_after_commit(declaration):
+    await declaration("123456782", year=2019, company="Foo Bar")
+    async with db.table.transaction():
+        await db.declaration.delete("123456782", 2019)
+        # A concurrent reader still sees the committed state, and caches it.
+        cache.backend.set("key", "stale")
+        assert cache.backend.get("key") == "stale"
+        async with db.table.transaction():
+            await declaration("123456783", year=2019, company="Foo Baz")
+        assert cache.backend.get("key") == "stale"
+    assert cache.backend.get("key") is cache.MISSING
+    cache.backend.set("key", "value")
+    with pytest.raises(ValueError):
+        async with db.table.transaction():
+            await db.declaration.delete("123456783", 2019)
+            raise ValueError("Oops")
+    assert cache.backend.get("key") == "value"
+
+
+async def test_stats_updates_match_a_full_refresh(declaration):
+    async def snapshot():
+        rows = await db.stats.fetch(
+            "SELECT year, region, departement, section_naf, count, notes, total, "
+            "min, max FROM stats WHERE count > 0 ORDER BY 1, 2, 3, 4"
+        )
+        return [tuple(row) for row in rows]
+
+    await declaration("123456781", year=2020, grade=80, departement="26")
+    await declaration("123456782", year=2020, grade=90, departement="26")
+    await declaration("123456783", year=2020, grade=70, departement="26")
+    await declaration("123456784", year=2020, grade=None, departement="26")
+    await declaration("123456785", year=2021, grade=60, departement="07")
+    # Max of its group is removed.
+    await declaration("123456782", year=2020, grade=85, departement="26")
+    # Neither min nor max.
+    await declaration("123456781", year=2020, grade=75, departement="26")
+    # Moves to another group.
+    await declaration("123456783", year=2020, grade=70, departement="07")
+    await db.declaration.delete("123456785", 2021)
+    await db.declaration.delete("123456784", 2020)
+    incremental = await snapshot()
+    assert (2020, "84", "26", "", 2, 2, 160, 75, 85) in incremental
+    await db.stats.refresh()
+    assert await snapshot() == incremental
+
+
+async def test_concurrent_writes_create_a_stats_group_once(declaration):
+    created = asyncio.Event()
+
+    async def first():
+        async with db.table.transaction():
+            await declaration("123456781", year=2020, grade=80, departement="26")
+            created.set()
+            # Let the second one try to create the same group meanwhile.
+            await asyncio.sleep(0.2)
+
+    async def second():
+        await created.wait()
+        await declaration("123456782", year=2020, grade=90, departement="26")
+
+    await asyncio.gather(first(), second())
+    row = await db.stats.fetchrow(
+        "SELECT count, total FROM stats WHERE year=2020 AND departement='26'"
+    )
+    assert tuple(row) == (2, 170)
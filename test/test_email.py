@@ -1,7 +1,9 @@
 import datetime
 from pathlib import Path
 
-from egapro import emails, models
+import pytest
+
+from egapro import emails, models, pdf
 from egapro.emails.success import attachment as success_attachment
 
 FAKE_NOW = datetime.datetime(2020, 12, 25, 17, 5, 55)
@@ -348,3 +350,42 @@ def test_success_email_attachment_small_company_non_calculable():
     pdf.set_creation_date(FAKE_NOW)
     # pdf.output("test/data/small_company_nc.pdf")
     assert bytes(pdf.output()) == Path("test/data/small_company_nc.pdf").read_bytes()
+
+
+def test_pdfs_rendered_in_the_same_process_embed_their_own_font_subset():
+    def render(data):
+        pdf, _ = success_attachment(dict(data))
+        pdf.set_creation_date(FAKE_NOW)
+        return bytes(pdf.output())
+
+    big = render(BIG_COMPANY)
+    small = render(SMALL_COMPANY)
+    for blob in (big, small):
+        assert b"/FontFile2" in blob
+        assert b"Marianne" in blob
+    # The fonts shared by the documents are not altered by the previous ones.
+    assert render(BIG_COMPANY) == big
+    assert render(SMALL_COMPANY) == small
+
+
+@pytest.mark.asyncio
+async def test_pdf_render_is_cached_by_modified_at():
+    calls = []
+
+    def attachment(context):
+        calls.append(context)
+        return success_attachment(context)
+
+    context = {**SMALL_COMPANY, "modified_at": FAKE_NOW}
+    blob, filename = await pdf.render(attachment, context)
+    assert blob.startswith(b"%PDF")
+    assert filename == "declaration_514027945_2020.pdf"
+    assert await pdf.render(attachment, context) == (blob, filename)
+    assert len(calls) == 1
+    context["modified_at"] = FAKE_NOW + datetime.timedelta(days=1)
+    await pdf.render(attachment, context)
+    assert len(calls) == 2
+    # No modification date, no cache.
+    del context["modified_at"]
+    await pdf.render(attachment, context)
+    assert len(calls) == 3
@@ -1,11 +1,13 @@
 import io
 import json
-from datetime import date, datetime, timezone
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
 
 import pytest
+from openpyxl import load_workbook
 
-from egapro import db, exporter, dgt
+from egapro import db, exporter, dgt, xlsx
+from egapro.utils import flatten
 
 pytestmark = pytest.mark.asyncio
 
@@ -990,6 +992,93 @@ async def test_dgt_dump_should_list_UES_in_dedicated_sheet(declaration):
     ]
 
 
+async def test_dgt_dump_xlsx_is_streamed(declaration):
+    await declaration(
+        company="Mirabar",
+        siren="87654321",
+        entreprise={
+            "ues": {
+                "nom": "MiraFoo",
+                "entreprises": [{"raison_sociale": "MiraBaz", "siren": "315710251"}],
+            },
+            "effectif": {"tranche": "1000:"},
+        },
+    )
+    await declaration(siren="12345678", year=2020)
+
+    class Pipe(io.RawIOBase):
+        """Non seekable output, like stdout or an HTTP response."""
+
+        def __init__(self):
+            self.chunks = []
+
+        def writable(self):
+            return True
+
+        def write(self, b):
+            self.chunks.append(bytes(b))
+            return len(b)
+
+    out = Pipe()
+    await dgt.dump_xlsx(out)
+    streamed = load_workbook(io.BytesIO(b"".join(out.chunks)))
+    expected = io.BytesIO()
+    (await dgt.as_xlsx(debug=True)).save(expected)
+    expected = load_workbook(expected)
+    assert streamed.sheetnames == expected.sheetnames
+    assert streamed.active.title == "BDD REPONDANTS"
+    for name in expected.sheetnames:
+        assert list(streamed[name].values) == list(expected[name].values)
+    assert isinstance(streamed.active["C2"].value, datetime)
+    assert streamed.active["Q2"].value == datetime(2019, 1, 1)
+
+
+async def test_dgt_rows_prepared_in_pool_keep_order(declaration, monkeypatch):
+    for i in range(5):
+        await declaration(
+            siren=f"1234567{i}",
+            entreprise={
+                "ues": {
+                    "nom": f"UES {i}",
+                    "entreprises": [{"raison_sociale": "Baz", "siren": "315710251"}],
+                },
+                "effectif": {"tranche": "1000:"},
+            },
+        )
+    monkeypatch.setattr("egapro.config.DGT_CHUNK", 2)
+    serial = await dgt.as_xlsx(debug=True, workers=0)
+    pooled = await dgt.as_xlsx(debug=True, workers=2)
+    for name in serial.sheetnames:
+        assert list(pooled[name].values) == list(serial[name].values)
+    assert len(list(pooled["BDD REPONDANTS"].values)) == 6
+    assert len(list(pooled["BDD UES détail entreprises"].values)) == 11
+
+
+async def test_dgt_compiled_row_matches_flatten():
+    record = {
+        "source": "formulaire",
+        "entreprise": {"ues": {"entreprises": [{"siren": "315710251"}]}, "x": {}},
+        "indicateurs": {
+            "rémunérations": {"catégories": [{"tranches": {":29": 1.2}}]},
+            "promotions": {"catégories": [None, 0.1]},
+        },
+    }
+    flat = flatten(record, flatten_lists=True)
+    paths = list(flat) + [
+        "entreprise",
+        "entreprise.x",
+        "entreprise.ues.entreprises.1.siren",
+        "indicateurs.promotions.catégories",
+        "indicateurs.promotions.catégories.2",
+        "source.nope",
+        "nope.nope",
+    ]
+    row = dgt.compile_row([(path, dgt.identity) for path in paths])
+    assert row(record) == [flat.get(path) for path in paths]
+    row = dgt.compile_row([("indicateurs.promotions.catégories.1", str)])
+    assert row(record) == ["0.1"]
+
+
 async def test_export_public_data(declaration):
     await declaration(
         company="Mirabar",
@@ -1279,3 +1368,158 @@ async def test_export_indexes(declaration):
         "87654322;2018;52\r\n"
         "87654321;2019;77\r\n"
     )
+
+
+async def test_export_parquet(declaration, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    await declaration(
+        company="Mirabar",
+        siren="87654321",
+        year=2019,
+        grade=88,
+        entreprise={
+            "code_naf": "47.25Z",
+            "ues": {
+                "nom": "MiraFoo",
+                "entreprises": [{"raison_sociale": "MiraBaz", "siren": "315710251"}],
+            },
+            "effectif": {"tranche": "1000:"},
+        },
+        indicateurs={"promotions": {"note": 15}, "augmentations": {}},
+    )
+    await declaration(company="KaramBar", siren="12345671", year=2020)
+    # Not declared yet, should not be exported.
+    await db.declaration.put(
+        "987654321", 2020, "foo@bar.org", {"déclaration": {"brouillon": True}}
+    )
+    path = tmp_path / "export.parquet"
+    assert await exporter.parquet(path, row_group_size=1) == 2
+    parquet = pq.ParquetFile(path)
+    assert parquet.num_row_groups == 2
+    assert parquet.schema_arrow.field("year").type == "int16"
+    rows = parquet.read().to_pylist()
+    assert rows[0]["siren"] == "87654321"
+    assert rows[0]["year"] == 2019
+    assert rows[0]["note"] == 88
+    assert rows[0]["note_promotions"] == 15
+    assert rows[0]["tranche"] == "1000:"
+    assert rows[0]["code_naf"] == "47.25Z"
+    assert rows[0]["region"] == "84"
+    assert rows[0]["fin_periode_reference"] == date(2019, 12, 31)
+    assert rows[0]["ues_size"] == 2
+    assert rows[1]["siren"] == "12345671"
+    assert rows[1]["ues_size"] is None
+    assert rows[1]["declared_at"].tzinfo is not None
+    # Analytical queries only read the columns they need.
+    table = pq.read_table(path, columns=["siren", "note"])
+    assert table.column_names == ["siren", "note"]
+
+
+async def test_export_parquet_with_malformed_data(declaration, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    await declaration(company="KaramBar", siren="12345671", year=2020)
+    await db.declaration.execute(
+        "UPDATE declaration SET data=jsonb_set(jsonb_set(data, "
+        "'{déclaration,fin_période_référence}', '\"\"'), "
+        "'{entreprise,ues}', '{\"entreprises\": {}}')"
+    )
+    path = tmp_path / "export.parquet"
+    assert await exporter.parquet(path) == 1
+    (row,) = pq.read_table(path).to_pylist()
+    assert row["fin_periode_reference"] is None
+    assert row["ues_size"] is None
+
+
+async def test_delta_export_and_compaction(declaration, tmp_path):
+    before = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    await declaration(siren="12345671", company="Stays", modified_at=before)
+    await declaration(siren="12345672", company="Modified", modified_at=before)
+    await declaration(siren="12345673", company="Deleted", modified_at=before)
+    snapshot = tmp_path / "snapshot.jsonl"
+    with snapshot.open("w") as f:
+        await exporter.full(f)
+
+    since = datetime(2021, 1, 2, tzinfo=timezone.utc)
+    await declaration(siren="12345672", company="Modified again")
+    await declaration(siren="12345674", company="New")
+    await db.declaration.delete("12345673", 2020)
+    # Deleting a missing declaration does not create a tombstone.
+    await db.declaration.delete("12345679", 2020)
+
+    out = io.StringIO()
+    assert await exporter.delta(out, since) == 3
+    changes = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert sorted(c["data"]["entreprise"]["siren"] for c in changes[:2]) == [
+        "12345672",
+        "12345674",
+    ]
+    assert changes[2]["siren"] == "12345673"
+    assert changes[2]["year"] == 2020
+    assert "deleted_at" in changes[2]
+
+    delta = tmp_path / "delta.jsonl"
+    delta.write_text(out.getvalue())
+    compacted = io.StringIO()
+    assert exporter.compact(snapshot, [delta], compacted) == 3
+    expected = io.StringIO()
+    await exporter.full(expected)
+
+    def companies(content):
+        lines = content.splitlines()
+        return sorted(json.loads(s)["entreprise"]["raison_sociale"] for s in lines)
+
+    assert companies(compacted.getvalue()) == ["Modified again", "New", "Stays"]
+    assert companies(compacted.getvalue()) == companies(expected.getvalue())
+
+    # Declaration recreated after its deletion.
+    await declaration(siren="12345673", company="Back")
+    second = tmp_path / "delta2.jsonl"
+    with second.open("w") as f:
+        await exporter.delta(f, since)
+    compacted = io.StringIO()
+    assert exporter.compact(snapshot, [delta, second], compacted) == 4
+    assert "Back" in companies(compacted.getvalue())
+
+
+async def test_delta_csv_and_xlsx_exports(declaration):
+    before = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    await declaration(siren="12345671", company="Stays", modified_at=before)
+    await declaration(siren="12345672", company="Deleted", modified_at=before)
+    since = datetime(2021, 1, 2, tzinfo=timezone.utc)
+    await declaration(
+        siren="12345673",
+        company="New",
+        entreprise={"effectif": {"tranche": "1000:"}},
+    )
+    await db.declaration.delete("12345672", 2020)
+
+    out = io.StringIO()
+    await exporter.public_data(out, since)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith("New;12345673;2020;")
+
+    out = io.StringIO()
+    await exporter.indexes(out, since)
+    assert out.getvalue().splitlines() == ["siren;year;index", "12345673;2020;26"]
+
+    out = io.StringIO()
+    assert await exporter.tombstones(out, since) == 1
+    lines = out.getvalue().splitlines()
+    assert lines[0] == "siren;year;deleted_at"
+    assert lines[1].startswith("12345672;2020;")
+
+    workbook = await dgt.as_xlsx(debug=True, since=since)
+    rows = list(workbook["BDD REPONDANTS"].values)
+    assert len(rows) == 2
+    assert "12345673" in rows[1]
+    deleted = list(workbook["Suppressions"].iter_rows(values_only=True))
+    assert deleted[0] == ("Siren", "Annee_indicateurs", "Date_suppression")
+    assert deleted[1][:2] == ("12345672", 2020)
+
+
+def test_xlsx_datetimes_are_written_as_utc():
+    paris = timezone(timedelta(hours=2))
+    value = datetime(2021, 6, 1, 12, tzinfo=paris)
+    assert xlsx.to_excel(value) == xlsx.to_excel(datetime(2021, 6, 1, 10))
+    assert xlsx.to_excel(date(2021, 6, 1)) == 44348
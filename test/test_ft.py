@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 import pytest
 
@@ -202,6 +202,35 @@ async def test_search_from_ues_member_name(client):
     }
 
 
+@pytest.mark.parametrize(
+    "query,label",
+    [
+        ("foobar", "Réseau Foobar"),
+        ("immobibaz", "Réseau Foobar (Foobar Immobibaz)"),
+        ("agence centrale", "Réseau Foobar (FOOBAR AGENCE CENTRALE)"),
+        ("transaction", "Réseau Foobar (FOOBAR TRANSACTION FRANCE)"),
+        ("réseau", "Réseau Foobar"),
+    ],
+)
+async def test_search_label(declaration, query, label):
+    await declaration(
+        "123456781",
+        year=2019,
+        company="FOOBAR TRANSACTION FRANCE",
+        entreprise={
+            "effectif": {"tranche": "1000:"},
+            "ues": {
+                "nom": "Réseau Foobar",
+                "entreprises": [
+                    {"siren": "123456782", "raison_sociale": "FOOBAR AGENCE CENTRALE"},
+                    {"siren": "123456783", "raison_sociale": "Foobar Immobibaz"},
+                ],
+            },
+        },
+    )
+    assert [r["label"] for r in await db.search.run(query)] == [label]
+
+
 async def test_search_with_filters(client):
     await db.declaration.put(
         "123456781",
@@ -481,3 +510,198 @@ async def test_amp_and_parens_are_excaped(declaration):
     )
     results = await db.search.run(query="zanzi & (bar)")
     assert len(results)
+
+
+async def test_bulk_index(declaration):
+    await declaration(
+        "123456712",
+        year=2019,
+        company="Zanzi Bar",
+        entreprise={"effectif": {"tranche": "1000:"}, "code_naf": "47.25Z"},
+    )
+    await declaration(
+        "987654321",
+        year=2019,
+        company="Sli Bar",
+        entreprise={"effectif": {"tranche": "1000:"}},
+    )
+    await declaration(
+        "123456782",
+        year=2017,  # Not public.
+        company="Foo Bar",
+        entreprise={"effectif": {"tranche": "1000:"}},
+    )
+    await db.search.truncate()
+    assert await db.search.count() == 0
+
+    async def records():
+        async for record in db.declaration.iter_completed():
+            yield record.data
+
+    assert await db.search.bulk_index(records()) == 2
+    assert await db.search.count(query="bar") == 2
+    assert await db.search.count(section_naf="G") == 1
+    # Running it again replaces the content.
+    assert await db.search.bulk_index(records()) == 2
+    assert await db.search.count() == 2
+
+
+async def test_sync(declaration):
+    at = datetime(2021, 2, 1, 2, 3, 4, tzinfo=timezone.utc)
+    await declaration(
+        "123456712",
+        year=2019,
+        company="Zanzi Bar",
+        entreprise={"effectif": {"tranche": "1000:"}},
+        modified_at=at,
+    )
+    # No watermark yet.
+    assert await db.search.sync() is None
+    await db.watermark.put("search", at)
+    await db.search.truncate()
+    # Within the safety margin.
+    assert await db.search.sync() == 1
+    assert await db.watermark.get("search") == at
+    await declaration(
+        "987654321",
+        year=2019,
+        company="Sli Bar",
+        entreprise={"effectif": {"tranche": "1000:"}},
+        modified_at=at + timedelta(days=1),
+    )
+    await db.search.truncate()
+    assert await db.search.sync() == 2
+    assert await db.search.count() == 2
+    assert await db.watermark.get("search") == at + timedelta(days=1)
+    await db.search.truncate()
+    assert await db.search.sync() == 1
+    assert await db.search.count() == 1
+    await db.stats.execute("TRUNCATE TABLE stats")
+    assert await db.search.sync(since=at - timedelta(days=1)) == 2
+    assert await db.search.count() == 2
+    # Touched groups are refreshed after the batch.
+    assert (await db.stats.get(2019))["year_count"] == 2
+    # The watermark did not move backwards.
+    assert await db.watermark.get("search") == at + timedelta(days=1)
+    await db.watermark.put("search", at + timedelta(days=3))
+    assert await db.search.sync(since=at + timedelta(days=2)) == 0
+    assert await db.watermark.get("search") == at + timedelta(days=3)
+
+
+async def test_search_cache_is_invalidated_on_write(declaration):
+    await declaration("123456712", year=2019, company="Zanzi Bar")
+    assert len(await db.search.run("bar")) == 1
+    await declaration("987654321", year=2019, company="Sli Bar")
+    assert len(await db.search.run("bar")) == 2
+    await db.declaration.delete("987654321", 2019)
+    assert len(await db.search.run("bar")) == 1
+
+
+async def test_page_returns_total_count(declaration):
+    for siren, company in [
+        ("123456712", "Zanzi Bar"),
+        ("987654321", "Sli Bar"),
+        ("123456782", "Foo Bar"),
+    ]:
+        await declaration(
+            siren,
+            year=2019,
+            company=company,
+            entreprise={"effectif": {"tranche": "1000:"}},
+        )
+    await declaration(
+        "123456782",
+        year=2020,
+        company="Foo Bar",
+        entreprise={"effectif": {"tranche": "1000:"}},
+    )
+    page = await db.search.page("bar", limit=2)
+    assert len(page["data"]) == 2
+    assert page["count"] == 3
+    page = await db.search.page("bar", limit=2, offset=2)
+    assert len(page["data"]) == 1
+    assert page["count"] == 3
+    page = await db.search.page("bar", limit=2, offset=10)
+    assert page == {"data": [], "count": 3}
+    assert await db.search.page("nothing") == {"data": [], "count": 0}
+
+
+async def test_search_keyset_pagination(declaration):
+    for idx in range(5):
+        await declaration(
+            f"12345678{idx}",
+            year=2019,
+            company=f"Foo Bar {idx}",
+            entreprise={"effectif": {"tranche": "1000:"}},
+        )
+    expected = [r["entreprise"]["siren"] for r in await db.search.run("bar")]
+    assert len(expected) == 5
+    sirens = []
+    page = await db.search.page("bar", limit=2)
+    while True:
+        assert page["count"] == 5
+        sirens.extend(r["entreprise"]["siren"] for r in page["data"])
+        if "next" not in page:
+            break
+        page = await db.search.page("bar", limit=2, cursor=page["next"])
+    assert sirens == expected
+    # A full last page has a cursor, leading to an empty page.
+    page = await db.search.page("bar", limit=5)
+    assert await db.search.page("bar", limit=5, cursor=page["next"]) == {
+        "data": [],
+        "count": 5,
+    }
+    with pytest.raises(ValueError):
+        await db.search.page("bar", cursor="nope")
+
+
+async def test_search_suggest(declaration):
+    await declaration(
+        "123456781",
+        year=2019,
+        company="Société Générale",
+        entreprise={"effectif": {"tranche": "1000:"}},
+    )
+    await declaration(
+        "123456782",
+        year=2019,
+        company="Générale 50%",
+        entreprise={"effectif": {"tranche": "1000:"}},
+    )
+    await declaration(
+        "123456783",
+        year=2019,
+        company="Total",
+        entreprise={
+            "effectif": {"tranche": "1000:"},
+            "ues": {
+                "nom": "UES Total",
+                "entreprises": [{"siren": "123456784", "raison_sociale": "Générique"}],
+            },
+        },
+    )
+    # Latest name wins.
+    await declaration(
+        "123456783",
+        year=2020,
+        company="TotalEnergies",
+        entreprise={"effectif": {"tranche": "1000:"}},
+    )
+    assert await db.search.suggest("GENER") == [
+        {"siren": "123456782", "raison_sociale": "Générale 50%"},
+        {"siren": "123456781", "raison_sociale": "Société Générale"},
+        {"siren": "123456783", "raison_sociale": "TotalEnergies"},
+    ]
+    assert await db.search.suggest("générale soc") == [
+        {"siren": "123456781", "raison_sociale": "Société Générale"},
+    ]
+    assert await db.search.suggest("ues tot", limit=1) == [
+        {"siren": "123456783", "raison_sociale": "TotalEnergies"},
+    ]
+    # LIKE wildcards are matched literally.
+    assert await db.search.suggest("50%") == [
+        {"siren": "123456782", "raison_sociale": "Générale 50%"},
+    ]
+    assert await db.search.suggest("e_e") == []
+    # Too short.
+    assert await db.search.suggest(" g ") == []
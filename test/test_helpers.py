@@ -1,6 +1,11 @@
+import asyncio
+from datetime import timedelta
+
+import httpx
 import pytest
 
-from egapro import constants, helpers, models
+from egapro import constants, db, helpers, models, utils
+
 
 RECHERCHE_ENTREPRISE_SAMPLE = {
     "activitePrincipale": "Conseil informatique",
@@ -149,35 +154,6 @@ API_ENTREPRISES_SAMPLE = {
 }
 
 
-@pytest.mark.parametrize(
-    "query,selected,candidates",
-    [
-        (
-            "foobar",
-            "Réseau Foobar",
-            [
-                "Réseau Foobar",
-                "FOOBAR TRANSACTION FRANCE",
-                "FOOBAR AGENCE CENTRALE",
-                "Foobar Immobibaz",
-            ],
-        ),
-        (
-            "immobibaz",
-            "Réseau Foobar (Foobar Immobibaz)",
-            [
-                "Réseau Foobar",
-                "FOOBAR TRANSACTION FRANCE",
-                "FOOBAR AGENCE CENTRALE",
-                "Foobar Immobibaz",
-            ],
-        ),
-    ],
-)
-def test_compute_label(query, selected, candidates):
-    assert helpers.compute_label(query, *candidates) == selected
-
-
 @pytest.mark.parametrize(
     "input,output",
     [
@@ -352,7 +328,7 @@ def test_extract_ft():
 
 
 @pytest.mark.asyncio
-async def test_recherche_entreprise(monkeypatch):
+async def test_recherche_entreprise(monkeypatch, init_db):
     async def mock_get(*args, **kwargs):
         return RECHERCHE_ENTREPRISE_SAMPLE
 
@@ -370,7 +346,7 @@ async def test_recherche_entreprise(monkeypatch):
 
 
 @pytest.mark.asyncio
-async def test_recherche_entreprise_with_date_radiation(monkeypatch):
+async def test_recherche_entreprise_with_date_radiation(monkeypatch, init_db):
     RECHERCHE_ENTREPRISE_SAMPLE["etatAdministratifUniteLegale"] = "C"
 
     async def mock_get(*args, **kwargs):
@@ -387,7 +363,7 @@ async def test_recherche_entreprise_with_date_radiation(monkeypatch):
 
 
 @pytest.mark.asyncio
-async def test_recherche_entreprise_with_foreign_company(monkeypatch):
+async def test_recherche_entreprise_with_foreign_company(monkeypatch, init_db):
     async def mock_get(*args, **kwargs):
         return {
             "activitePrincipale": "Activités des sièges sociaux",
@@ -423,7 +399,7 @@ async def test_recherche_entreprise_with_foreign_company(monkeypatch):
 
 
 @pytest.mark.asyncio
-async def test_recherche_entreprise_with_com_company(monkeypatch):
+async def test_recherche_entreprise_with_com_company(monkeypatch, init_db):
     async def mock_get(*args, **kwargs):
         return {
             "activitePrincipale": "Activités des agences de travail temporaire",
@@ -465,7 +441,7 @@ async def test_recherche_entreprise_with_com_company(monkeypatch):
 
 
 @pytest.mark.asyncio
-async def test_recherche_entreprise_is_cached(monkeypatch):
+async def test_recherche_entreprise_is_cached(monkeypatch, init_db):
     RECHERCHE_ENTREPRISE_SAMPLE["label"] = "123 je vais dans les bois"
     RECHERCHE_ENTREPRISE_SAMPLE["simpleLabel"] = "123 je vais dans les bois"
 
@@ -485,7 +461,9 @@ async def test_recherche_entreprise_is_cached(monkeypatch):
 
 
 @pytest.mark.asyncio
-async def test_recherche_entreprise_with_date_radiation_current_year(monkeypatch):
+async def test_recherche_entreprise_with_date_radiation_current_year(
+    monkeypatch, init_db
+):
     # Older than active year
     API_ENTREPRISES_SAMPLE["entreprise"]["date_radiation"] = "2019-03-12"
 
@@ -505,6 +483,7 @@ async def test_recherche_entreprise_with_date_radiation_current_year(monkeypatch
     API_ENTREPRISES_SAMPLE["entreprise"][
         "date_radiation"
     ] = f"{constants.CURRENT_YEAR}-03-12"
+    await db.entreprise.delete("481912999")  # Forget the cached error.
     res = await helpers.get_entreprise_details("481912999")
     assert res == {
         "adresse": "2 RUE FOOBAR",
@@ -523,3 +502,132 @@ async def test_recherche_entreprise_with_date_radiation_current_year(monkeypatch
 )
 def test_code_insee_to_departement(code, expected):
     assert helpers.code_insee_to_departement(code) == expected
+
+
+@pytest.mark.asyncio
+async def test_entreprise_errors_are_cached(monkeypatch, init_db):
+    calls = []
+
+    async def mock_get(*args, **kwargs):
+        calls.append(args)
+        return None
+
+    monkeypatch.setattr("egapro.helpers.get", mock_get)
+    for _ in range(2):
+        with pytest.raises(ValueError) as info:
+            await helpers.get_entreprise_details("481912999")
+        assert str(info.value) == "Numéro SIREN inconnu: 481912999"
+    assert len(calls) == 1
+    stats = await helpers.entreprise_cache_stats()
+    assert stats["total"] == 1
+    assert stats["negative"] == 1
+
+    # Expired negative entry: call the API again.
+    monkeypatch.setattr("egapro.config.SIREN_NEGATIVE_TTL", 0)
+    with pytest.raises(ValueError):
+        await helpers.get_entreprise_details("481912999")
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_entreprise_transient_errors_are_not_cached(monkeypatch, init_db):
+    statuses = [500]
+
+    def handler(request):
+        status = statuses.pop(0)
+        if status == 200:
+            return httpx.Response(200, json=RECHERCHE_ENTREPRISE_SAMPLE)
+        if status is None:
+            raise httpx.ConnectTimeout("Timeout", request=request)
+        return httpx.Response(status)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr("egapro.helpers.client", client)
+    statuses = [500, None, 200]
+    for _ in range(2):
+        with pytest.raises(helpers.UpstreamError):
+            await helpers.get_entreprise_details("481912999")
+        assert (await helpers.entreprise_cache_stats())["total"] == 0
+    res = await helpers.get_entreprise_details("481912999")
+    assert res["raison_sociale"] == RECHERCHE_ENTREPRISE_SAMPLE["simpleLabel"]
+    assert (await helpers.entreprise_cache_stats())["total"] == 1
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_entreprise_revalidation_errors_are_logged(monkeypatch, init_db):
+    await db.entreprise.put("481912999", {"raison_sociale": "Old name"})
+    await db.entreprise.execute(
+        "UPDATE entreprise SET fetched_at=$1", utils.utcnow() - timedelta(days=7.5)
+    )
+    errors = []
+    monkeypatch.setattr("egapro.helpers.logger.error", errors.append)
+
+    async def mock_get(*args, **kwargs):
+        raise helpers.UpstreamError("Service indisponible: 502")
+
+    monkeypatch.setattr("egapro.helpers.get", mock_get)
+    res = await helpers.get_entreprise_details("481912999")
+    assert res == {"raison_sociale": "Old name"}
+    assert isinstance(helpers.REVALIDATING["481912999"], asyncio.Future)
+    while helpers.REVALIDATING:
+        await asyncio.sleep(0.01)
+    assert errors == ["Cannot refresh entreprise 481912999: Service indisponible: 502"]
+    # The stale value is still there.
+    assert (await db.entreprise.get("481912999"))["data"] == {
+        "raison_sociale": "Old name"
+    }
+
+
+@pytest.mark.asyncio
+async def test_entreprise_stale_while_revalidate(monkeypatch, init_db):
+    await db.entreprise.put("481912999", {"raison_sociale": "Old name"})
+    await db.entreprise.execute(
+        "UPDATE entreprise SET fetched_at=$1", utils.utcnow() - timedelta(days=7.5)
+    )
+
+    async def mock_get(*args, **kwargs):
+        return {
+            **RECHERCHE_ENTREPRISE_SAMPLE,
+            "simpleLabel": "New name",
+            "etatAdministratifUniteLegale": "A",
+        }
+
+    monkeypatch.setattr("egapro.helpers.get", mock_get)
+    # Stale value is returned, while it's refreshed in background.
+    res = await helpers.get_entreprise_details("481912999")
+    assert res == {"raison_sociale": "Old name"}
+    while helpers.REVALIDATING:
+        await asyncio.sleep(0.01)
+    res = await helpers.get_entreprise_details("481912999")
+    assert res["raison_sociale"] == "New name"
+
+    # Too old to be served even stale.
+    monkeypatch.setattr("egapro.config.SIREN_STALE", 0)
+    await db.entreprise.put("481912999", {"raison_sociale": "Old name"})
+    await db.entreprise.execute(
+        "UPDATE entreprise SET fetched_at=$1", utils.utcnow() - timedelta(days=8)
+    )
+    res = await helpers.get_entreprise_details("481912999")
+    assert res["raison_sociale"] == "New name"
+
+
+@pytest.mark.asyncio
+async def test_get_reuses_shared_client(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        if request.url.path == "/missing":
+            return httpx.Response(404)
+        return httpx.Response(200, json={"ok": True})
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr("egapro.helpers.client", client)
+    assert await helpers.get("https://example.org/foo") == {"ok": True}
+    assert await helpers.get("https://example.org/missing") is None
+    assert calls == ["example.org", "example.org"]
+    assert not client.is_closed
+    await helpers.terminate()
+    assert client.is_closed
+    assert helpers.client is None
@@ -0,0 +1,133 @@
+import asyncio
+from email import message_from_bytes
+
+import pytest
+
+from egapro import db, emails
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures("init_db")]
+
+
+@pytest.fixture(autouse=True)
+def send_emails(monkeypatch):
+    monkeypatch.setattr("egapro.config.SEND_EMAILS", True)
+
+
+@pytest.fixture
+async def smtpd(monkeypatch):
+    """Minimal local SMTP server, keeping the received messages."""
+    received = []
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        writer.write(b"220 localhost\r\n")
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == b"DATA":
+                writer.write(b"354 go ahead\r\n")
+                await writer.drain()
+                lines = []
+                while True:
+                    line = await reader.readline()
+                    if line == b".\r\n":
+                        break
+                    lines.append(line)
+                received.append(message_from_bytes(b"".join(lines)))
+                writer.write(b"250 OK\r\n")
+            elif command == b"QUIT":
+                writer.write(b"221 bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"250 OK\r\n")
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    monkeypatch.setattr("egapro.config.SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr("egapro.config.SMTP_PORT", server.sockets[0].getsockname()[1])
+    server.connections = connections
+    server.received = received
+    yield server
+    server.close()
+    await server.wait_closed()
+
+
+async def test_send_only_queues():
+    await emails.send("foo@bar.org", "Foo", "Bar")
+    assert (await db.outbox.stats()) == {"pending": 1, "abandoned": 0}
+
+
+async def test_flush_sends_through_one_connection(smtpd):
+    for i in range(3):
+        await emails.send("foo@bar.org", f"Foo {i}", "Bar")
+    assert await emails.outbox.flush() == 3
+    assert [m["Subject"] for m in smtpd.received] == ["Foo 0", "Foo 1", "Foo 2"]
+    assert len(smtpd.connections) == 1
+    assert (await db.outbox.stats()) == {"pending": 0, "abandoned": 0}
+    # Nothing left to send.
+    assert await emails.outbox.flush() == 0
+
+
+async def test_flush_retries_with_backoff(monkeypatch):
+    monkeypatch.setattr("egapro.config.SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr("egapro.config.SMTP_PORT", 1)  # Nobody listening.
+    monkeypatch.setattr("egapro.config.OUTBOX_MAX_ATTEMPTS", 2)
+    await emails.send("foo@bar.org", "Foo", "Bar")
+    assert await emails.outbox.flush() == 0
+    row = await db.outbox.fetchrow("SELECT * FROM outbox")
+    assert row["attempts"] == 1
+    assert row["error"]
+    # Not due yet.
+    assert await emails.outbox.flush() == 0
+    assert (await db.outbox.fetchrow("SELECT * FROM outbox"))["attempts"] == 1
+
+    await db.outbox.execute("UPDATE outbox SET next_attempt_at=NOW()")
+    assert await emails.outbox.flush() == 0
+    assert (await db.outbox.stats()) == {"pending": 0, "abandoned": 1}
+
+
+async def test_flush_stops_on_connection_errors(monkeypatch):
+    monkeypatch.setattr("egapro.config.SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr("egapro.config.SMTP_PORT", 1)  # Nobody listening.
+    for i in range(3):
+        await emails.send("foo@bar.org", f"Foo {i}", "Bar")
+    assert await emails.outbox.flush() == 0
+    rows = await db.outbox.fetch(
+        "SELECT attempts, next_attempt_at <= NOW() AS due FROM outbox ORDER BY id"
+    )
+    # Only the first one was tried, the others are released as they were.
+    assert [tuple(row) for row in rows] == [(1, False), (0, True), (0, True)]
+
+
+async def test_send_many_resumes_from_checkpoint(smtpd, tmp_path):
+    checkpoint = tmp_path / "checkpoint"
+    checkpoint.write_text("123456782/2020\n")
+    items = [
+        ("123456782/2020", "foo@bar.org", {"id": "1234"}),
+        ("514027945/2020", "bar@foo.org", {"id": "5678"}),
+    ]
+    assert await emails.send_many("permalink", items, checkpoint, workers=2) == 1
+    assert [m["To"] for m in smtpd.received] == ["bar@foo.org"]
+    assert "5678" in smtpd.received[0].get_payload(decode=True).decode()
+    assert checkpoint.read_text().split() == ["123456782/2020", "514027945/2020"]
+    assert (await db.outbox.stats()) == {"pending": 0, "abandoned": 0}
+    # Everything is done.
+    assert await emails.send_many("permalink", items, checkpoint) == 0
+
+
+async def test_claimed_emails_are_leased(smtpd):
+    await emails.send("foo@bar.org", "Foo", "Bar")
+    (row,) = await db.outbox.claim(10, 60)
+    # Being sent by another worker.
+    assert await db.outbox.claim(10, 60) == []
+    assert await emails.outbox.flush() == 0
+    assert smtpd.received == []
+    # That worker died: sent again once the lease expired.
+    await db.outbox.execute("UPDATE outbox SET next_attempt_at=NOW()")
+    assert await emails.outbox.flush() == 1
+    assert [m["Subject"] for m in smtpd.received] == ["Foo"]
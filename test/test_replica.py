@@ -0,0 +1,146 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from egapro import db, replica
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures("init_db")]
+
+
+@pytest.fixture
+async def companies(declaration):
+    async def factory(siren, year, company, **entreprise):
+        entreprise.setdefault("effectif", {"tranche": "1000:"})
+        await declaration(siren, year=year, company=company, entreprise=entreprise)
+
+    await factory("123456781", 2019, "Bio c Bon", département="77", région="11")
+    await factory("123456781", 2020, "Bio c Bon", département="77", région="11")
+    await factory("123456782", 2020, "Biocoop", département="26", région="84")
+    await factory("123456783", 2020, "Pyrénées Énergies", code_naf="33.11Z")
+    await factory(
+        "123456784",
+        2019,
+        "Réseau",
+        ues={
+            "nom": "Réseau Foobar",
+            "entreprises": [
+                {"siren": "123456785", "raison_sociale": "Foobar Immobibaz"},
+            ],
+        },
+    )
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {},
+        {"query": "bio"},
+        {"query": "bio c"},
+        {"query": "BIO", "region": "11"},
+        {"query": "pyrenees"},
+        {"query": "123456781"},
+        {"query": "immobi"},
+        {"query": "nothing"},
+        {"departement": "26"},
+        {"section_naf": "C"},
+        {"limit": 2},
+        {"limit": 2, "offset": 2},
+        {"limit": 1, "offset": 10},
+        {"query": "bio", "fields": ("label", "notes")},
+    ],
+)
+async def test_replica_page_matches_db(companies, params):
+    index = replica.Index()
+    assert await index.refresh() == 5
+    assert await index.page(**params) == await db.search.page(**params)
+
+
+async def test_replica_cursor_and_label(companies):
+    index = replica.Index()
+    await index.refresh()
+    page = await index.page(limit=2)
+    assert page == await db.search.page(limit=2)
+    assert await index.page(limit=2, cursor=page["next"]) == await db.search.page(
+        limit=2, cursor=page["next"]
+    )
+    (result,) = (await index.page("immobibaz"))["data"]
+    assert result["label"] == "Réseau Foobar (Foobar Immobibaz)"
+    with pytest.raises(ValueError):
+        await index.page(fields=("data",))
+    naive = db.search.encode_cursor(datetime(2020, 1, 1), "123456781")
+    with pytest.raises(ValueError):
+        await index.page(cursor=naive)
+
+
+async def test_replica_stats_match_db(companies):
+    index = replica.Index()
+    await index.refresh()
+    for year, filters in [
+        (2020, {}),
+        (2019, {}),
+        (2020, {"departement": "77"}),
+        (2020, {"region": "84", "section_naf": "C"}),
+        (2018, {}),
+    ]:
+        expected = dict(await db.search.stats(year, **filters))
+        got = await index.stats(year, **filters)
+        assert (got.pop("refreshed_at") is None) == (
+            expected.pop("refreshed_at") is None
+        )
+        assert got == expected
+
+
+async def test_replica_refresh_follows_changes(companies, declaration):
+    index = replica.Index()
+    await index.refresh()
+    await declaration("123456782", year=2020, company="Coopérative")
+    await db.declaration.delete("123456781", 2020)
+    await declaration("123456786", year=2020, company="Nouvelle Coop")
+    assert await index.refresh() >= 3
+    assert len(index) == 5
+    for query in ("bio", "coop", "biocoop", ""):
+        assert await index.page(query) == await db.search.page(query)
+    assert "biocoop" not in index.by_token
+
+
+async def test_replica_refresh_drops_rows_leaving_the_index(companies, declaration):
+    index = replica.Index()
+    await index.refresh()
+    size = len(index.sirens)
+    # The declaration is modified, but not indexed anymore.
+    await db.search.execute("DELETE FROM search WHERE year=2019")
+    await db.declaration.execute(
+        "UPDATE declaration SET modified_at=now() WHERE siren='123456781' AND year=2019"
+    )
+    await index.refresh()
+    assert ("123456781", 2019) not in index.ids
+    # Left the index without being modified, eg. on a full reindex.
+    assert ("123456784", 2019) not in index.ids
+    assert len(index) == 3
+    assert await index.page() == await db.search.page()
+    assert await index.page("reseau") == await db.search.page("reseau")
+    # Freed slots are reused.
+    await declaration("123456786", year=2020, company="Nouvelle Coop")
+    await index.refresh()
+    assert len(index) == 4
+    assert len(index.sirens) == size
+    assert await index.page("coop") == await db.search.page("coop")
+
+
+async def test_search_endpoints_use_replica(client, companies, monkeypatch):
+    index = replica.Index()
+    await index.refresh()
+    monkeypatch.setattr(replica, "index", index)
+    # Not in the replica until the next refresh.
+    await db.declaration.delete("123456782", 2020)
+    resp = await client.get("/search?q=bio")
+    assert resp.status == 200
+    assert json.loads(resp.body)["count"] == 2
+    resp = await client.get("/stats?year=2020")
+    assert resp.status == 200
+    assert json.loads(resp.body)["year_count"] == 3
+    assert "Last-Modified" in resp.headers
+    await index.refresh()
+    resp = await client.get("/search?q=bio")
+    assert json.loads(resp.body)["count"] == 1
@@ -62,3 +62,23 @@ def test_flatten_should_flatten_lists():
 )
 def test_remove_one_year(input, output):
     assert utils.remove_one_year(date(*input)) == date(*output)
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        ("gzip", True),
+        ("gzip, deflate", True),
+        ("deflate, gzip;q=0.5", True),
+        ("GZIP", True),
+        ("gzip;q=0", False),
+        ("gzip; q=0.0, deflate", False),
+        ("*", True),
+        ("*;q=0", False),
+        ("*, gzip;q=0", False),
+        ("deflate", False),
+        ("", False),
+    ],
+)
+def test_accepts_encoding(header, expected):
+    assert utils.accepts_encoding(header, "gzip") is expected